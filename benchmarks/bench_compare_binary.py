@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Benchmark of binary comparison of two equal files (the worst case: both files are read to the end).
+# Compares the old 8 KiB read loop of folder_sync with compare_files.compare_binary()
+# reading with readinto() and with mmap.
+# Usage: python benchmarks/bench_compare_binary.py [--sizes 1 100 5120] [--buffer-mb 4] [--folder /tmp]
+# Files are created in a temporary folder and removed afterwards, so it needs twice the largest size of free space.
+# Page cache is not dropped, so files smaller than RAM are read from memory after they were written.
+# Files smaller than 1 GB are compared three times and the best time is shown.
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compare_files  # noqa: E402
+
+
+def old_compare_binary(path_a, path_b):
+    # compare_binary() as it used to be in folder_sync
+    with open(path_a, 'rb') as f1, open(path_b, 'rb') as f2:
+        while True:
+            b1 = f1.read(8192)
+            b2 = f2.read(8192)
+            if b1 != b2:
+                return False
+            if not b1:
+                return True
+
+
+def readinto_compare_binary(path_a, path_b):
+    compare_files.use_mmap = False
+    return compare_files.compare_binary(path_a, path_b)
+
+
+def mmap_compare_binary(path_a, path_b):
+    compare_files.use_mmap = True
+    return compare_files.compare_binary(path_a, path_b)
+
+
+def make_equal_files(folder, size):
+    chunk = os.urandom(1024 ** 2)
+    paths = [os.path.join(folder, 'a.bin'), os.path.join(folder, 'b.bin')]
+    for path in paths:
+        with open(path, 'wb') as file:
+            written = 0
+            while written < size:
+                file.write(chunk[:size - written])
+                written += len(chunk)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of binary comparison of files.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 100, 5120], help='sizes of files in MB')
+    parser.add_argument('--buffer-mb', type=int, default=4)
+    parser.add_argument('--folder', default=None, help='where to create files (default: system temp folder)')
+    arguments = parser.parse_args()
+
+    compare_files.buffer_size = arguments.buffer_mb * 1024 ** 2
+    compare_files.MMAP_THRESHOLD = 0  # use mmap for any size when it is asked for
+    implementations = [('old 8 KiB read', old_compare_binary), ('readinto', readinto_compare_binary),
+                       ('mmap', mmap_compare_binary)]
+
+    print('{:>9} {:<16} {:>10} {:>10}'.format('size MB', 'implementation', 'seconds', 'MB/s'))
+    for size_mb in arguments.sizes:
+        folder = tempfile.mkdtemp(prefix='folder_sync_bench_', dir=arguments.folder)
+        try:
+            path_a, path_b = make_equal_files(folder, size_mb * 1024 ** 2)
+            for name, compare in implementations:
+                # the best of a few runs for small files, the first run also allocates read buffers
+                elapsed = None
+                for attempt in range(3 if size_mb < 1024 else 1):
+                    start_time = time.perf_counter()
+                    assert compare(path_a, path_b)
+                    elapsed = min(elapsed or float('inf'), time.perf_counter() - start_time)
+                print('{:>9} {:<16} {:>10.3f} {:>10.0f}'.format(size_mb, name, elapsed, 2 * size_mb / elapsed))
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+# Benchmark of scan_folder.scan_folder() with different number of workers.
+# Usage: python benchmarks/bench_scan_workers.py [path] [--workers 1 2 4 8 16] [--latency 5]
+# If path is not given, a temporary tree of files is generated.
+# --latency adds a delay in milliseconds to every folder listing to imitate network drive,
+# because on a local disk with warm cache listing is too fast to win anything from threads.
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scan_folder  # noqa: E402
+
+
+def make_tree(path, folders_number, files_per_folder):
+    # Create a simple tree: every folder has a few subfolders and files_per_folder empty files
+    made = 0
+    queue = [path]
+    while queue and made < folders_number:
+        current = queue.pop(0)
+        for i in range(4):
+            subfolder = os.path.join(current, 'folder{}'.format(i))
+            os.mkdir(subfolder)
+            queue.append(subfolder)
+            made += 1
+            for j in range(files_per_folder):
+                open(os.path.join(subfolder, 'file{}.txt'.format(j)), 'w').close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of parallel folder scan.')
+    parser.add_argument('path', nargs='?', help='folder to scan (default: generate temporary tree)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--latency', type=float, default=0, help='delay of every listing in milliseconds')
+    parser.add_argument('--folders', type=int, default=2000, help='folders in generated tree')
+    parser.add_argument('--files', type=int, default=20, help='files per folder in generated tree')
+    arguments = parser.parse_args()
+
+    temp_folder = None
+    path = arguments.path
+    if path is None:
+        temp_folder = tempfile.mkdtemp(prefix='folder_sync_bench_')
+        path = temp_folder
+        make_tree(path, arguments.folders, arguments.files)
+
+    if arguments.latency:
+        real_scandir = os.scandir
+
+        def slow_scandir(folder):
+            time.sleep(arguments.latency / 1000)
+            return real_scandir(folder)
+
+        scan_folder.os.scandir = slow_scandir
+
+    try:
+        serial_result = None
+        print('{:>8} {:>10} {:>14} {:>8}'.format('workers', 'seconds', 'entries/sec', 'speedup'))
+        for workers in arguments.workers:
+            start_time = time.perf_counter()
+            result = list(scan_folder.scan_folder(path, workers))
+            elapsed = time.perf_counter() - start_time
+            if serial_result is None:
+                serial_result = result, elapsed
+            elif result != serial_result[0]:
+                print('ERROR: result with {} workers differs from the first run'.format(workers))
+                sys.exit(1)
+            print('{:>8} {:>10.3f} {:>14.0f} {:>7.2f}x'.format(workers, elapsed, len(result) / elapsed,
+                                                              serial_result[1] / elapsed))
+    finally:
+        if temp_folder:
+            shutil.rmtree(temp_folder)
+
+
+if __name__ == '__main__':
+    main()
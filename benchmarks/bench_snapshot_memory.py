@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+# Memory needed for one item of a snapshot: old list records against SnapshotItem.
+# Usage: python benchmarks/bench_snapshot_memory.py [number of items]
+# Items are generated in memory, so no files are created on disk.
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scan_folder  # noqa: E402
+
+PATH_TO_ROOT_FOLDER = os.path.join(os.sep, 'mnt', 'storage', 'backup', 'photos')
+ROOT_FOLDER = 'photos'
+
+
+def generate_items(number):
+    # Items look like real ones: a few levels of folders and file names of usual length
+    for i in range(number):
+        path_wout_root = os.path.join('year_{}'.format(i % 20), 'event_{:05d}'.format(i // 200),
+                                      'IMG_{:08d}.jpg'.format(i))
+        yield 'file', path_wout_root, 3500000 + i, 1500000000123456789 + i, 4000000 + i
+
+
+def make_list_snapshot(number):
+    # Snapshot as it used to be built by get_snapshot()
+    snapshot = {}
+    for item_type, path_wout_root, size, mtime_ns, inode in generate_items(number):
+        full_path = os.path.join(PATH_TO_ROOT_FOLDER, path_wout_root)
+        path_with_root = os.path.join(ROOT_FOLDER, path_wout_root)
+        all_paths = [full_path, ROOT_FOLDER, path_with_root, path_wout_root]
+        snapshot[path_with_root] = [item_type, all_paths, size, -(-mtime_ns // 10 ** 9)]
+    return snapshot
+
+
+def make_item_snapshot(number):
+    # Snapshot as it is built by get_snapshot() now
+    snapshot = {}
+    root = scan_folder.FolderRoot(PATH_TO_ROOT_FOLDER, ROOT_FOLDER)
+    for item_type, path_wout_root, size, mtime_ns, inode in generate_items(number):
+        snapshot[path_wout_root] = scan_folder.SnapshotItem(item_type, path_wout_root, size, mtime_ns, inode, root)
+    return snapshot
+
+
+def measure(make_snapshot, number):
+    tracemalloc.start()
+    snapshot = make_snapshot(number)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del snapshot
+    return size
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    list_bytes = measure(make_list_snapshot, number)
+    item_bytes = measure(make_item_snapshot, number)
+
+    print('Items in snapshot: {}'.format(number))
+    print('{:<16} {:>12} {:>16}'.format('format', 'total MB', 'bytes per item'))
+    print('{:<16} {:>12.1f} {:>16.0f}'.format('list records', list_bytes / 1024 ** 2, list_bytes / number))
+    print('{:<16} {:>12.1f} {:>16.0f}'.format('SnapshotItem', item_bytes / 1024 ** 2, item_bytes / number))
+    print('Saved {:.0%}'.format(1 - item_bytes / list_bytes))
+
+
+if __name__ == '__main__':
+    main()
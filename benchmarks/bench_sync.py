@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+# Benchmark of the whole sync on a synthetic tree: scanning, finding changes since last sync, comparing,
+# binary comparison and syncing. Results are written as JSON, so runs of different versions can be compared.
+# Usage: python benchmarks/bench_sync.py [--files 10000] [--depth 3] [--fan-out 8] [--sizes lognormal]
+#        [--mean-kb 64] [--modified 0.05] [--deleted 0.02] [--new 0.02] [--seed 0] [--folder /tmp]
+#        [--output results.json] [-- options of folder_sync, e.g. --scan-workers 4]
+# A tree is generated (see make_tree.py) and copied to the second folder, both folders are stored as synced,
+# then files are modified, deleted and added in both of them, and the steps of folder_sync are timed one by one.
+# Page cache is not dropped, so files are read from memory after they were written.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import make_tree  # noqa: E402
+import compare_files  # noqa: E402
+import folder_sync  # noqa: E402
+
+
+def get_version():
+    # Commit of folder_sync that is benchmarked, None if it is not a git repository
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def answer(question):
+    # Answers of user to questions of folder_sync: do not show lists of files, sync everything as it is planned
+    return 'n' if 'SEE' in question else 'y'
+
+
+def measure(results, name, function, items=None, size=None):
+    # Run function once with its output hidden, and add its time and speed to results. Returns result of function.
+    start_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function()
+    elapsed = time.perf_counter() - start_time
+    results[name] = {'seconds': round(elapsed, 6)}
+    if items is not None:
+        results[name]['items'] = items(result) if callable(items) else items
+        results[name]['items_per_second'] = round(results[name]['items'] / max(elapsed, 1e-9), 1)
+    if size is not None:
+        results[name]['mb_per_second'] = round(size / 1024 ** 2 / max(elapsed, 1e-9), 1)
+    print('{:<36} {:>10.3f} s'.format(name, elapsed))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of folder_sync on a synthetic tree.')
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--depth', type=int, default=3, help='levels of subfolders')
+    parser.add_argument('--fan-out', type=int, default=8, help='subfolders in every folder')
+    parser.add_argument('--sizes', choices=make_tree.SIZE_DISTRIBUTIONS, default='lognormal')
+    parser.add_argument('--mean-kb', type=int, default=64, help='mean size of files in KB')
+    parser.add_argument('--modified', type=float, default=0.05, help='fraction of files to modify in each folder')
+    parser.add_argument('--deleted', type=float, default=0.02, help='fraction of files to delete in each folder')
+    parser.add_argument('--new', type=float, default=0.02, help='fraction of new files in each folder')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--folder', default=None, help='where to create trees (default: system temp folder)')
+    parser.add_argument('--output', help='write results to this JSON file (default: print them)')
+    parser.add_argument('folder_sync_options', nargs=argparse.REMAINDER,
+                        help='options of folder_sync after --, e.g. -- --compare-workers 8')
+    arguments = parser.parse_args()
+
+    arguments.folder_sync_options = [option for option in arguments.folder_sync_options if option != '--']
+    folder_sync.apply_settings(folder_sync.parse_arguments(arguments.folder_sync_options))
+    folder_sync.input = answer  # nobody answers questions during benchmark
+
+    temp_folder = tempfile.mkdtemp(prefix='folder_sync_bench_', dir=arguments.folder)
+    first_folder = os.path.join(temp_folder, 'first')
+    second_folder = os.path.join(temp_folder, 'second')
+    results = {}
+    try:
+        print('Generating {} files...'.format(arguments.files))
+        files = make_tree.make_tree(first_folder, arguments.files, arguments.depth, arguments.fan_out,
+                                    arguments.sizes, arguments.mean_kb * 1024, arguments.seed)
+        shutil.copytree(first_folder, second_folder)
+
+        snapshot = measure(results, 'get_snapshot', lambda: folder_sync.get_snapshot(first_folder, 'first'),
+                           items=len)
+        # both folders are stored as synced, the same way folder_sync stores them after sync
+        folder_sync.remove_from_a_next_time.append('first')
+        folder_sync.remove_from_b_next_time.append('second')
+        with contextlib.redirect_stdout(io.StringIO()):
+            folder_sync.store_snapshot_before_exit(first_folder, 'first', snapshot, [])
+            folder_sync.store_snapshot_before_exit(second_folder, 'second',
+                                                   folder_sync.get_snapshot(second_folder, 'second'), [])
+        time.sleep(2.1)  # changes should not fall into racy interval of folder times (scan_folder.RACY_INTERVAL_NS)
+
+        changes = {}
+        for index, path in enumerate((first_folder, second_folder)):
+            changes[os.path.basename(path)] = make_tree.change_tree(
+                path, files, arguments.modified, arguments.deleted, arguments.new, arguments.sizes,
+                arguments.mean_kb * 1024, arguments.seed + 1 + index)
+
+        measure(results, 'get_changes_between_folder_states',
+                lambda: folder_sync.get_changes_between_folder_states(first_folder, 'first'),
+                items=lambda change_set: len(change_set.current_snapshot))
+        # compare_snapshot() scans both folders again, as it does when program runs
+        folder_sync.change_sets.clear()
+        difference = measure(results, 'compare_snapshot',
+                             lambda: folder_sync.compare_snapshot(first_folder, second_folder, 'first', 'second',
+                                                                  True, True, True),
+                             items=lambda difference: len(difference[7].snap_a) + len(difference[7].snap_b))
+        measure(results, 'sync_files',
+                lambda: folder_sync.sync_files(difference, first_folder, second_folder, 'first', True, 'second',
+                                               True),
+                items=difference[6])
+
+        # folders are equal now, every pair of files is read to the end
+        pairs = [(os.path.join(first_folder, path), os.path.join(second_folder, path))
+                 for path in sorted(folder_sync.get_snapshot(first_folder, 'first'))
+                 if os.path.isfile(os.path.join(first_folder, path))]
+        total_size = sum(os.path.getsize(path_a) * 2 for path_a, path_b in pairs)
+        measure(results, 'compare_binary',
+                lambda: [compare_files.compare_binary(path_a, path_b) for path_a, path_b in pairs],
+                items=len(pairs), size=total_size)
+    finally:
+        shutil.rmtree(temp_folder)
+
+    report = {
+        'version': get_version(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {key: value for key, value in vars(arguments).items() if key not in ('output', 'folder')},
+        'changes': changes,
+        'results': results,
+    }
+    if arguments.output:
+        with open(arguments.output, 'w', encoding='utf8') as file:
+            json.dump(report, file, indent=2)
+        print('Results were written to {}.'.format(arguments.output))
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# Deterministic generator of synthetic trees of files for benchmarks.
+# The same parameters and seed give the same folders, names, sizes, content and times of modification,
+# so runs of different versions of folder_sync can be compared.
+# Usage: python benchmarks/make_tree.py path [--files 10000] [--depth 3] [--fan-out 8] [--sizes lognormal]
+#        [--mean-kb 64] [--seed 0] [--copy-to path] [--modified 0.05] [--deleted 0.02] [--new 0.02]
+# With --copy-to the tree is copied to the second folder (like a synced backup), and then the fractions of files
+# given by --modified, --deleted and --new are changed in each of the folders independently.
+
+import argparse
+import os
+import random
+import shutil
+
+BASE_MTIME = 1600000000  # times of modification of generated files are a few days before this moment
+SIZE_DISTRIBUTIONS = ('fixed', 'uniform', 'lognormal')
+BLOCK_SIZE = 1024 ** 2  # content of files is cut from one random block, so generating it costs nothing
+
+
+def make_block(seed):
+    return random.Random(seed).getrandbits(BLOCK_SIZE * 8).to_bytes(BLOCK_SIZE, 'little')
+
+
+def get_size(rng, distribution, mean_size):
+    # Size of one file, mean_size is the mean of distribution in bytes
+    if distribution == 'fixed':
+        return mean_size
+    if distribution == 'uniform':
+        return rng.randint(0, 2 * mean_size)
+    # lognormal: most files are small and a few are large, like in real folders
+    sigma = 1.5
+    return int(rng.lognormvariate(0, sigma) * mean_size / 3.08)  # 3.08 = exp(sigma ** 2 / 2), mean of lognormal
+
+
+def write_file(path, size, block, offset, mtime):
+    with open(path, 'wb') as file:
+        written = 0
+        while written < size:
+            chunk = block[offset:offset + size - written] or block[:size - written]
+            file.write(chunk)
+            written += len(chunk)
+            offset = 0
+    os.utime(path, (mtime, mtime))
+
+
+def get_folders(depth, fan_out):
+    # Paths without root folder of all folders of a tree with depth levels and fan_out subfolders in every folder
+    folders = ['']
+    level = ['']
+    for level_number in range(depth):
+        level = [os.path.join(parent, 'folder_{}_{}'.format(level_number, index))
+                 for parent in level for index in range(fan_out)]
+        folders.extend(level)
+    return folders
+
+
+def make_tree(path, files=10000, depth=3, fan_out=8, sizes='lognormal', mean_size=64 * 1024, seed=0):
+    # Create tree in path, which should not exist. Returns list of paths without root folder of created files.
+    rng = random.Random(seed)
+    block = make_block(seed)
+    folders = get_folders(depth, fan_out)
+    for folder in folders:
+        os.makedirs(os.path.join(path, folder), exist_ok=True)
+
+    created = []
+    for index in range(files):
+        path_wout_root = os.path.join(rng.choice(folders), 'file_{:07d}.bin'.format(index))
+        write_file(os.path.join(path, path_wout_root), get_size(rng, sizes, mean_size), block,
+                   rng.randrange(BLOCK_SIZE), BASE_MTIME - rng.randrange(7 * 24 * 3600))
+        created.append(path_wout_root)
+    return created
+
+
+def change_tree(path, files, modified=0.05, deleted=0.02, new=0.02, sizes='lognormal', mean_size=64 * 1024,
+                seed=1):
+    # Modify, delete and add the given fractions of files of a tree made by make_tree().
+    # files is list of paths without root folder of its files. Changed and new files get times of modification
+    # later than any generated file, so they look like they have changed since last sync.
+    # Returns dictionary with number of files of every kind.
+    rng = random.Random(seed)
+    block = make_block(seed)
+    shuffled = sorted(files)
+    rng.shuffle(shuffled)
+    number_modified = int(len(files) * modified)
+    number_deleted = int(len(files) * deleted)
+    folders = sorted({os.path.dirname(path_wout_root) for path_wout_root in files})
+
+    for path_wout_root in shuffled[:number_modified]:
+        write_file(os.path.join(path, path_wout_root), get_size(rng, sizes, mean_size), block,
+                   rng.randrange(BLOCK_SIZE), BASE_MTIME + 3600 + rng.randrange(3600))
+    for path_wout_root in shuffled[number_modified:number_modified + number_deleted]:
+        os.remove(os.path.join(path, path_wout_root))
+    number_new = int(len(files) * new)
+    for index in range(number_new):
+        path_wout_root = os.path.join(rng.choice(folders), 'new_{}_{:07d}.bin'.format(seed, index))
+        write_file(os.path.join(path, path_wout_root), get_size(rng, sizes, mean_size), block,
+                   rng.randrange(BLOCK_SIZE), BASE_MTIME + 3600 + rng.randrange(3600))
+    return {'modified': number_modified, 'deleted': number_deleted, 'new': number_new}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic tree of files for benchmarks.')
+    parser.add_argument('path', help='folder to create, it should not exist')
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--depth', type=int, default=3, help='levels of subfolders')
+    parser.add_argument('--fan-out', type=int, default=8, help='subfolders in every folder')
+    parser.add_argument('--sizes', choices=SIZE_DISTRIBUTIONS, default='lognormal', help='distribution of sizes')
+    parser.add_argument('--mean-kb', type=int, default=64, help='mean size of files in KB')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--copy-to', help='copy tree to this folder and change both copies')
+    parser.add_argument('--modified', type=float, default=0.05, help='fraction of files to modify in each copy')
+    parser.add_argument('--deleted', type=float, default=0.02, help='fraction of files to delete in each copy')
+    parser.add_argument('--new', type=float, default=0.02, help='fraction of new files in each copy')
+    arguments = parser.parse_args()
+
+    files = make_tree(arguments.path, arguments.files, arguments.depth, arguments.fan_out, arguments.sizes,
+                      arguments.mean_kb * 1024, arguments.seed)
+    print('{} files were created in {}.'.format(len(files), arguments.path))
+    if arguments.copy_to:
+        shutil.copytree(arguments.path, arguments.copy_to)
+        for index, path in enumerate((arguments.path, arguments.copy_to)):
+            changed = change_tree(path, files, arguments.modified, arguments.deleted, arguments.new, arguments.sizes,
+                                  arguments.mean_kb * 1024, arguments.seed + 1 + index)
+            print('{}: {modified} modified, {deleted} deleted, {new} new file(s).'.format(path, **changed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+
+# This module decides whether two files with the same path in both folders have the same content.
+
+# Digests of content of files are cached in .folderSyncSnapshot/hashes.sqlite3 of every folder.
+# A digest is valid while path, size, time of modification in nanoseconds and inode of the file
+# stay the same, so a file that has not been touched since it was hashed is never read again,
+# even if pair of files stays unresolved for many runs.
+
+# Files that are not in cache are compared side by side. Both files are read with readinto() into
+# two buffers that are allocated once per thread, so comparison of multi-GB files doesn't create
+# a new bytes object for every chunk. Files are hashed at the same time, and if they turn out
+# to be equal both digests go to cache. Comparison with mmap can be chosen instead of reading,
+# it is used only for large files on local disks because on network drives every page fault waits for the server.
+
+# Before the whole files are read, a few probe blocks are compared: at the beginning, at the end
+# and at evenly spaced offsets between them. Most files with different time of modification
+# really have different content, and a probe usually finds it after reading a few kilobytes.
+
+# compare_pairs() compares many pairs of files in a thread pool. Number of comparisons that read
+# from the same disk at once is limited, and large files are compared in their own lane
+# with a limit of bytes in flight, so neither thousands of small files wait behind one huge file
+# nor a huge file waits until all small ones are done.
+
+import hashlib
+import logging
+import mmap
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import metrics
+import progress
+import scan_folder
+import snapshot_store
+
+log_file = logging.getLogger('fs1')
+
+HASH_CACHE_NAME = 'hashes.sqlite3'
+MMAP_THRESHOLD = 64 * 1024 ** 2  # smaller files are always compared with readinto()
+SMALL_BUFFER_SIZE = 64 * 1024  # buffer for files smaller than buffer_size and for probes
+
+# file systems on which mmap is not used
+NETWORK_FILE_SYSTEMS = {'nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'ncpfs', 'afs', 'ceph', 'glusterfs', '9p',
+                        'fuse.sshfs', 'fuse.rclone', 'davfs'}
+
+# options, folder_sync sets them from command line
+buffer_size = 4 * 1024 ** 2  # size of each of two read buffers in bytes
+use_mmap = False
+
+# read buffers are reused, but every thread needs its own pair
+buffers = threading.local()
+
+# options of compare_pairs(), folder_sync sets them from command line
+workers = 4  # threads comparing files smaller than LARGE_FILE_SIZE
+large_file_workers = 4  # threads comparing large files, max_bytes_in_flight limits how many of them read at once
+max_per_device = 4  # comparisons that read from the same device at once
+max_bytes_in_flight = 1024 ** 3  # total size of large files being compared at once
+LARGE_FILE_SIZE = 64 * 1024 ** 2
+probes = 4  # probe blocks between the first and the last one, 0 turns probes off
+PROBE_SIZE = 64 * 1024
+
+
+class HashCache:
+    # Cache of digests of files of one folder. Database is opened only when it is needed for the first time,
+    # so folders that have nothing to compare don't get .folderSyncSnapshot folder because of it.
+
+    def __init__(self, path_to_folder):
+        self.path_to_database = os.path.join(path_to_folder, scan_folder.SNAPSHOT_FOLDER, HASH_CACHE_NAME)
+        self.connection = None
+        self.lock = threading.Lock()  # files are compared in several threads
+
+    def _connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.path_to_database), exist_ok=True)
+            self.connection = sqlite3.connect(self.path_to_database, check_same_thread=False)
+            # paths are UTF-8 BLOBs like in snapshot store, see snapshot_store.encode_path()
+            self.connection.execute('CREATE TABLE IF NOT EXISTS hashes (path BLOB PRIMARY KEY, size INTEGER, '
+                                    'mtime_ns INTEGER, inode INTEGER, digest BLOB) WITHOUT ROWID')
+            if self.connection.execute('PRAGMA user_version').fetchone()[0] < snapshot_store.SCHEMA_VERSION:
+                with self.connection:
+                    self.connection.execute("UPDATE hashes SET path = CAST(path AS BLOB) WHERE typeof(path) = 'text'")
+                    self.connection.execute('PRAGMA user_version = {}'.format(snapshot_store.SCHEMA_VERSION))
+        return self.connection
+
+    def get(self, item):
+        # Return cached digest of SnapshotItem or None if file has changed since it was hashed
+        with self.lock:
+            row = self._connect().execute('SELECT size, mtime_ns, inode, digest FROM hashes WHERE path = ?',
+                                          (snapshot_store.encode_path(item.path_wout_root),)).fetchone()
+        if row is not None and tuple(row[:3]) == (item.size, item.mtime_ns, item.inode):
+            return row[3]
+        return None
+
+    def put(self, item, digest, hashed_at_ns):
+        # hashed_at_ns is time when reading of the file started. If the file was modified that recently, it could
+        # be rewritten with the same size in the same tick of file system clock after it was read, and cached
+        # digest would be taken for the new content, so such digest is not cached (see scan_folder.RACY_INTERVAL_NS).
+        if item.mtime_ns >= hashed_at_ns - scan_folder.RACY_INTERVAL_NS:
+            return
+        with self.lock:
+            self._connect().execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)',
+                                    (snapshot_store.encode_path(item.path_wout_root), item.size, item.mtime_ns,
+                                     item.inode, digest))
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        if self.connection is not None:
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
+
+
+class CompareStats:
+    # How much work hash cache saved during the compare phase
+
+    def __init__(self):
+        # pairs of files resolved at every tier of comparison
+        self.size_mismatches = 0  # without reading, because sizes differ
+        self.resolved_by_cache = 0  # both digests were in cache
+        self.resolved_by_probes = 0  # probe blocks differ
+        self.resolved_by_reading = 0  # whole files were read
+        self.cache_hits = 0  # digests taken from cache
+        self.cache_misses = 0  # files that had to be read and hashed
+        self.bytes_read = 0
+        self.bytes_avoided = 0  # size of files that were not read thanks to cache
+        self.lock = threading.Lock()
+
+    def add(self, **counters):
+        # Add values to counters, e.g. stats.add(cache_hits=1), safe to call from several threads
+        with self.lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+
+# HashCache of every folder that has been compared during this run, keys are paths to folders
+hash_caches = {}
+hash_caches_lock = threading.Lock()
+stats = CompareStats()
+
+
+def get_hash_cache(path_to_folder):
+    with hash_caches_lock:
+        if path_to_folder not in hash_caches:
+            hash_caches[path_to_folder] = HashCache(path_to_folder)
+        return hash_caches[path_to_folder]
+
+
+def close_hash_caches():
+    for cache in hash_caches.values():
+        cache.close()
+    hash_caches.clear()
+
+
+def get_buffers(file_size):
+    # Return two preallocated buffers of this thread, (re)allocate them if buffer size has changed.
+    # Small files get small buffers: the last chunk of a file is sliced out of buffer to be compared,
+    # and slicing of megabytes costs more than reading a small file.
+    if file_size < buffer_size:
+        if not hasattr(buffers, 'small'):
+            buffers.small = bytearray(SMALL_BUFFER_SIZE), bytearray(SMALL_BUFFER_SIZE)
+        return buffers.small
+    if getattr(buffers, 'size', None) != buffer_size:
+        buffers.large = bytearray(buffer_size), bytearray(buffer_size)
+        buffers.size = buffer_size
+    return buffers.large
+
+
+def is_on_local_disk(path):
+    # Best guess whether file is on local disk, used to decide whether mmap is worth it
+    if sys.platform.startswith('win'):
+        return not os.path.abspath(path).startswith('\\\\')  # UNC path like \\server\share
+    try:
+        with open('/proc/self/mounts', encoding='utf-8') as mounts:
+            mount_points = [line.split()[1:3] for line in mounts]
+    except OSError:
+        return True
+
+    # find the longest mount point that contains the file
+    path = os.path.realpath(path)
+    best_mount_point, file_system = '', ''
+    for mount_point, mount_file_system in mount_points:
+        mount_point = mount_point.replace('\\040', ' ')
+        inside = path == mount_point or path.startswith(mount_point.rstrip('/') + '/')
+        if inside and len(mount_point) >= len(best_mount_point):
+            best_mount_point, file_system = mount_point, mount_file_system
+    return file_system not in NETWORK_FILE_SYSTEMS
+
+
+def hash_file(path):
+    digest = hashlib.blake2b()
+    buffer, _ = get_buffers(buffer_size)
+    view = memoryview(buffer)
+    calls = 0
+    with open(path, 'rb', buffering=0) as file:
+        while True:
+            bytes_read = file.readinto(buffer)
+            calls += 1
+            if not bytes_read:
+                break
+            digest.update(view[:bytes_read])
+    metrics.add('read', calls)
+    return digest.digest()
+
+
+def get_probe_offsets(size):
+    # Offsets of probe blocks: the first block, the last one and evenly spaced blocks between them.
+    # Returns empty list if file is so small that it is faster to compare it at once.
+    if probes <= 0 or size <= (probes + 2) * PROBE_SIZE:
+        return []
+    last_offset = size - PROBE_SIZE
+    step = last_offset // (probes + 1)
+    return [0] + [step * i for i in range(1, probes + 1)] + [last_offset]
+
+
+def probes_are_equal(path_a, path_b, size):
+    # Compare a few blocks of two files of the same size, return False as soon as blocks differ
+    offsets = get_probe_offsets(size)
+    if not offsets:
+        return True
+    buffer_a, buffer_b = get_buffers(0)  # small buffers are exactly PROBE_SIZE
+    view_a, view_b = memoryview(buffer_a), memoryview(buffer_b)
+    with open(path_a, 'rb', buffering=0) as file_a, open(path_b, 'rb', buffering=0) as file_b:
+        for offset in offsets:
+            file_a.seek(offset)
+            file_b.seek(offset)
+            read_a = read_into_buffer(file_a, view_a)
+            read_b = read_into_buffer(file_b, view_b)
+            if read_a != read_b or buffer_a != buffer_b:
+                return False
+    return True
+
+
+def compare_binary(path_a, path_b, digest_a=None, digest_b=None):
+    # Compare two files byte by byte, return True if they are equal.
+    # If digest_a and digest_b (hashlib objects) are given, content of files is fed to them on the way,
+    # they are complete only if files are equal, because reading stops at the first difference.
+    size = os.path.getsize(path_a)
+    if size != os.path.getsize(path_b):
+        return False
+    if use_mmap and size >= MMAP_THRESHOLD and is_on_local_disk(path_a) and is_on_local_disk(path_b):
+        return _compare_mmap(path_a, path_b, digest_a, digest_b)
+    return _compare_readinto(path_a, path_b, size, digest_a, digest_b)
+
+
+def read_into_buffer(file, view):
+    # Fill the buffer completely unless the end of file is reached. A single readinto() may
+    # return less than asked, e.g. on network drives, and then two equal files would look different.
+    total_read = 0
+    calls = 0
+    while total_read < len(view):
+        bytes_read = file.readinto(view[total_read:])
+        calls += 1
+        if not bytes_read:
+            break
+        total_read += bytes_read
+    metrics.add('read', calls)
+    return total_read
+
+
+def _compare_readinto(path_a, path_b, size, digest_a, digest_b):
+    buffer_a, buffer_b = get_buffers(size)
+    view_a, view_b = memoryview(buffer_a), memoryview(buffer_b)
+    with open(path_a, 'rb', buffering=0) as file_a, open(path_b, 'rb', buffering=0) as file_b:
+        while True:
+            read_a = read_into_buffer(file_a, view_a)
+            read_b = read_into_buffer(file_b, view_b)
+            if read_a != read_b:
+                return False
+            if not read_a:
+                return True
+            if read_a == len(buffer_a):
+                # comparison of two bytearrays is a single memcmp() without copying
+                if buffer_a != buffer_b:
+                    return False
+            else:
+                # the last chunk is shorter than buffer and has to be sliced out of it,
+                # slice it in small pieces, because big slices are slow to allocate
+                for offset in range(0, read_a, SMALL_BUFFER_SIZE):
+                    end = min(offset + SMALL_BUFFER_SIZE, read_a)
+                    if buffer_a[offset:end] != buffer_b[offset:end]:
+                        return False
+            if digest_a is not None:
+                digest_a.update(view_a[:read_a])
+                digest_b.update(view_b[:read_b])
+
+
+def _compare_mmap(path_a, path_b, digest_a, digest_b):
+    with open(path_a, 'rb') as file_a, open(path_b, 'rb') as file_b, \
+            mmap.mmap(file_a.fileno(), 0, access=mmap.ACCESS_READ) as map_a, \
+            mmap.mmap(file_b.fileno(), 0, access=mmap.ACCESS_READ) as map_b:
+        metrics.add('mmap', 2)
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            map_a.madvise(mmap.MADV_SEQUENTIAL)
+            map_b.madvise(mmap.MADV_SEQUENTIAL)
+        for offset in range(0, len(map_a), buffer_size):
+            chunk_a = map_a[offset:offset + buffer_size]
+            chunk_b = map_b[offset:offset + buffer_size]
+            if chunk_a != chunk_b:
+                return False
+            if digest_a is not None:
+                digest_a.update(chunk_a)
+                digest_b.update(chunk_b)
+        return True
+
+
+def get_cached_digest(item):
+    # Get digest of a file from cache of its folder, None if file has changed since it was hashed
+    digest = get_hash_cache(item.root.path).get(item)
+    if digest is not None:
+        stats.add(cache_hits=1, bytes_avoided=item.size)
+    return digest
+
+
+def files_are_equal(file_from_a, file_from_b):
+    # Compare content of two files (SnapshotItem): by size, then by cached digests, and read only
+    # files that are not in cache.
+    if file_from_a.size != file_from_b.size:
+        stats.add(size_mismatches=1)
+        return False
+
+    if file_from_a.size > 1024 ** 3:
+        # called from threads of compare_pairs(), so message must not break progress line
+        message = "Comparing '{}' is gonna take some time, be patient.".format(file_from_a.full_path)
+        progress.echo(message)
+        log_file.info(message)
+
+    cached_digest_a = get_cached_digest(file_from_a)
+    cached_digest_b = get_cached_digest(file_from_b)
+    if cached_digest_a is not None and cached_digest_b is not None:
+        stats.add(resolved_by_cache=1)
+        return cached_digest_a == cached_digest_b
+
+    if not probes_are_equal(file_from_a.full_path, file_from_b.full_path, file_from_a.size):
+        stats.add(resolved_by_probes=1)
+        return False
+
+    stats.add(resolved_by_reading=1)
+    if cached_digest_a is not None or cached_digest_b is not None:
+        # only one file has to be read
+        file_to_hash = file_from_b if cached_digest_a is not None else file_from_a
+        stats.add(cache_misses=1, bytes_read=file_to_hash.size)
+        hashed_at_ns = time.time_ns()
+        digest = hash_file(file_to_hash.full_path)
+        get_hash_cache(file_to_hash.root.path).put(file_to_hash, digest, hashed_at_ns)
+        return digest == (cached_digest_a or cached_digest_b)
+
+    stats.add(cache_misses=2, bytes_read=file_from_a.size + file_from_b.size)
+    digest_a, digest_b = hashlib.blake2b(), hashlib.blake2b()
+    hashed_at_ns = time.time_ns()
+    if not compare_binary(file_from_a.full_path, file_from_b.full_path, digest_a, digest_b):
+        return False
+    # digests are complete only for equal files
+    get_hash_cache(file_from_a.root.path).put(file_from_a, digest_a.digest(), hashed_at_ns)
+    get_hash_cache(file_from_b.root.path).put(file_from_b, digest_b.digest(), hashed_at_ns)
+    return True
+
+
+class ByteBudget:
+    # Limit of total size of files being compared at once. A pair larger than the whole limit
+    # is still compared, but only when nothing else is in flight.
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            while self.in_flight and self.in_flight + size > self.limit:
+                self.condition.wait()
+            self.in_flight += size
+
+    def release(self, size):
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+
+def compare_pairs(pairs, on_compared=None):
+    # Compare content of many pairs of files (SnapshotItem, SnapshotItem) at once.
+    # Returns list of verdicts (True if files are equal) in the same order as pairs.
+    # on_compared(file_from_a, file_from_b) is called in the calling thread as soon as a pair has been compared,
+    # pairs come to it in any order, e.g. to show progress.
+
+    if workers <= 1 or len(pairs) <= 1:
+        verdicts = []
+        for file_from_a, file_from_b in pairs:
+            verdicts.append(files_are_equal(file_from_a, file_from_b))
+            if on_compared is not None:
+                on_compared(file_from_a, file_from_b)
+        return verdicts
+
+    devices = {}  # device of every root folder, every root is stat'ed only once
+    device_limits = {}
+    byte_budget = ByteBudget(max_bytes_in_flight)
+
+    def get_device(item):
+        if item.root.path not in devices:
+            devices[item.root.path] = os.stat(item.root.path).st_dev
+            device_limits.setdefault(devices[item.root.path], threading.BoundedSemaphore(max_per_device))
+        return devices[item.root.path]
+
+    def compare_pair(file_from_a, file_from_b, pair_devices, size_in_flight):
+        if size_in_flight:
+            byte_budget.acquire(size_in_flight)
+        # take limits of devices always in the same order, otherwise two threads can wait for each other
+        for device in pair_devices:
+            device_limits[device].acquire()
+        try:
+            return files_are_equal(file_from_a, file_from_b)
+        finally:
+            for device in pair_devices:
+                device_limits[device].release()
+            if size_in_flight:
+                byte_budget.release(size_in_flight)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='compare') as small_files_pool, \
+            ThreadPoolExecutor(max_workers=large_file_workers,
+                               thread_name_prefix='compare_large') as large_files_pool:
+        futures = []
+        for file_from_a, file_from_b in pairs:
+            pair_devices = sorted({get_device(file_from_a), get_device(file_from_b)})
+            if file_from_a.size >= LARGE_FILE_SIZE:
+                futures.append(large_files_pool.submit(compare_pair, file_from_a, file_from_b, pair_devices,
+                                                       file_from_a.size + file_from_b.size))
+            else:
+                futures.append(small_files_pool.submit(compare_pair, file_from_a, file_from_b, pair_devices, 0))
+        if on_compared is not None:
+            pair_of_future = dict(zip(futures, pairs))
+            for future in as_completed(futures):
+                if future.exception() is None:
+                    on_compared(*pair_of_future[future])
+        return [future.result() for future in futures]
+
+
+def reset_stats():
+    # Count from zero again, so every comparison reports only its own work
+    global stats
+    stats = CompareStats()
+
+
+def log_stats():
+    message = ('Binary comparison: pairs resolved by size - {}, by cache - {}, by probes - {}, by reading whole '
+               'files - {}.'.format(stats.size_mismatches, stats.resolved_by_cache, stats.resolved_by_probes,
+                                    stats.resolved_by_reading))
+    print(message)
+    log_file.info(message)
+
+    message = ('Hash cache: {} hit(s), {} miss(es), {:.2f} MB read, {:.2f} MB of reading avoided.'
+               .format(stats.cache_hits, stats.cache_misses, stats.bytes_read / 1024 ** 2,
+                       stats.bytes_avoided / 1024 ** 2))
+    print(message)
+    log_file.info(message)
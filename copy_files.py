@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+
+# This module copies files for folder_sync.
+
+# Copying of thousands of small files is limited by time every single file takes to open, create,
+# write and close rather than by speed of disk, so files are copied in a thread pool.
+# Number of copies that read from the same volume and that write to the same volume at once
+# are limited separately, so e.g. a slow USB drive is not flooded while the other folder is on SSD.
+
+# Content of a file is copied by the first backend that works for the pair of files:
+# 1. reflink (FICLONE) - on btrfs, XFS and others the copy shares blocks with the source, nothing is copied at all
+# 2. os.copy_file_range() - kernel copies data itself, or even server side on NFS and SMB
+# 3. os.sendfile() - kernel copies data without passing it through Python
+# 4. shutil.copyfileobj() - plain read and write in chunks, works everywhere
+
+import errno
+import itertools
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import send2trash
+
+import metrics
+import scan_folder
+
+try:
+    import fcntl
+except ImportError:  # there is no fcntl on Windows
+    fcntl = None
+
+log_file = logging.getLogger('fs1')
+
+# options, folder_sync sets them from command line
+workers = 4  # threads copying files
+max_per_source = 4  # copies that read from the same volume at once
+max_per_destination = 4  # copies that write to the same volume at once
+delta_threshold = 0  # files of this size or larger are updated by delta_update(), 0 turns it off
+delta_block_size = 1024 ** 2  # delta_update() compares and rewrites files by blocks of this size
+# How old versions of updated files are handled:
+# 'trash' - folder_sync sends them to trash and copies new versions afterwards,
+# 'replace' - new version is written to a temporary file and renamed over the old one,
+# 'stash' - the same as 'replace', but old version is kept in stash folder inside .folderSyncSnapshot
+update_mode = 'trash'
+stash_limit = 1024 ** 3  # maximum size of stash of one folder in bytes, older versions are evicted first
+
+STASH_FOLDER = 'stash'
+stash_counter = itertools.count(1)  # number of update in this run, see get_stash_path()
+
+# limits of volumes, keys are (device, 'read' or 'write')
+volume_limits = {}
+volume_limits_lock = threading.Lock()
+
+
+def get_volume_limit(path, direction):
+    device = os.stat(path).st_dev
+    with volume_limits_lock:
+        if (device, direction) not in volume_limits:
+            limit = max_per_source if direction == 'read' else max_per_destination
+            volume_limits[(device, direction)] = threading.BoundedSemaphore(limit)
+        return volume_limits[(device, direction)]
+
+
+FICLONE = 0x40049409  # ioctl of Linux that makes destination file share all blocks of source file
+CHUNK_SIZE = 8 * 1024 ** 2  # bytes copied by one system call
+
+# errors that mean backend can't copy between these two files, so the next backend should be tried
+UNSUPPORTED_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF, errno.ENOTTY, errno.EPERM,
+                      errno.ETXTBSY, getattr(errno, 'EOPNOTSUPP', errno.ENOTSUP), errno.ENOTSUP}
+BACKENDS = ('reflink', 'copy_file_range', 'sendfile', 'shutil')
+
+
+class CopyStats:
+    # How many files and bytes every backend has copied
+
+    def __init__(self):
+        self.files = dict.fromkeys(BACKENDS, 0)
+        self.bytes = dict.fromkeys(BACKENDS, 0)
+        self.seconds = 0.0  # time spent in copy_files()
+        self.lock = threading.Lock()
+
+    def add(self, backend, size):
+        with self.lock:
+            self.files[backend] += 1
+            self.bytes[backend] += size
+
+
+stats = CopyStats()
+
+
+def reflink(fd_in, fd_out, size):
+    # Make destination share blocks with source. Returns False if file system can't do it.
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    metrics.add('ioctl_ficlone')
+    try:
+        fcntl.ioctl(fd_out, FICLONE, fd_in)
+    except OSError as error:
+        if error.errno in UNSUPPORTED_ERRORS:
+            return False
+        raise
+    return True
+
+
+def kernel_copy(fd_in, fd_out, size, copy_chunk, syscall):
+    # Copy file by chunks with copy_chunk(offset, count) that returns number of copied bytes.
+    # Returns False if the very first chunk failed because backend doesn't support these files,
+    # nothing has been written to destination then. syscall is name of counter of calls of copy_chunk().
+    offset = 0
+    while offset < size:
+        metrics.add(syscall)
+        try:
+            copied = copy_chunk(offset, min(CHUNK_SIZE, size - offset))
+        except OSError as error:
+            if offset == 0 and error.errno in UNSUPPORTED_ERRORS:
+                return False
+            raise
+        if copied == 0:
+            if offset == 0:  # some file systems, e.g. procfs, just return nothing
+                return False
+            break  # file became shorter while being copied
+        offset += copied
+    return True
+
+
+def copy_by_copy_file_range(fd_in, fd_out, size):
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    return kernel_copy(fd_in, fd_out, size, lambda offset, count: os.copy_file_range(fd_in, fd_out, count, offset),
+                       'copy_file_range')
+
+
+def copy_by_sendfile(fd_in, fd_out, size):
+    # sendfile() can write into regular file only on Linux
+    if not hasattr(os, 'sendfile') or not sys.platform.startswith('linux'):
+        return False
+    return kernel_copy(fd_in, fd_out, size, lambda offset, count: os.sendfile(fd_out, fd_in, offset, count),
+                       'sendfile')
+
+
+def copy_file(source, destination):
+    # Copy one file with its metadata like shutil.copy2() does. Returns name of backend that copied content.
+    # If copying fails, destination is removed: a half-written file with time of modification of this moment
+    # would look like a newer version of the file during next sync.
+    with open(source, 'rb') as file_in:
+        file_out = open(destination, 'wb')
+        try:
+            with file_out:
+                fd_in, fd_out = file_in.fileno(), file_out.fileno()
+                size = os.fstat(fd_in).st_size
+
+                if reflink(fd_in, fd_out, size):
+                    backend = 'reflink'
+                elif copy_by_copy_file_range(fd_in, fd_out, size):
+                    backend = 'copy_file_range'
+                elif copy_by_sendfile(fd_in, fd_out, size):
+                    backend = 'sendfile'
+                else:
+                    shutil.copyfileobj(file_in, file_out, CHUNK_SIZE)
+                    backend = 'shutil'
+
+            shutil.copystat(source, destination)
+        except BaseException:
+            os.remove(destination)
+            raise
+    stats.add(backend, size)
+    if backend != 'reflink':  # reflink shares blocks of source and writes nothing
+        metrics.add('bytes_written', size)
+    log_file.debug("'%s' was copied by %s.", destination, backend)
+    return backend
+
+
+def get_temporary_path(destination):
+    # Temporary file lies next to destination, so it can replace destination atomically.
+    # Names starting with '~$' are skipped by scan_folder, so a file left after a crash is never synced.
+    folder, name = os.path.split(destination)
+    return os.path.join(folder, '~$' + name + '.folderSync.tmp')
+
+
+def clone_file(source, destination):
+    # Make destination a reflink of source. Returns False and leaves no destination if file system can't do it.
+    with open(source, 'rb') as file_in, open(destination, 'wb') as file_out:
+        cloned = reflink(file_in.fileno(), file_out.fileno(), 0)
+    if not cloned:
+        os.remove(destination)
+    return cloned
+
+
+def rewrite_blocks(source, old_version, file_to_patch):
+    # Overwrite blocks of file_to_patch (a copy of old_version) that differ from source. Returns bytes written.
+    bytes_written = 0
+    with open(source, 'rb') as file_in, open(old_version, 'rb') as file_old, open(file_to_patch, 'r+b') as file_out:
+        offset = 0
+        while True:
+            new_block = file_in.read(delta_block_size)
+            if not new_block:
+                break
+            if file_old.read(delta_block_size) != new_block:
+                file_out.seek(offset)
+                file_out.write(new_block)
+                bytes_written += len(new_block)
+            offset += len(new_block)
+        file_out.truncate(offset)
+    return bytes_written
+
+
+def get_stash_path(destination, root_folder):
+    # Every update keeps old version in its own subfolder of stash named by time and number of the update,
+    # so a file updated twice (e.g. in watch mode) keeps both old versions. Names of subfolders sort by time,
+    # which evict_stash() relies on.
+    update_folder = '{}_{:06d}'.format(time.strftime('%Y-%m-%d__%Hh%Mm%Ss'), next(stash_counter))
+    return os.path.join(root_folder, scan_folder.SNAPSHOT_FOLDER, STASH_FOLDER, update_folder,
+                        os.path.relpath(destination, root_folder))
+
+
+def install_new_version(temporary_path, destination, root_folder=None):
+    # Rename temporary file over destination. In 'stash' mode old version is hard linked into stash first,
+    # which takes no time and no space on disk, so there is no moment when destination doesn't exist.
+    # In 'trash' mode (only delta_update() and its fallback get here in it) old version is sent to trash first,
+    # the same as old versions of files that are updated by copying.
+    if update_mode == 'trash':
+        metrics.add('send2trash')
+        send2trash.send2trash(destination)
+    elif update_mode == 'stash' and root_folder is not None:
+        stash_path = get_stash_path(destination, root_folder)
+        os.makedirs(os.path.dirname(stash_path), exist_ok=True)
+        try:
+            os.link(destination, stash_path)
+        except OSError:
+            # file system without hard links, old version is moved to stash then
+            log_file.debug("Can't make hard link of '%s', it is moved to stash.", destination)
+            os.replace(destination, stash_path)
+    os.replace(temporary_path, destination)
+
+
+def replace_file(source, destination, root_folder=None):
+    # Copy source next to destination, flush it to disk and rename it over destination,
+    # so destination is either old or new version but never missing or half-written.
+    temporary_path = get_temporary_path(destination)
+    try:
+        copy_file(source, temporary_path)
+        with open(temporary_path, 'rb+') as file_out:
+            os.fsync(file_out.fileno())
+        metrics.add('fsync')
+        install_new_version(temporary_path, destination, root_folder)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def evict_stash(root_folder):
+    # Remove the oldest versions from stash of the folder until it is not larger than stash_limit
+    path_to_stash = os.path.join(root_folder, scan_folder.SNAPSHOT_FOLDER, STASH_FOLDER)
+    if not os.path.isdir(path_to_stash):
+        return
+
+    stashed_files = []  # (name of update, full path, size), names of updates sort by time
+    for update in os.listdir(path_to_stash):
+        for folder, subfolders, files in os.walk(os.path.join(path_to_stash, update)):
+            for name in files:
+                full_path = os.path.join(folder, name)
+                stashed_files.append((update, full_path, os.lstat(full_path).st_size))
+    stashed_files.sort()
+
+    total_size = sum(size for update, full_path, size in stashed_files)
+    evicted = 0
+    evicted_size = 0
+    for update, full_path, size in stashed_files:
+        if total_size <= stash_limit:
+            break
+        os.remove(full_path)
+        total_size -= size
+        evicted += 1
+        evicted_size += size
+
+    # remove folders that became empty, the deepest first
+    for folder, subfolders, files in os.walk(path_to_stash, topdown=False):
+        if folder != path_to_stash and not os.listdir(folder):
+            os.rmdir(folder)
+
+    if evicted:
+        message = '{} old version(s) ({:.2f} MB) were evicted from stash of {}.'.format(
+            evicted, evicted_size / 1024 ** 2, root_folder)
+        print(message)
+        log_file.info(message)
+
+
+def delta_update(source, destination, root_folder=None):
+    # Update destination to be equal to source by rewriting only blocks that differ.
+    # Destination is cloned by reflink to a temporary file, differing blocks of the clone are overwritten,
+    # and then it replaces destination in one rename, so destination is either old or new version
+    # but never half-written. Old version goes to trash or stash as --update-mode says, see install_new_version().
+    # Returns number of bytes written.
+    # Without reflink the clone would cost as much as a full copy, so file is replaced by replace_file() then.
+    temporary_path = get_temporary_path(destination)
+    if not clone_file(destination, temporary_path):
+        replace_file(source, destination, root_folder)
+        return os.path.getsize(destination)
+    try:
+        bytes_written = rewrite_blocks(source, destination, temporary_path)
+        metrics.add('bytes_written', bytes_written)
+        with open(temporary_path, 'rb+') as file_out:
+            os.fsync(file_out.fileno())
+        metrics.add('fsync')
+        shutil.copystat(source, temporary_path)
+        install_new_version(temporary_path, destination, root_folder)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+    size = os.path.getsize(destination)
+    delta_stats.add(size, bytes_written)
+    log_file.debug("'%s' was updated by writing %d of %d bytes.", destination, bytes_written, size)
+    return bytes_written
+
+
+class DeltaStats:
+    # How many bytes delta updates have written compared to size of updated files
+
+    def __init__(self):
+        self.files = 0
+        self.size = 0
+        self.bytes_written = 0
+        self.lock = threading.Lock()
+
+    def add(self, size, bytes_written):
+        with self.lock:
+            self.files += 1
+            self.size += size
+            self.bytes_written += bytes_written
+
+
+delta_stats = DeltaStats()
+
+
+def reset_stats():
+    # Count from zero again, so every sync in watch mode reports its own speed
+    global stats, delta_stats
+    stats = CopyStats()
+    delta_stats = DeltaStats()
+
+
+def copy_files(jobs, source_folder, destination_folder, copy=copy_file):
+    # Copy files in a thread pool.
+    # jobs is a list of (full path of source file, full path of destination file),
+    # all sources are inside source_folder and all destinations are inside destination_folder.
+    # Yields (job, None) for every copied file or (job, exception) if file could not be copied,
+    # in the same order as jobs, so caller can report results while other files are still being copied.
+    # copy is function that copies one file, e.g. delta_update() to update existing files.
+
+    start_time = time.perf_counter()
+    try:
+        yield from _copy_files(jobs, source_folder, destination_folder, copy)
+    finally:
+        with stats.lock:
+            stats.seconds += time.perf_counter() - start_time
+
+
+def _copy_files(jobs, source_folder, destination_folder, copy):
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            try:
+                copy(*job)
+            except OSError as error:
+                yield job, error
+            else:
+                yield job, None
+        return
+
+    read_limit = get_volume_limit(source_folder, 'read')
+    write_limit = get_volume_limit(destination_folder, 'write')
+
+    def copy_job(job):
+        # every thread takes read limit first and write limit second, so they never wait for each other
+        with read_limit, write_limit:
+            copy(*job)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='copy') as executor:
+        futures = [executor.submit(copy_job, job) for job in jobs]
+        for job, future in zip(jobs, futures):
+            try:
+                future.result()
+            except OSError as error:
+                yield job, error
+            else:
+                yield job, None
+
+
+def log_stats():
+    # Show which backends have copied files and how fast
+    total_bytes = sum(stats.bytes.values())
+    if sum(stats.files.values()):
+        backends = ', '.join('{} - {} ({:.2f} MB)'.format(backend, stats.files[backend],
+                                                          stats.bytes[backend] / 1024 ** 2)
+                             for backend in BACKENDS if stats.files[backend])
+        message = 'Files were copied by: {}.'.format(backends)
+        print(message)
+        log_file.info(message)
+
+        message = 'Copying speed: {:.2f} MB/s.'.format(total_bytes / 1024 ** 2 / max(stats.seconds, 1e-6))
+        print(message)
+        log_file.info(message)
+
+    if delta_stats.files:
+        message = ('Delta updates: {} file(s), {:.2f} MB written of {:.2f} MB ({:.1%}).'
+                   .format(delta_stats.files, delta_stats.bytes_written / 1024 ** 2, delta_stats.size / 1024 ** 2,
+                           delta_stats.bytes_written / max(delta_stats.size, 1)))
+        print(message)
+        log_file.info(message)
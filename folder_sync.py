@@ -8,20 +8,34 @@
 # During second and other syncs script can delete files from folder if they were deleted in the other one.
 # It can also detect and manage updated files.
 # For file comparison it uses timestamps, size of file and binary comparison - it depends on a situation.
-# Script also write logs to .\log folder and clear the oldest ones, when size of logs folder is more than 20 Mb.
+# Script also write logs to .\log folder, compresses old ones and clear the oldest ones, when size of logs folder
+# is more than 20 Mb (see --log-max-mb and --log-max-days).
 
 # Written by Aleksandr Mikheev
 # https://github.com/RandyRomero/folderSync
 
-import math
+import argparse
+import atexit
+import compare_files
+import copy_files
+import functools
+import itertools
+import logging
+import metrics
 import os
-import shutil
+import plan_file
+import progress
+import remove_files
+import stat
 import send2trash
-import shelve
+import stream_sync
 import sys
 import time
 import handle_logs
+import scan_folder
+import snapshot_store
 import traceback
+import watch_folders
 
 # files that were not removed last time
 remove_from_a_next_time = []
@@ -30,6 +44,128 @@ remove_from_b_next_time = []
 # set up logging via my module
 log_file, log_console = handle_logs.set_loggers()
 
+# options from command line, main() replaces them with ones given by user
+settings = argparse.Namespace(scan_workers=1, verify_rescan=False, compare_buffer_mb=4, compare_mmap=False,
+                              compare_workers=4, compare_large_workers=4, compare_per_device=4,
+                              compare_max_mb_in_flight=1024, compare_probes=4, copy_workers=4, copy_per_source=4,
+                              copy_per_destination=4,
+                              delta_threshold_mb=0, update_mode='trash', stash_max_mb=1024,
+                              permanent_delete=False, watch=False, watch_debounce=2.0, watch_poll=30.0,
+                              prune_scan=True, trust_folder_mtime=False)
+
+
+def parse_arguments(args=None):
+    # args is list of command line arguments, sys.argv is used if it is None
+    parser = argparse.ArgumentParser(description='Sync all files and folders between two chosen folders.')
+    parser.add_argument('--scan-workers', type=int, default=1, metavar='N',
+                        help='number of threads that list folders while scanning them, '
+                             'more than one helps on network drives (default: 1)')
+    parser.add_argument('--verify-rescan', action='store_true',
+                        help='scan both folders again after syncing and check them against snapshots '
+                             'that program got from performed operations')
+    parser.add_argument('--compare-buffer-mb', type=int, default=4, metavar='MB',
+                        help='size of each of two buffers used for binary comparison of files (default: 4)')
+    parser.add_argument('--compare-mmap', action='store_true',
+                        help='compare large files on local disks through mmap instead of reading them')
+    parser.add_argument('--compare-workers', type=int, default=4, metavar='N',
+                        help='number of threads comparing content of files (default: 4)')
+    parser.add_argument('--compare-large-workers', type=int, default=4, metavar='N',
+                        help='number of threads comparing files of 64 MB or larger, how many of them read at once '
+                             'is limited by --compare-max-mb-in-flight (default: 4)')
+    parser.add_argument('--compare-per-device', type=int, default=4, metavar='N',
+                        help='number of comparisons reading from the same disk at once (default: 4)')
+    parser.add_argument('--compare-max-mb-in-flight', type=int, default=1024, metavar='MB',
+                        help='total size of large files being compared at once (default: 1024)')
+    parser.add_argument('--compare-probes', type=int, default=4, metavar='N',
+                        help='number of blocks between the first and the last one that are compared before '
+                             'reading whole files, 0 compares whole files right away (default: 4)')
+    parser.add_argument('--copy-workers', type=int, default=4, metavar='N',
+                        help='number of threads copying files (default: 4)')
+    parser.add_argument('--copy-per-source', type=int, default=4, metavar='N',
+                        help='number of copies reading from the same volume at once (default: 4)')
+    parser.add_argument('--copy-per-destination', type=int, default=4, metavar='N',
+                        help='number of copies writing to the same volume at once (default: 4)')
+    parser.add_argument('--delta-threshold-mb', type=int, default=0, metavar='MB',
+                        help='update modified files of this size or larger by rewriting only blocks that differ '
+                             'in a reflink copy of old version (btrfs, XFS), 0 turns it off (default: 0)')
+    parser.add_argument('--update-mode', choices=['trash', 'replace', 'stash'], default='trash',
+                        help='trash - send old versions of updated files to trash (default); '
+                             'replace - write new version to a temporary file and rename it over the old one; '
+                             'stash - the same as replace, but keep old versions in .folderSyncSnapshot')
+    parser.add_argument('--stash-max-mb', type=int, default=1024, metavar='MB',
+                        help='maximum size of stash of old versions in every folder, '
+                             'the oldest ones are evicted first (default: 1024)')
+    parser.add_argument('--permanent-delete', action='store_true',
+                        help='remove files and folders permanently instead of sending them to trash, '
+                             'e.g. for backup folders')
+    parser.add_argument('--watch', action='store_true',
+                        help='after syncing keep watching both folders and sync every change without asking')
+    parser.add_argument('--watch-debounce', type=float, default=2.0, metavar='SECONDS',
+                        help='sync changes when folders have been quiet for this long (default: 2)')
+    parser.add_argument('--watch-poll', type=float, default=30.0, metavar='SECONDS',
+                        help='how often folders are rescanned where inotify is not available (default: 30)')
+    parser.add_argument('--no-prune-scan', dest='prune_scan', action='store_false',
+                        help='list every folder, even if its time of modification is the same as at last sync; '
+                             'for file systems that do not update time of modification of folders')
+    parser.add_argument('--trust-folder-mtime', action='store_true',
+                        help='do not stat files in folders that have not changed since last sync, '
+                             'which misses files modified in place without changing their folder')
+    parser.add_argument('--log-max-mb', type=int, default=20, metavar='MB',
+                        help='remove the oldest logs when log folder is larger than this (default: 20)')
+    parser.add_argument('--log-max-days', type=int, default=0, metavar='DAYS',
+                        help='remove logs older than this many days (default: 0, keep logs of any age)')
+    parser.add_argument('--trace', action='store_true',
+                        help='besides metrics of the run, write its phases to log folder in Chrome trace format')
+    parser.add_argument('--verbose', action='store_true',
+                        help='print and log a line about every file instead of one line of progress')
+    parser.add_argument('--stream', action='store_true',
+                        help='scan, compare and sync folders in one pass without asking, which keeps memory '
+                             'bounded on huge folders')
+    parser.add_argument('--on-removed', choices=['remove', 'restore', 'skip'], default='remove',
+                        help='in --stream mode, what to do with items removed from one folder since last sync: '
+                             'remove them from the other folder too, copy them back or leave them (default: remove)')
+    parser.add_argument('--plan', metavar='FILE',
+                        help='compare folders without asking anything and write what should be done to FILE '
+                             '(JSON lines, compressed if FILE ends with .gz) instead of syncing them')
+    parser.add_argument('--apply', metavar='FILE',
+                        help='sync folders as plan made with --plan says without scanning them again; operations '
+                             'on files that have changed since plan was made are skipped')
+    parser.add_argument('folders', nargs='*', metavar='FOLDER',
+                        help='two folders to sync, program asks for them if they are not given')
+    arguments = parser.parse_args(args)
+    if arguments.stream and arguments.watch:
+        parser.error('--stream can not be used with --watch')
+    if (arguments.plan or arguments.apply) and (arguments.stream or arguments.watch):
+        parser.error('--plan and --apply can not be used with --stream or --watch')
+    if arguments.plan and arguments.apply:
+        parser.error('--plan can not be used with --apply')
+    if arguments.apply and arguments.folders:
+        parser.error('folders are taken from plan with --apply')
+    if len(arguments.folders) not in (0, 2):
+        parser.error('give both folders to sync or none of them')
+    for folder in arguments.folders:
+        if not os.path.isdir(folder):
+            parser.error("'{}' is not a folder".format(folder))
+    if arguments.folders and os.path.abspath(arguments.folders[0]) == os.path.abspath(arguments.folders[1]):
+        parser.error("paths can't be equal")
+    if arguments.watch_debounce < 0 or arguments.watch_poll <= 0:
+        parser.error('--watch-debounce should not be negative and --watch-poll should be positive')
+    if arguments.stash_max_mb < 0:
+        parser.error('--stash-max-mb should not be negative')
+    if arguments.delta_threshold_mb < 0:
+        parser.error('--delta-threshold-mb should not be negative')
+    if min(arguments.copy_workers, arguments.copy_per_source, arguments.copy_per_destination) < 1:
+        parser.error('--copy-workers, --copy-per-source and --copy-per-destination should be at least 1')
+    if min(arguments.compare_workers, arguments.compare_large_workers, arguments.compare_per_device,
+           arguments.compare_max_mb_in_flight) < 1:
+        parser.error('--compare-workers, --compare-large-workers, --compare-per-device and '
+                     '--compare-max-mb-in-flight should be at least 1')
+    if arguments.scan_workers < 1:
+        parser.error('--scan-workers should be at least 1')
+    if arguments.compare_buffer_mb < 1:
+        parser.error('--compare-buffer-mb should be at least 1')
+    return arguments
+
 
 def choose_folder():  # used to check validity of file's path given by user
 
@@ -72,12 +208,16 @@ def menu_choose_folders():  # let a user choose folders and assure they do not h
     return first_folder, second_folder
 
 
-def get_snapshot(path_to_root_folder, root_folder):
+def get_snapshot(path_to_root_folder, root_folder, previous=None):
     # Get all paths of every file and folder,
     # and collect file size and file time of modification.
-    # Returns all paths with information as a single snapshot-dictionary.
+    # previous is scan_folder.PreviousScan if folders that have not changed since last sync should not be listed.
+    # Returns all items as a single snapshot-dictionary {path without root folder: SnapshotItem}.
 
     start_time = time.time()
+    # stored with snapshot, so next scan knows which folders have not changed since this one
+    scan_info[path_to_root_folder] = {'root_mtime_ns': os.stat(path_to_root_folder).st_mtime_ns,
+                                      'scan_time_ns': time.time_ns()}
 
     log_file.info('Getting snapshot of %s...', path_to_root_folder)
 
@@ -85,164 +225,371 @@ def get_snapshot(path_to_root_folder, root_folder):
     files_number = 0  # total number of files in given folder
     total_size = 0  # total size of all files in given folder
 
-    current_snapshot = {}  # dictionary for all paths to files and folders
-
-    # subtract path to root folder from full path in order to get path to folder/file without root folder
-    # this is necessary to compare files from different folders
-    def get_path_without_root_folder(entire_path, path_to_root):
-        if 'win' in sys.platform.lower():
-            return entire_path.split(path_to_root + '\\')[1]
-        else:
-            return entire_path.split(path_to_root + '/')[1]
-
-    for root, folders, files in os.walk(path_to_root_folder):  # recursively get paths of all files and folders
-        # only add to list folders that not '.folderSyncSnapshot' and files that don't start with '~$'
-        folders[:] = [x for x in folders if not x == '.folderSyncSnapshot']
-        files = [x for x in files if not x.startswith('~$')]
-
-        for folder in folders:
-            full_path = os.path.join(root, folder)
-            path_wout_root = get_path_without_root_folder(full_path, path_to_root_folder)
-            path_with_root = os.path.join(root_folder, path_wout_root)
-            all_paths = [full_path, root_folder, path_with_root, path_wout_root]
-            current_snapshot[path_with_root] = ['folder', all_paths]
-            folders_number += 1
-
-        for file in files:
-            full_path = os.path.join(root, file)
-            path_wout_root = get_path_without_root_folder(full_path, path_to_root_folder)
-            path_with_root = os.path.join(root_folder, path_wout_root)
-            all_paths = [full_path, root_folder, path_with_root, path_wout_root]
-
-            size_of_current_file = os.path.getsize(all_paths[0])
-            total_size += size_of_current_file
-            current_snapshot[path_with_root] = ['file', all_paths, size_of_current_file,
-                                                math.ceil(os.path.getmtime(all_paths[0]))]
-            # math.ceil for rounding float because otherwise it is to precise for our purpose
-            files_number += 1
+    # dictionary for all files and folders, keys are paths without root folder,
+    # which is necessary to compare files from different folders
+    current_snapshot = {}
+    root = scan_folder.FolderRoot(path_to_root_folder, root_folder)  # shared by all items of the snapshot
+
+    with metrics.phase('scan', folder=path_to_root_folder):
+        scanned_items = scan_folder.scan_folder(path_to_root_folder, settings.scan_workers, previous=previous)
+        for item_type, path_wout_root, size, mtime_ns, inode in scanned_items:
+            current_snapshot[path_wout_root] = scan_folder.SnapshotItem(item_type, path_wout_root, size, mtime_ns,
+                                                                        inode, root)
+            if item_type == 'folder':
+                folders_number += 1
+            else:
+                total_size += size
+                files_number += 1
 
     log_file.info("There are %d folders and %d files in '%s'.", folders_number, files_number, path_to_root_folder)
     log_file.info("Total size of %s is %.2f MB.", path_to_root_folder, total_size / 1024 ** 2)
-    log_file.info('--- %.3f seconds ---\n', time.time() - start_time)
+    scan_time = time.time() - start_time
+    log_file.info('Scanned %d entries at %.0f entries/second with %d worker(s).', folders_number + files_number,
+                  (folders_number + files_number) / max(scan_time, 1e-6), settings.scan_workers)
+    if previous is not None:
+        message = ("{} folder(s) of '{}' have not changed since last sync and were not listed, {} were listed."
+                   .format(previous.pruned, path_to_root_folder, previous.listed))
+        print(message)
+        log_file.info(message)
+    log_file.info('--- %.3f seconds ---\n', scan_time)
 
     return current_snapshot
 
 
+class ChangeSet:
+    # Changes of one folder since its last sync: sets of paths without root folder
+    # of items that were removed, added and modified, plus current snapshot of the folder.
+    # Previous snapshot is read as a stream of items ordered by path and joined with sorted paths
+    # of current snapshot, so it never has to be loaded into memory and it takes linear time to find all changes.
+
+    def __init__(self, current_snapshot, previous_items, were_not_removed_last_time, store_date):
+        self.current_snapshot = current_snapshot
+        self.store_date = store_date  # date when previous snapshot has been stored
+        # files that were not removed last time are treated as removed since last sync in order
+        # to remove them this time
+        self.removed = set(were_not_removed_last_time)
+        self.new = set()
+        self.modified = set()
+        self.listed_folders = 0  # folders that scan listed, because their times differ from stored snapshot
+
+        current_paths = iter(sorted(current_snapshot))
+        current_path = next(current_paths, None)
+        for previous_item in previous_items:
+            path = previous_item.path_wout_root
+            while current_path is not None and current_path < path:
+                self.new.add(current_path)  # there is no such item in previous snapshot
+                current_path = next(current_paths, None)
+
+            if current_path != path:  # item from previous snapshot is not in current snapshot
+                self.removed.add(path)
+                continue
+
+            current_item = current_snapshot[path]
+            if current_item.type == 'file' and current_item.mtime != previous_item.mtime:
+                self.modified.add(path)
+            current_path = next(current_paths, None)
+
+        while current_path is not None:
+            self.new.add(current_path)
+            current_path = next(current_paths, None)
+        self.new -= self.removed
+
+
+# ChangeSet of every folder that has been already scanned during this run, keys are paths to folders
+change_sets = {}
+# time of modification of root folder and time of the last scan of every scanned folder, keys are paths to folders
+scan_info = {}
+
+
 def get_changes_between_folder_states(path_to_folder, root_of_path):
     # Compare folder's snapshot that was stored in .folderSyncSnapshot
     # folder during last syncing with fresh snapshot that is going to be taken within this function.
     # This is necessary to figure out which files were removed in order not to
     # acquire it from not yet updated folder again.
+    # Returns ChangeSet or None if stored snapshot can't be loaded. Folder is scanned only once per run,
+    # every next call returns the same ChangeSet.
+
+    if path_to_folder in change_sets:
+        return change_sets[path_to_folder]
+    change_sets[path_to_folder] = None
 
     try:
-        shel_file = shelve.open(os.path.join(path_to_folder, '.folderSyncSnapshot', 'snapshot'))
-    except:
+        store = snapshot_store.open_store(path_to_folder, root_of_path)
+    except Exception:
         print("Can't open stored snapshot. Exit.")
         log_file.error(traceback.format_exc())
-        return -1
+        return None
 
-    current_folder_snapshot = get_snapshot(path_to_folder, root_of_path)  # make currant snapshot of the given folder
-    try:
-        previous_snapshot = shel_file['snapshot']  # load previous snapshot
-    except KeyError:
-        message = ('Error: Unfortunately, database with previous state of folder is corrupted.\n' 
-                   'Program will assume that folder has never been synchronized before.')
-        print(message)
-        log_file.error(message)
-        log_file.error(traceback.format_exc())
-        return -1
+    with store:
+        store_date = store.get_info('date')  # load date when previous snapshot has been done
+        if store_date is None:
+            message = ('Error: Unfortunately, database with previous state of folder is corrupted.\n'
+                       'Program will assume that folder has never been synchronized before.')
+            print(message)
+            log_file.error(message)
+            return None
+
+        were_not_removed_last_time = store.not_removed_paths()
+        if len(were_not_removed_last_time) > 0:
+            message = 'There are {} file(s) that were not removed last time'.format(len(were_not_removed_last_time))
+            print(message)
+            log_file.info(message)
 
-    store_date = shel_file['date']  # load date when previous snapshot has been done
+        # folders that have not changed since last sync are not listed again
+        previous = None
+        root_mtime_ns = store.get_info('root_mtime_ns')
+        scan_time_ns = store.get_info('scan_time_ns')
+        if settings.prune_scan and root_mtime_ns is not None and scan_time_ns is not None:
+            previous = scan_folder.PreviousScan(store, int(root_mtime_ns), int(scan_time_ns),
+                                                settings.trust_folder_mtime)
+
+        current_folder_snapshot = get_snapshot(path_to_folder, root_of_path, previous)  # make current snapshot
+        with metrics.phase('detect_changes', folder=path_to_folder):
+            changes = ChangeSet(current_folder_snapshot, store.iter_items(), were_not_removed_last_time, store_date)
+        if previous is not None:
+            changes.listed_folders = previous.listed
+
+    for path in sorted(changes.removed):
+        log_file.info('%s WAS REMOVED', path)
+    for path in sorted(changes.modified):
+        log_file.info('Modification time of %s has changed.', current_folder_snapshot[path].full_path)
+    for path in sorted(changes.new):
+        log_file.info('%s IS NEW ITEM', path)
 
-    if shel_file['to_remove_from_a'][0] == root_of_path:
-        # Figure out which list of files that were not removed last time
-        # program should load this time due to folder name.
-        were_not_removed_last_time = shel_file['to_remove_from_a']
+    log_file.info('\n%s', path_to_folder)
+    log_file.info('%d items were removed', len(changes.removed))
+    log_file.info('There are %d new items', len(changes.new))
+    log_file.info('\n')
+
+    change_sets[path_to_folder] = changes
+    return changes
+
+
+class SyncPlan:
+    # Result of comparison of two snapshots - everything that should be done to make folders equal.
+    # Lists of items to copy and to remove contain SnapshotItem objects, lists of items to update
+    # contain lists [full path of newer file, full path of file to be replaced, size of newer file].
+
+    def __init__(self):
+        self.copy_from_a_to_b = []  # Items that exist in 1st folder but do not exist in 2nd folder
+        self.copy_from_b_to_a = []  # Vice versa
+        self.update_from_a_to_b = []  # Files in 2nd folder that will be replaced by their newer versions from 1st
+        self.update_from_b_to_a = []  # Vice versa
+        self.remove_from_a = []  # Items to remove from 1st folder
+        self.remove_from_b = []  # Items to remove from 2nd folder
+        self.skipped = []  # Paths of files to skip (e.g. because both were changed since last sync)
+        self.not_updated_in_a = []  # Paths of files in 1st folder that sync_files() could not update
+        self.not_updated_in_b = []  # Ditto for 2nd folder
+        self.equal = []  # Files from both folders that are exact duplicates
+        self.common = []  # Files that exist in both folders with the same path and name
+        self.num_identical_files = 0  # Files inside identical folders, they are common and equal but not listed
+        self.num_files_in_a = 0
+        self.num_files_in_b = 0
+        self.num_folders_in_a = 0
+        self.num_folders_in_b = 0
+        self.size_of_items_in_a = 0  # Total size of all files in 1st folder
+        self.size_of_items_in_b = 0  # Ditto for 2nd folder
+        self.size_copy_from_a_to_b = 0
+        self.size_copy_from_b_to_a = 0
+        self.size_update_from_a_to_b = 0
+        self.size_update_from_b_to_a = 0
+        self.snap_a = {}  # Snapshots of both folders the plan was made from
+        self.snap_b = {}
+
+
+def diff_snapshots(snap_a, snap_b, first_folder, second_folder, both_synced, were_removed_from_a=(),
+                   were_removed_from_b=(), updated_items_a=(), updated_items_b=(), trees=None):
+    # Join two snapshots by path without root folder and decide what to do with every item.
+    # Snapshots are dictionaries with these paths as keys and collections of changes since last sync
+    # are turned into sets, so every lookup takes constant time and comparison is linear in number of items.
+    # trees are scan_folder.FolderTree of both snapshots: if they are given, snapshots are walked folder by folder
+    # and content of folders whose digests are equal in both of them is counted as equal without looking inside.
+    # Returns SyncPlan.
+
+    plan = SyncPlan()
+    plan.snap_a = snap_a
+    plan.snap_b = snap_b
+    were_removed_from_a = set(were_removed_from_a)
+    were_removed_from_b = set(were_removed_from_b)
+    updated_items_a = set(updated_items_a)
+    updated_items_b = set(updated_items_b)
+
+    # Check if the same files were changed in both folder (which means, if true, script can't
+    # decide automatically which one to remove and which one to update).
+    both_updated = updated_items_a & updated_items_b if both_synced else set()
+
+    to_compare_binary = []  # pairs of files with the same path but different time of modification
+
+    def files_are_equal(item):
+        progress.detail('= Files are equal.')
+        plan.equal.append(item)
+
+    print()  # this print() is needed to make offset
+
+    if trees is not None:
+        tree_a, tree_b = trees
+        identical_folders = tree_a.identical_folders(tree_b)
+        items_a = tree_a.walk(skip=identical_folders)
+        items_b = tree_b.walk(skip=identical_folders)
     else:
-        if shel_file['to_remove_from_b'][0] == root_of_path:
-            were_not_removed_last_time = shel_file['to_remove_from_b']
+        identical_folders = set()
+        items_a = snap_a.values()
+        items_b = snap_b.values()
+
+    # Lines about every file are shown only in verbose mode, otherwise there is one line of progress
+    bar = progress.Progress("Comparing items of '{}'".format(first_folder), total=len(snap_a))
+
+    # Compare 1st folder to 2nd folder
+    for item_a in items_a:
+        path = item_a.path_wout_root
+        bar.update()
+        if item_a.type == 'file':
+            # count number and size of files in 1st folder
+            plan.num_files_in_a += 1
+            plan.size_of_items_in_a += item_a.size
+            progress.detail('Comparing files {}'.format(path))
         else:
-            log_console.error('ERROR: Can not load list of files that program could not remove last time.')
-            log_file.error('ERROR: Can not load list of files that program could not remove last time')
-            sys.exit()
-
-    items_with_changed_mtime = []  # List of files that have been modified since last sync.
-    items_from_prev_snapshot = []
-    items_from_current_snapshot = []
-    items_were_removed = []  # files and folders that were removed since last sync
-    new_items = []  # files and folder that were added since last sync
-
-    if len(were_not_removed_last_time) > 1:
-        message = 'There are {} file(s) that were not removed last time'.format(len(were_not_removed_last_time) - 1)
-        print(message)
-        log_file.info(message)
+            # count number of subfolders in the 1st folder
+            plan.num_folders_in_a += 1
+            if path in identical_folders:
+                # the same items are in the same places inside it in both folders, nothing to do with them
+                files, folders, size = tree_a.totals[path]
+                bar.update(files + folders)
+                plan.num_files_in_a += files
+                plan.num_folders_in_a += folders
+                plan.size_of_items_in_a += size
+                plan.num_identical_files += files
+
+        item_b = snap_b.get(path)
 
-        # add files that were not removed last time to the list of files that were removed since last sync in order
-        # to remove them this time
-        for i in range(1, len(were_not_removed_last_time)):
-            items_were_removed.append(were_not_removed_last_time[i][1][3])
-
-    # make a list of paths of current files/folders in order to check them against previous list
-    for key in current_folder_snapshot.keys():
-        items_from_current_snapshot.append(key)
-
-    for key in previous_snapshot.keys():  # get list of paths of files from previous folder snapshot
-        items_from_prev_snapshot.append(key)
-
-        # if item from previous snapshot not in current snapshot
-        if key not in items_from_current_snapshot:
-            log_file.info('%s WAS REMOVED', key)
-            # add path without root folder to list because we should compare them later
-            # against path with another root folder
-            items_were_removed.append(previous_snapshot[key][1][3])
+        # if item with same path exists in both folders to be synced
+        if item_b is not None:
+            # if item is file - compare them
+            if item_a.type != 'file':
+                continue
+            plan.common.append(item_a)
+
+            # check if both files have the same modification time that they have before
+            if both_synced and path not in updated_items_a and path not in updated_items_b:
+                files_are_equal(item_a)
+                continue
+
+            # do not update file if it has been updated in both folders since last sync
+            if path in both_updated:
+                message = path + ' has changed in both folders, so you need to choose ' \
+                                 'right version manually. Program will not manage it.'
+                progress.echo(message)
+                log_file.warning(message)
+                plan.skipped.append(path)
+
+            # files have different time of modification -> check if files have indeed different content.
+            # Binary comparison is slow, so pairs are collected here and compared all together later.
+            elif item_a.mtime != item_b.mtime:
+                to_compare_binary.append((item_a, item_b))
+
+            elif item_a.size == item_b.size:
+                files_are_equal(item_a)
+
+            # If modification time is equal, bit size is not
+            # then add it to list to tell to user to check manually.
+            else:
+                message = "! {} has the same time of modification but different size, you should check it " \
+                          "manually.".format(path)
+                progress.echo(message)
+                log_file.warning(message)
+                plan.skipped.append(path)
+
+        # if item was removed from 2nd folder then add it to list of items which will be removed from 1st folder
+        elif path in were_removed_from_b:
+            plan.remove_from_a.append(item_a)
+            if item_a.type == 'file':
+                progress.detail("- Will be removed from {}".format(first_folder))
+
+        else:  # if file doesn't exist in 2nd folder -> add it in list to be copied from 1st folder
+            plan.copy_from_a_to_b.append(item_a)
+            if item_a.type == 'file':
+                progress.detail("-> Doesn\'t exist in '{}' and will be copied there.".format(second_folder))
+                plan.size_copy_from_a_to_b += item_a.size
+
+    # Compare content of files which time of modification differs. Pairs are compared in a thread pool,
+    # and verdicts are handled in the same order the pairs were found.
+    bar.close()
+    if to_compare_binary:
+        print('\nComparing content of {} pair(s) of files...'.format(len(to_compare_binary)))
+        log_file.info('Comparing content of %d pair(s) of files...', len(to_compare_binary))
+        with progress.Progress('Comparing content', total=len(to_compare_binary)) as content_bar, \
+                metrics.phase('compare_binary', pairs=len(to_compare_binary)):
+            verdicts = compare_files.compare_pairs(
+                to_compare_binary, on_compared=lambda item_a, item_b: content_bar.update(size=item_a.size))
+    else:
+        verdicts = []
+
+    for (item_a, item_b), equal in zip(to_compare_binary, verdicts):
+        progress.detail('Content of {}:'.format(item_a.path_wout_root))
+
+        # if content of files the same - time doesn't matter. Files are equal.
+        if equal:
+            files_are_equal(item_a)
+
+        # file in A newer than file in 2nd folder -> add them to list to be copied from 1st to 2nd folder
+        elif item_a.mtime > item_b.mtime:
+            progress.detail("-> File in '{}' is newer".format(first_folder))
+            plan.update_from_a_to_b.append([item_a.full_path, item_b.full_path, item_a.size])
+            plan.size_update_from_a_to_b += item_a.size
+
+        # file in A older than file in B -> add it to list to be copied from B to A
         else:
-            # check whether file has been modified since last time or not
-            if current_folder_snapshot[key][0] == 'file':
-                if current_folder_snapshot[key][3] != previous_snapshot[key][3]:
-                    items_with_changed_mtime.append(current_folder_snapshot[key][1][3])
-                    log_file.info('Modification time of %s has changed.', current_folder_snapshot[key][1][0])
-
-    # check whether some new files have been added since last time
-    for path in items_from_current_snapshot:
-        if path not in items_from_prev_snapshot and path not in items_were_removed:
-            log_file.info('%s IS NEW ITEM', path)
-            new_items.append(path)
+            progress.detail("<- File in '{}' is newer".format(second_folder))
+            plan.update_from_b_to_a.append([item_b.full_path, item_a.full_path, item_b.size])
+            plan.size_update_from_b_to_a += item_b.size
+
+    bar = progress.Progress("Comparing items of '{}'".format(second_folder), total=len(snap_b))
+    for item_b in items_b:  # check which files from B exist in A
+        path = item_b.path_wout_root
+        bar.update()
+        if item_b.type == 'file':
+            # count number and size of files in the second folder
+            plan.num_files_in_b += 1
+            plan.size_of_items_in_b += item_b.size
+        else:  # count number of folder in the second folder
+            plan.num_folders_in_b += 1
+            if path in identical_folders:
+                files, folders, size = tree_b.totals[path]
+                bar.update(files + folders)
+                plan.num_files_in_b += files
+                plan.num_folders_in_b += folders
+                plan.size_of_items_in_b += size
+
+        # items that exist in both folders have been compared already
+        if path in snap_a:
+            continue
 
-    log_file.info('\n%s', path_to_folder)
-    log_file.info('%d items were removed', len(items_were_removed))
-    log_file.info('There are %d new items', len(new_items))
-    log_file.info('\n')
+        progress.detail("Comparing files... '{}'".format(path))
 
-    return items_were_removed, new_items, items_with_changed_mtime, current_folder_snapshot, store_date
+        # if item was removed from 1st folder - add it to list of items
+        # which will be removed from 2nd folder
+        if path in were_removed_from_a:
+            progress.detail("- Will be removed from {}".format(second_folder))
+            plan.remove_from_b.append(item_b)
+
+        else:  # if file doesn't exists in 1st folder -> add it in list to be copied from 2nd folder
+            progress.detail("<- Doesn't exist in '{}' and will be copied there.".format(first_folder))
+            plan.copy_from_b_to_a.append(item_b)
+            if item_b.type == 'file':
+                plan.size_copy_from_b_to_a += item_b.size
+
+    bar.close()
+    return plan
 
 
 def compare_snapshot(first_folder, second_folder, root_first_folder, root_second_folder, both_synced,
-                     first_folder_synced, second_folder_synced):
+                     first_folder_synced, second_folder_synced, ask_user=True):
+    # ask_user is False when plan is written to file with --plan: lists are not shown and user can't change them
 
     start_time = time.time()  # to measure how long it's gonna take to compare snapshots
-    equal_files = []  # Files from both folders to compare that are exact duplicate
-    num_files_in_a = 0  # List of files of folder that user chose first
-    num_files_in_b = 0  # List of files of folder that user chose second
-    num_folders_in_a = 0  # Number of folders in the 1st folder
-    num_folders_in_b = 0  # Number of folder in the 2nd folder
-    must_remove_from_a = []  # Items to remove from 1st folder
-    must_remove_from_b = []  # Items to remove from 2nd folder
-    not_exist_in_a = []  # File that exist in 2nd folder but do not exist in 1st folder
-    not_exist_in_b = []  # Vice versa
-    paths_of_snap_a = []  # List of paths of items from 1st folder
-    paths_of_snap_b = []  # Ditto for 2nd folder
-    same_path_and_name = []  # List of items that exist in both folders that user chose
-    size_copy_from_a_to_b = 0  # Size of files that need to be copied from 1st folder to 2nd
-    size_copy_from_b_to_a = 0  # Ditto for 2nd folder
-    size_update_from_a_to_b = 0  # Size of files that need to be updated from 1st folder to 2nd
-    size_update_from_b_to_a = 0  # Ditto for 2nd folder
-    size_of_items_in_a = 0  # Total of all files in 1st folder
-    size_of_items_in_b = 0  # Ditto for 2nd folder
-    skipped_files = []  # Files to skip (because both were changed since last sync)
+    compare_files.reset_stats()
     store_date_a = 0  # Time when snapshot of 1st folder was saved to storage
     store_date_b = 0  # Ditto for 2nd folder
-    to_be_updated_from_a_to_b = []  # Files in 1st folder that will be replaced by their newer versions from 2nd folder
-    to_be_updated_from_b_to_a = []  # Vice versa
     updated_items_a = []  # Files from 1st folder that have been changed since last sync
     updated_items_b = []  # Ditto for 2nd folder
     were_removed_from_a = []  # File that were removed from 1st folder since last sync
@@ -259,19 +606,19 @@ def compare_snapshot(first_folder, second_folder, root_first_folder, root_second
         def get_size_of_files_to_remove(files_to_delete):
             total_size = 0
             for item in files_to_delete:
-                total_size += item[2]
+                total_size += item.size
             return total_size
 
         def get_size_files_to_transfer(files_to_copy, files_to_update):
             total_size = 0
             # Loop two lists at once to get size of all files to be copied or updated
             for item_a in files_to_copy:
-                if item_a[0] == 'file':
-                    total_size += item_a[2]
+                if item_a.type == 'file':
+                    total_size += item_a.size
 
+            # files to update are lists [full path of source, full path of destination, size]
             for item_b in files_to_update:
-                if item_b[0] == 'file':
-                    total_size += item_b[2]
+                total_size += item_b[2]
 
             return total_size
 
@@ -373,7 +720,10 @@ def compare_snapshot(first_folder, second_folder, root_first_folder, root_second
             log_file.info('%s\n', question)
             if see_list.lower() == 'y':
                 for item in list_of_files:
-                    print(item[1][0])
+                    if isinstance(item, list):  # file to update: [full path of newer file, full path of old one, size]
+                        print(item[1])
+                    else:
+                        print(item.full_path)
                 break
             elif see_list.lower() == 'n':
                 break
@@ -422,196 +772,59 @@ def compare_snapshot(first_folder, second_folder, root_first_folder, root_second
         #     print(message1)
         #     logFile.info(message1)
 
-    def compare_files_mtime(file_from_a, file_from_b):
-        # Compare time when files were changed last time
-        nonlocal both_updated
-        nonlocal skipped_files
-
-        # do not update file if it has been updated in both folders since last sync
-        if both_synced and len(both_updated) > 0 and file_from_a[1][3] in both_updated:
-            message2 = file_from_a[1][3] + ' has changed in both folders, so you need to choose ' \
-                                          'right version manually. Program will not manage it.'
-            print(message2)
-            log_file.warning(message2)
-            skipped_files.append(file_from_a[1][3])
-
-        else:
-            if file_from_a[3] > file_from_b[3]:
-                return 'firstNewer'
-            elif file_from_a[3] < file_from_b[3]:
-                return 'secondNewer'
-            else:
-                return 'equal'
-
-    def compare_binary(file_from_a, file_from_b):
-        # Compare files in binary mode with buffer
-        if file_from_a[2] > 1024 ** 3:
-            print('It\'s gonna take some time, be patient.')
-        with open(file_from_a[1][0], 'rb') as f1, open(file_from_b[1][0], 'rb') as f2:
-            while True:
-                b1 = f1.read(8192)
-                b2 = f2.read(8192)
-                if b1 != b2:
-                    # content is not equal
-                    return False
-                if not b1:
-                    # content is equal
-                    return True
+    changes_a = None  # changes of 1st folder since last sync if it has been synced before
+    changes_b = None  # Ditto for 2nd folder
 
-    if first_folder_synced and get_changes_between_folder_states(first_folder, root_first_folder) != -1:
+    if first_folder_synced:
         # If 1st folder have been synced before, compare it's current and previous snapshot and get changes
-        were_removed_from_a, new_in_a, updated_items_a, snap_a, store_date_a = \
-            get_changes_between_folder_states(first_folder, root_first_folder)
+        changes_a = get_changes_between_folder_states(first_folder, root_first_folder)
+    if changes_a is not None:
+        were_removed_from_a, updated_items_a, snap_a, store_date_a = \
+            changes_a.removed, changes_a.modified, changes_a.current_snapshot, changes_a.store_date
     else:
         # Load current state of folder (path to every ite inside with size and modification time)
         snap_a = get_snapshot(first_folder, root_first_folder)
 
-    if second_folder_synced and get_changes_between_folder_states(second_folder, root_second_folder) != -1:
-        were_removed_from_b, new_in_b, updated_items_b, snap_b, store_date_b = \
-            get_changes_between_folder_states(second_folder, root_second_folder)
+    if second_folder_synced:
+        changes_b = get_changes_between_folder_states(second_folder, root_second_folder)
+    if changes_b is not None:
+        were_removed_from_b, updated_items_b, snap_b, store_date_b = \
+            changes_b.removed, changes_b.modified, changes_b.current_snapshot, changes_b.store_date
     else:
         snap_b = get_snapshot(second_folder, root_second_folder)
 
-    # Check if the same files were changed in both folder (which means, if true, script can't
-    # decide automatically which one to remove and which one to update).
-    if both_synced:
-        both_updated = [item for item in updated_items_a if item in updated_items_b]
-
-    # Create list of paths to items from 2nd folder's snapshot.
-    # Path like this '\somefolder\somefile.ext' - to be able to compare them to each other
-    for key in snap_b.keys():
-        paths_of_snap_b.append(snap_b[key][1][3])
-
-    print()  # this print() is needed to make offset
-
-    # Compare 1st folder to 2nd folder
-    for key in snap_a.keys():
-        # Create list of paths to items from 2nd folder's snapshot.
-        path_to_file_in_a_without_root = snap_a[key][1][3]
-        paths_of_snap_a.append(path_to_file_in_a_without_root)
+    # folders with equal digests are equal with everything inside, so diff doesn't need to look into them
+    with metrics.phase('digests'):
+        tree_a = scan_folder.FolderTree(snap_a)
+        tree_b = scan_folder.FolderTree(snap_b)
 
-        if snap_a[key][0] == 'file':
-            # count number and size of files in 1st folder
-            num_files_in_a += 1
-            size_of_items_in_a += snap_a[key][2]
-            message1 = ('Comparing files {}'.format(path_to_file_in_a_without_root))
-            print(message1)
-            log_file.info(message1)
-        else:
-            # count number of subfolders in the 1st folder
-            num_folders_in_a += 1
-
-        # if item with same path exists in both folders to be synced
-        if path_to_file_in_a_without_root in paths_of_snap_b:
-            # if item is file - compare them
-            if snap_a[key][0] == 'file':
-                same_path_and_name.append(snap_a[key])
-                # merge root of 2nd folder with path of file/folder from 1st folder
-                # to get a probability to compare files
-                corresponding_file_in_b = os.path.join(root_second_folder, path_to_file_in_a_without_root)
-
-                # check if both files have the same modification time that they have before
-                if both_synced:
-                    if path_to_file_in_a_without_root not in updated_items_a \
-                            and path_to_file_in_a_without_root not in updated_items_b:
-                        print('= Files are equal.')
-                        log_file.info('= Files are equal.')
-                        equal_files.append(snap_a[key])
-                        continue
-
-                which_file_is_newer = compare_files_mtime(snap_a[key], snap_b[corresponding_file_in_b])
-                # file in A newer than file in 2nd folder -> check if files have indeed different content
-                if which_file_is_newer == 'firstNewer':
-                    # if content of files the same - time doesn't matter. Files are equal.
-                    if compare_binary(snap_a[key], snap_b[corresponding_file_in_b]):
-                        print('= Files are equal.')
-                        log_file.info('= Files are equal.')
-                        equal_files.append(snap_a[key])
-                    # files have different content - add them to list to be copied from 1st to 2nd folder
-                    else:
-                        message1 = "-> File in '{}' is newer".format(first_folder)
-                        print(message1)
-                        log_file.info(message1)
-                        # add to list another list with full paths of both files and size of file to be copied
-                        to_be_updated_from_a_to_b.append([snap_a[key][1][0], snap_b[corresponding_file_in_b][1][0],
-                                                          snap_a[key][2]])
-                        size_update_from_a_to_b += snap_a[key][2]
-                elif which_file_is_newer == 'secondNewer':
-                    # if content of files the same - time doesn't matter. Files are equal.
-                    if compare_binary(snap_a[key], snap_b[corresponding_file_in_b]):
-                        print('= Files are equal.')
-                        log_file.info('= Files are equal.')
-                        equal_files.append(snap_a[key])
-
-                    # file in A older than file in B -> add it to list to be copied from B to A
-                    else:
-                        message1 = "<- File in '{}' is newer".format(second_folder)
-                        print(message1)
-                        log_file.info(message1)
-                        # add to list another list with full paths of both files and size of file in B
-                        to_be_updated_from_b_to_a.append([snap_b[corresponding_file_in_b][1][0], snap_a[key][1][0],
-                                                          snap_b[corresponding_file_in_b][2]])
-                        size_update_from_b_to_a += snap_b[corresponding_file_in_b][2]
-                elif which_file_is_newer == 'equal':
-                    if snap_a[key][2] == snap_b[corresponding_file_in_b][2]:
-                        print('= Files are equal.')
-                        log_file.info('= Files are equal.')
-                        equal_files.append(snap_a[key])
-
-                    # If modification time is equal, bit size is not
-                    # then add it to list to tell to user to check manually.
-                    else:
-                        print("! You should check it manually.")
-                        log_file.info("! You should check it manually.")
-                        skipped_files.append(path_to_file_in_a_without_root)
-
-        else:  # if file from first folder has not been found in the second folder
-            # if item was removed from 2nd folder then add it to list of items which will be removed from 1st folder
-            if path_to_file_in_a_without_root in were_removed_from_b:
-                must_remove_from_a.append(snap_a[key])
-                if snap_a[key][0] == 'file':
-                    message1 = "- Will be removed from {}".format(first_folder)
-                    print(message1)
-                    log_file.info(message1)
-                continue
-
-            else:  # if file doesn't exist in 2nd folder -> add it in list to be copied from 1st folder
-                not_exist_in_b.append(snap_a[key])
-                if snap_a[key][0] == 'file':
-                    message1 = "-> Doesn\'t exist in '{}' and will be copied there.".format(second_folder)
-                    print(message1)
-                    log_file.info(message1)
-                    size_copy_from_a_to_b += snap_a[key][2]
-
-    for key in snap_b.keys():  # check which files from B exist in A
-        if snap_b[key][0] == 'file':
-            # count number and size of files in the first folder
-            num_files_in_b += 1
-            size_of_items_in_b += snap_b[key][2]
-        else:  # count number of folder in the second folder
-            num_folders_in_b += 1
-
-        # if item from 1st folder doesn't exist in 2nd folder
-        if not snap_b[key][1][3] in paths_of_snap_a:
-            message1 = "Comparing files... '{}'".format(snap_b[key][1][3])
-            print(message1)
-            log_file.info(message1)
-
-            # if item was removed from 1st folder - add it to list of items
-            # which will be removed from 2nd folder
-            if snap_b[key][1][3] in were_removed_from_a:
-                message1 = "- Will be removed from {}".format(second_folder)
-                print(message1)
-                log_file.info(message1)
-                must_remove_from_b.append(snap_b[key])
-
-            else:  # if file doesn't exists in 1st folder -> add it in list to be copied from 2nd folder
-                message1 = "<- Doesn't exist in '{}' and will be copied there.".format(first_folder)
-                print(message1)
-                log_file.info(message1)
-                not_exist_in_a.append(snap_b[key])
-                if snap_b[key][0] == 'file':
-                    size_copy_from_b_to_a += snap_b[key][2]
+    if tree_a.digests[''] == tree_b.digests['']:
+        # nothing has been changed in one folder that hasn't been changed the same way in the other one
+        files, folders, size = tree_a.totals['']
+        message = "Content of both folders is identical: {} folders and {} files with total size of {:.2f} MB."\
+            .format(folders, files, size / 1024 ** 2)
+        print(message)
+        log_file.info(message)
+        message = '--- {0:.3f} --- seconds\n'.format(time.time() - start_time)
+        print(message)
+        log_file.info('%s\n', message)
+        plan = SyncPlan()
+        plan.snap_a = snap_a
+        plan.snap_b = snap_b
+        return [[], [], [], [], [], [], 0, plan]
+
+    with metrics.phase('diff'):
+        plan = diff_snapshots(snap_a, snap_b, first_folder, second_folder, both_synced, were_removed_from_a,
+                              were_removed_from_b, updated_items_a, updated_items_b, (tree_a, tree_b))
+
+    # menus below change these lists in place, so the plan sees every decision of user
+    not_exist_in_a = plan.copy_from_b_to_a
+    not_exist_in_b = plan.copy_from_a_to_b
+    to_be_updated_from_a_to_b = plan.update_from_a_to_b
+    to_be_updated_from_b_to_a = plan.update_from_b_to_a
+    must_remove_from_a = plan.remove_from_a
+    must_remove_from_b = plan.remove_from_b
+    skipped_files = plan.skipped
 
     '''result messages to console and log file'''
 
@@ -620,23 +833,23 @@ def compare_snapshot(first_folder, second_folder, root_first_folder, root_second
     log_file.info('\n')
     log_file.info('###########################')
 
-    size = size_of_items_in_a / 1024**2
+    size = plan.size_of_items_in_a / 1024**2
     message = "There are {} folders and {} files in '{}' with total size of {:.2f} MB."\
-              .format(num_folders_in_a, num_files_in_a, first_folder, size)
+              .format(plan.num_folders_in_a, plan.num_files_in_a, first_folder, size)
     print(message)
     log_file.info(message)
 
-    size = size_of_items_in_b / 1024 ** 2
+    size = plan.size_of_items_in_b / 1024 ** 2
     message = "There are {} folders and {} files in '{}' with total size of {:.2f} MB."\
-              .format(num_folders_in_b, num_files_in_b, second_folder, size)
+              .format(plan.num_folders_in_b, plan.num_files_in_b, second_folder, size)
     print(message)
     log_file.info(message)
 
-    message = '{} file(s) that are common for both folders.'.format(len(same_path_and_name))
+    message = '{} file(s) that are common for both folders.'.format(len(plan.common) + plan.num_identical_files)
     print(message)
     log_file.info(message)
 
-    message = '{} file(s) are equal.'.format(len(equal_files))
+    message = '{} file(s) are equal.'.format(len(plan.equal) + plan.num_identical_files)
     print(message)
     log_file.info(message)
 
@@ -697,24 +910,29 @@ def compare_snapshot(first_folder, second_folder, root_first_folder, root_second
                 print('- ' + file)
                 log_file.warning('- %s', file)
 
+    compare_files.close_hash_caches()
+    compare_files.log_stats()
+
     message = '--- {0:.3f} --- seconds\n'.format(time.time() - start_time)
     print(message)
     log_file.info('%s\n', message)
 
     number_to_transfer_from_a_to_b = count_items_to_be_transferred(not_exist_in_b, to_be_updated_from_a_to_b)
-    if number_to_transfer_from_a_to_b > 0:
+    if number_to_transfer_from_a_to_b > 0 and ask_user:
         show_files_to_transfer(number_to_transfer_from_a_to_b, first_folder, second_folder, not_exist_in_b,
-                               updated_items_a, size_copy_from_a_to_b, size_update_from_a_to_b, must_remove_from_a)
+                               to_be_updated_from_a_to_b, plan.size_copy_from_a_to_b, plan.size_update_from_a_to_b,
+                               must_remove_from_a)
 
     number_to_transfer_from_b_to_a = count_items_to_be_transferred(not_exist_in_a, to_be_updated_from_b_to_a)
-    if number_to_transfer_from_b_to_a > 0:
+    if number_to_transfer_from_b_to_a > 0 and ask_user:
         show_files_to_transfer(number_to_transfer_from_b_to_a, second_folder, first_folder, not_exist_in_a,
-                               updated_items_b, size_copy_from_b_to_a, size_update_from_b_to_a, must_remove_from_b)
+                               to_be_updated_from_b_to_a, plan.size_copy_from_b_to_a, plan.size_update_from_b_to_a,
+                               must_remove_from_b)
 
-    if len(must_remove_from_a) > 0:
+    if len(must_remove_from_a) > 0 and ask_user:
         show_files_to_remove(first_folder, must_remove_from_a, first_folder, second_folder, not_exist_in_b)
 
-    if len(must_remove_from_b) > 0:
+    if len(must_remove_from_b) > 0 and ask_user:
         show_files_to_remove(second_folder, must_remove_from_b, second_folder, first_folder, not_exist_in_a)
 
     print_and_log_what_will_be_synced()
@@ -727,39 +945,329 @@ def compare_snapshot(first_folder, second_folder, root_first_folder, root_second
         number_files_to_transfer += len(array)
 
     result.append(number_files_to_transfer)
+    result.append(plan)  # sync_files() needs snapshots from the plan to store them after syncing
     return result
 
 
-def store_snapshot_before_exit(folder_to_take_snapshot, root_folder, folder_synced):
+def store_snapshot_before_exit(folder_to_take_snapshot, root_folder, snapshot, were_not_removed):
     # Store state of folder on storage after this folder was was synced
+    # snapshot is current state of the folder that sync_files() got by applying performed operations
+    # to the snapshot taken before syncing, so there is no need to scan the whole folder once again.
+    # were_not_removed is list of items that program should try to remove from this folder next time
 
-    if folder_synced:
-        shel_file = shelve.open(os.path.join(folder_to_take_snapshot, '.folderSyncSnapshot', 'snapshot'))
-    else:
-        os.mkdir(os.path.join(folder_to_take_snapshot, '.folderSyncSnapshot'))
-        shel_file = shelve.open(os.path.join(folder_to_take_snapshot, '.folderSyncSnapshot', 'snapshot'))
-
-    # Scan folder to get a snapshot
-    snapshot = get_snapshot(folder_to_take_snapshot, root_folder)
+    if settings.verify_rescan:
+        snapshot = verify_snapshot(folder_to_take_snapshot, root_folder, snapshot)
 
     store_time = time.strftime('%Y-%m-%d %Hh-%Mm')
-    shel_file['path'] = folder_to_take_snapshot
-    shel_file['snapshot'] = snapshot
-    shel_file['date'] = store_time
-    shel_file['to_remove_from_a'] = remove_from_a_next_time
-    shel_file['to_remove_from_b'] = remove_from_b_next_time
+    with metrics.phase('store_snapshot', folder=folder_to_take_snapshot), \
+            snapshot_store.open_store(folder_to_take_snapshot, root_folder) as store:
+        store.write_snapshot(snapshot.values(), store_time, [item.path_wout_root for item in were_not_removed],
+                             scan_info.get(folder_to_take_snapshot))
 
     log_file.info('Snapshot of %s was stored in %s at %s\n', root_folder, folder_to_take_snapshot, store_time)
-    shel_file.close()
+
+
+def store_snapshot_changes(folder_to_take_snapshot, root_folder, snapshot, changed_paths, were_not_removed):
+    # Store only items at changed_paths (paths without root folder) instead of the whole snapshot, so storing
+    # in watch mode takes time proportional to number of changes. Items that are not in snapshot anymore
+    # are removed from storage with everything inside them.
+
+    if settings.verify_rescan:  # the whole folder is scanned anyway
+        store_snapshot_before_exit(folder_to_take_snapshot, root_folder, snapshot, were_not_removed)
+        return
+    if not changed_paths and not were_not_removed:
+        return
+
+    store_time = time.strftime('%Y-%m-%d %Hh-%Mm')
+    changed_paths = sorted(changed_paths)
+    with metrics.phase('store_changes', folder=folder_to_take_snapshot, items=len(changed_paths)), \
+            snapshot_store.open_store(folder_to_take_snapshot, root_folder) as store:
+        store.update_items([snapshot[path] for path in changed_paths if path in snapshot],
+                           [path for path in changed_paths if path not in snapshot], store_time,
+                           [item.path_wout_root for item in were_not_removed])
+
+    log_file.info('%d change(s) of snapshot of %s were stored in %s at %s\n', len(changed_paths), root_folder,
+                  folder_to_take_snapshot, store_time)
+
+
+def verify_snapshot(folder_to_take_snapshot, root_folder, snapshot):
+    # Scan folder once again and log every item that differs from the snapshot made from performed operations.
+    # Returns fresh snapshot, because it is the one to be trusted.
+    fresh_snapshot = get_snapshot(folder_to_take_snapshot, root_folder)
+    mismatches = 0
+
+    for path in snapshot.keys() - fresh_snapshot.keys():
+        log_file.warning("Verification: '%s' is in snapshot, but not in folder.", path)
+        mismatches += 1
+    for path, item in fresh_snapshot.items():
+        expected_item = snapshot.get(path)
+        if expected_item is None:
+            log_file.warning("Verification: '%s' is in folder, but not in snapshot.", path)
+            mismatches += 1
+        elif item.type == 'file' and (item.size, item.mtime) != (expected_item.size, expected_item.mtime):
+            log_file.warning("Verification: size or time of modification of '%s' differs from snapshot.", path)
+            mismatches += 1
+
+    message = "Verification of '{}': {} mismatch(es) with snapshot.".format(folder_to_take_snapshot, mismatches)
+    print(message)
+    log_file.info(message)
+    return fresh_snapshot
+
+
+def update_snapshot_item(snapshot, root, path_wout_root):
+    # Put current state of one file or folder in the snapshot, only this path is stat'ed
+    item_stat = os.stat(os.path.join(root.path, path_wout_root))
+    if stat.S_ISDIR(item_stat.st_mode):
+        snapshot[path_wout_root] = scan_folder.SnapshotItem('folder', path_wout_root, 0, item_stat.st_mtime_ns,
+                                                            item_stat.st_ino, root)
+    else:
+        snapshot[path_wout_root] = scan_folder.SnapshotItem('file', path_wout_root, item_stat.st_size,
+                                                            item_stat.st_mtime_ns, item_stat.st_ino, root)
+
+
+def get_touched_folders(copied_items, removed_items, updated_files, path_to_root):
+    # Paths without root folder of folders where sync_files() has copied, removed or replaced items
+    touched_folders = {os.path.dirname(item.path_wout_root) for item in itertools.chain(copied_items, removed_items)}
+    touched_folders.update(os.path.dirname(os.path.relpath(destination, path_to_root))
+                           for source, destination, size in updated_files)
+    return touched_folders
+
+
+def get_synced_paths(copied_items, removed_items, updated_files, path_to_root):
+    # Paths without root folder of items that sync_files() has copied, removed or replaced
+    synced_paths = {item.path_wout_root for item in itertools.chain(copied_items, removed_items)}
+    synced_paths.update(os.path.relpath(destination, path_to_root) for source, destination, size in updated_files)
+    return synced_paths
+
+
+def refresh_folder_times(snapshot, root, touched_folders):
+    # Syncing changes times of modification of folders where items were created or removed, and with
+    # times from snapshot taken before syncing such folders would be listed by every next scan
+    # (see scan_folder.PreviousScan). A touched folder gets its current time only if it has exactly
+    # the items snapshot has in it, otherwise something else has changed there too and it keeps old time,
+    # so next scan lists it. Folder is stat'ed before it is listed, so any change after stat() is noticed.
+    # Time of scan stored with snapshot moves to this moment, but not past time of modification of a folder
+    # that was not refreshed and was too recent to be trusted already (see scan_folder.RACY_INTERVAL_NS).
+    info = scan_info.get(root.path)
+    if info is None or not touched_folders:
+        return
+    refresh_time_ns = time.time_ns()
+    not_after_ns = info['scan_time_ns'] - scan_folder.RACY_INTERVAL_NS
+
+    names = {folder: set() for folder in touched_folders}  # names of items in every touched folder
+    recent_folders = {}  # folders that were too recent at the scan, keys are paths without root folder
+    for path, item in snapshot.items():
+        parent = os.path.dirname(path)
+        if parent in names:
+            names[parent].add(os.path.basename(path))
+        if item.type == 'folder' and item.mtime_ns >= not_after_ns:
+            recent_folders[path] = item.mtime_ns
+    if info['root_mtime_ns'] >= not_after_ns:
+        recent_folders[''] = info['root_mtime_ns']
+
+    for folder, folder_names in names.items():
+        if folder and (folder not in snapshot or snapshot[folder].type != 'folder'):
+            continue  # removed itself
+        full_path = os.path.join(root.path, folder)
+        try:
+            folder_stat = os.stat(full_path)
+            with os.scandir(full_path) as entries:
+                # the same items scan_folder skips
+                current_names = {entry.name for entry in entries
+                                 if entry.name != scan_folder.SNAPSHOT_FOLDER and not entry.name.startswith('~$')}
+        except OSError:
+            continue
+        metrics.add('scandir')
+        if current_names != folder_names:
+            log_file.debug("'%s' has changed during sync, it will be listed next time.", full_path)
+            continue
+        if folder:
+            snapshot[folder] = scan_folder.SnapshotItem('folder', folder, 0, folder_stat.st_mtime_ns,
+                                                        folder_stat.st_ino, root)
+        else:
+            info['root_mtime_ns'] = folder_stat.st_mtime_ns
+        recent_folders.pop(folder, None)
+
+    info['scan_time_ns'] = min([refresh_time_ns] + list(recent_folders.values()))
+
+
+def remove_from_snapshot(snapshot, removed_paths):
+    # Remove items that were removed from folder and everything that was inside removed folders
+    removed_paths = set(removed_paths)
+    if not removed_paths:
+        return
+    for path in list(snapshot):
+        if path in removed_paths:
+            del snapshot[path]
+            continue
+        # check every folder this item is inside of
+        parent = os.path.dirname(path)
+        while parent:
+            if parent in removed_paths:
+                del snapshot[path]
+                break
+            parent = os.path.dirname(parent)
+
+
+def refresh_snapshot(snapshot, root, changed_paths):
+    # Bring snapshot up to date for given paths without root folder, only these paths are stat'ed
+    # and only new folders are scanned. If changed_paths is None, the whole folder is scanned again.
+    # Returns sets of paths without root folder of items that were removed, added and modified, like ChangeSet.
+
+    if changed_paths is None:
+        fresh_snapshot = get_snapshot(root.path, root.name)
+        removed = snapshot.keys() - fresh_snapshot.keys()
+        new = fresh_snapshot.keys() - snapshot.keys()
+        modified = {path for path, item in fresh_snapshot.items()
+                    if path in snapshot and item.type == 'file' and
+                    (item.size, item.mtime_ns) != (snapshot[path].size, snapshot[path].mtime_ns)}
+        snapshot.clear()
+        snapshot.update(fresh_snapshot)
+        return removed, new, modified
+
+    removed = set()
+    new = set()
+    modified = set()
+    fresh_items = {}  # current state of changed paths that exist, keys are paths without root folder
+    for path in changed_paths:
+        try:
+            item_stat = os.stat(os.path.join(root.path, path))
+        except OSError:
+            continue
+        fresh_items[path] = item_stat
+
+    # items that are gone or became something else go out of snapshot with everything inside them
+    gone = {path for path in changed_paths if path in snapshot and
+            (path not in fresh_items or
+             stat.S_ISDIR(fresh_items[path].st_mode) != (snapshot[path].type == 'folder'))}
+    if gone:
+        for path in list(snapshot):
+            parent = path
+            while parent and parent not in gone:
+                parent = os.path.dirname(parent)
+            if parent:
+                del snapshot[path]
+                removed.add(path)
+
+    for path, item_stat in sorted(fresh_items.items()):  # parent folders go first
+        if not stat.S_ISDIR(item_stat.st_mode):
+            previous_item = snapshot.get(path)
+            update_snapshot_item(snapshot, root, path)
+            if previous_item is None:
+                new.add(path)
+            elif (previous_item.size, previous_item.mtime_ns) != (item_stat.st_size, item_stat.st_mtime_ns):
+                modified.add(path)
+        elif path not in snapshot:
+            # new folder: it could have been filled before it was watched, so it is scanned with its content
+            update_snapshot_item(snapshot, root, path)
+            new.add(path)
+            for item_type, path_wout_root, size, mtime_ns, inode in scan_folder.scan_folder(
+                    os.path.join(root.path, path), settings.scan_workers, path):
+                if path_wout_root not in snapshot:
+                    snapshot[path_wout_root] = scan_folder.SnapshotItem(item_type, path_wout_root, size, mtime_ns,
+                                                                        inode, root)
+                    new.add(path_wout_root)
+
+    # the same path could be removed and created again
+    removed -= new
+    return removed, new, modified
+
+
+def watch_and_sync(first_folder, second_folder, root_first_folder, root_second_folder, snap_a, snap_b, watcher):
+    # Watch mode: wait for changes in both folders and sync them right away without asking user.
+    # Snapshots stay in memory between syncs and only changed paths are looked at.
+
+    root_a = scan_folder.FolderRoot(first_folder, root_first_folder)
+    root_b = scan_folder.FolderRoot(second_folder, root_second_folder)
+
+    message = 'Watching both folders for changes. Press Ctrl+C to stop.'
+    print(message)
+    log_file.info(message)
+
+    # files that could not be updated last time, they are tried again with next changes
+    not_updated_in_a = set()
+    not_updated_in_b = set()
+
+    try:
+        while True:
+            changes = watcher.wait_for_changes(settings.watch_debounce)
+            with metrics.phase('refresh'):
+                removed_a, new_a, modified_a = refresh_snapshot(snap_a, root_a, changes[0])
+                removed_b, new_b, modified_b = refresh_snapshot(snap_b, root_b, changes[1])
+
+            # Items that could not be removed from one folder are still removed from the other one,
+            # and files that could not be updated still have newer version in the other folder.
+            # Lists of items that were not removed start with name of root folder they belong to.
+            removed_a |= {item.path_wout_root for item in remove_from_a_next_time[1:]} - snap_a.keys()
+            removed_b |= {item.path_wout_root for item in remove_from_b_next_time[1:]} - snap_b.keys()
+            del remove_from_a_next_time[1:]
+            del remove_from_b_next_time[1:]
+            modified_a |= not_updated_in_b & snap_a.keys()
+            modified_b |= not_updated_in_a & snap_b.keys()
+            if not (removed_a or new_a or modified_a or removed_b or new_b or modified_b):
+                continue  # e.g. events caused by syncing itself
+
+            message = ('Changes in {}: {} removed, {} new, {} modified; in {}: {} removed, {} new, {} modified.'
+                       .format(first_folder, len(removed_a), len(new_a), len(modified_a),
+                               second_folder, len(removed_b), len(new_b), len(modified_b)))
+            print(message)
+            log_file.info(message)
+
+            # only changed paths can differ between folders, the rest has been synced already
+            changed_a = removed_a | new_a | modified_a
+            changed_b = removed_b | new_b | modified_b
+            changed_paths = changed_a | changed_b
+            plan = diff_snapshots({path: snap_a[path] for path in sorted(changed_paths) if path in snap_a},
+                                  {path: snap_b[path] for path in sorted(changed_paths) if path in snap_b},
+                                  first_folder, second_folder, True, removed_a, removed_b, modified_a, modified_b)
+            plan.snap_a = snap_a  # sync_files() updates whole snapshots, but stores only changed items
+            plan.snap_b = snap_b
+            compare_files.close_hash_caches()
+            for path in plan.skipped:
+                message = '- {} was changed in both folders, check it manually.'.format(path)
+                print(message)
+                log_file.warning(message)
+
+            result = [plan.copy_from_b_to_a, plan.copy_from_a_to_b, plan.update_from_b_to_a, plan.update_from_a_to_b,
+                      plan.remove_from_a, plan.remove_from_b]
+            number_files_to_transfer = sum(len(array) for array in result)
+            # snapshots in memory have been changed by refresh, so changed items are stored even if nothing is synced
+            if number_files_to_transfer > 0:
+                sync_files(result + [number_files_to_transfer, plan], first_folder, second_folder, root_first_folder,
+                           True, root_second_folder, True, (changed_a, changed_b), ask_user=False)
+            else:
+                store_snapshot_changes(first_folder, root_first_folder, snap_a, changed_a, [])
+                store_snapshot_changes(second_folder, root_second_folder, snap_b, changed_b, [])
+            not_updated_in_a = set(plan.not_updated_in_a)
+            not_updated_in_b = set(plan.not_updated_in_b)
+    except KeyboardInterrupt:
+        print('\nWatching has been stopped.')
+        log_file.info('Watching has been stopped.')
+    finally:
+        watcher.close()
 
 
 def sync_files(difference_between_folders, first_folder, second_folder, root_first_folder, first_folder_synced,
-               root_second_folder, second_folder_synced):
+               root_second_folder, second_folder_synced, changed_paths=None, ask_user=True):
     # This function takes lists with items to copy and/or delete them
+    # changed_paths are given in watch mode: sets of paths without root folder that have changed in 1st and 2nd
+    # folder since snapshots were stored. Then only these items and items touched by syncing are stored.
+    # ask_user is False in watch mode: items that can't be removed or updated are just logged and left
+    # in remove_from_*_next_time and plan.not_updated_in_*, so they can be tried again later.
 
     start_time = time.time()
     not_exist_in_a, not_exist_in_b, to_be_updated_from_b_to_a, to_be_updated_from_a_to_b, \
-        remove_from_a, remove_from_b, number_files_to_handle = difference_between_folders
+        remove_from_a, remove_from_b, number_files_to_handle, plan = difference_between_folders
+    copy_files.reset_stats()
+
+    # Snapshots are updated after every successful operation, so there is no need
+    # to scan both folders again after syncing in order to store their state
+    snap_a = plan.snap_a
+    snap_b = plan.snap_b
+    root_a = scan_folder.FolderRoot(first_folder, root_first_folder)
+    root_b = scan_folder.FolderRoot(second_folder, root_second_folder)
+    removed_from_a = []  # paths without root folder of items that were removed from 1st folder
+    removed_from_b = []  # Ditto for 2nd folder
 
     total_size_copied_updated = 0
     total_size_removed = 0
@@ -771,21 +1279,28 @@ def sync_files(difference_between_folders, first_folder, second_folder, root_fir
     log_file.info('Start syncing files...')
     print('Start syncing files...')
 
-    def delete(file_to_delete):
+    # Lines about every item are shown only in verbose mode, otherwise there is one line of progress
+    bar = progress.Progress('Syncing', total=sum(len(items) for items in (
+        not_exist_in_a, not_exist_in_b, to_be_updated_from_a_to_b, to_be_updated_from_b_to_a, remove_from_a,
+        remove_from_b)))
+
+    def delete(file_to_delete, remove=send2trash.send2trash):
         # Function that tries to remove one specific file and return true if it was removed.
         # Used in remove_items() and update_files().
 
         user_decision = ''
         while user_decision != 'n':
             try:
-                send2trash.send2trash(file_to_delete)
+                remove(file_to_delete)
 
             # ask user to close program that is using file that should be removed and try to perform removing again
             except OSError:
                 log_file.error(traceback.format_exc())
+                if not ask_user:  # nobody is there to answer in watch mode
+                    return False
                 message2 = ("'{}' has been opened in another app. Close all apps that can use this file "
                             "and try again.".format(file_to_delete))
-                print(message2)
+                progress.echo(message2)
                 log_file.warning(message2)
                 user_decision = input('Try again? y/n: ').lower()
                 if user_decision == 'n':
@@ -800,134 +1315,201 @@ def sync_files(difference_between_folders, first_folder, second_folder, root_fir
                     continue
             return True
 
-    def remove_items(items_to_remove, folder):  # function that recursively removes files from list
+    def remove_items(items_to_remove, folder, removed_paths):  # function that removes files from list
 
-        nonlocal were_removed  # list of removed files
-        nonlocal total_size_removed  # number of removed files
-        remove_state = True  # used to count removed files
+        progress.detail('Removing files...')
 
-        print('Removing files...')
-        log_file.info('Removing files...')
-
-        for item in range(len(items_to_remove)):  # recursively sends items from list to delete() function
-            full_path = items_to_remove[item][1][0]
-            if os.path.exists(full_path):
-                if delete(full_path):
-                    message2 = "'{}' was removed".format(full_path)
-                    print(message2)
-                    log_file.info(message2)
-                    were_removed += 1
-                else:
-                    message2 = "'{}' was not removed".format(full_path)
-                    print(message1)
+        def was_removed(group):
+            nonlocal were_removed  # number of removed files
+            nonlocal total_size_removed  # size of removed files
+            if len(group.items) > 1:
+                message2 = "'{}' was removed with {} item(s) inside".format(group.top.full_path,
+                                                                           len(group.items) - 1)
+            else:
+                message2 = "'{}' was removed".format(group.top.full_path)
+            progress.detail(message2)
+            bar.update(len(group.items))
+            were_removed += len(group.items)
+            total_size_removed += group.size
+            # items inside removed folder are removed from snapshot with it
+            removed_paths.append(group.top.path_wout_root)
+
+        # only top-most items are removed, everything inside removed folders goes with them
+        groups_to_remove = []
+        for group in remove_files.collapse(items_to_remove):
+            if os.path.lexists(group.top.full_path):
+                groups_to_remove.append(group)
+            else:  # item was removed by user since snapshot was made
+                was_removed(group)
+
+        for group, error in remove_files.remove_groups(groups_to_remove):
+            if error is not None:
+                log_file.error(''.join(traceback.format_exception_only(type(error), error)))
+                # ask user to close program that uses it and try again
+                if not delete(group.top.full_path, remove=remove_files.remove_path):
+                    message2 = "'{}' was not removed".format(group.top.full_path)
+                    progress.echo(message2)
                     log_file.warning(message2)
                     if folder == 'first':  # check and log from which folder were file that wasn't removed
-                        remove_from_b_next_time.append(items_to_remove[item])
+                        remove_from_b_next_time.extend(group.items)
                     elif folder == 'second':
-                        remove_from_a_next_time.append(items_to_remove[item])
-                    remove_state = False
+                        remove_from_a_next_time.extend(group.items)
                     continue
-            else:  # item was removed with its folder before
-                message2 = "'{}' was removed".format(full_path)
-                print(message2)
-                log_file.info(message2)
-                were_removed += 1
-
-            if items_to_remove[item][0] == 'file' and remove_state:  # count size of removed files
-                total_size_removed += items_to_remove[item][2]
+            was_removed(group)
 
-    def copy_items(items_to_copy, path_to_root):  # Copy files that don't exist in one of folders
+    def copy_items(items_to_copy, path_to_root, snapshot, root):  # Copy files that don't exist in one of folders
 
         # in order to use a variable from nearest outer scope
         nonlocal were_copied
         nonlocal were_created
         nonlocal total_size_copied_updated
 
+        files_to_copy = []  # (full path of source file, full path of destination file)
+        size_of_files = {}  # size of every file to copy, keys are full paths of destination files
+        source_folder = None
+
+        # Create all folders first, so files can be copied in any order afterwards.
+        # Folders go before their content in snapshot, so parent folder is always created before its subfolders.
         for item in items_to_copy:
 
             # create path where copy items to
-            path_without_root = item[1][3]
-            full_path_item_in_this_folder = item[1][0]  # full path of item
+            path_without_root = item.path_wout_root
+            full_path_item_in_this_folder = item.full_path  # full path of item
             full_path_item_that_not_exits_yet = os.path.join(path_to_root, path_without_root)
 
-            if item[0] == 'folder':
+            if item.type == 'folder':
                 os.mkdir(full_path_item_that_not_exits_yet)  # create empty folder instead of copying full directory
+                update_snapshot_item(snapshot, root, path_without_root)
                 were_created += 1
-                message2 = "- '{}' was created".format(full_path_item_that_not_exits_yet)
-                print(message2)
-                log_file.info(message2)
+                progress.detail("- '{}' was created".format(full_path_item_that_not_exits_yet))
+                bar.update()
 
-            elif item[0] == 'file':
+            elif item.type == 'file':
                 if os.path.exists(full_path_item_that_not_exits_yet):  # it shouldn't happened, but just in case
                     log_console.warning("WARNING: '%s' already exists!", full_path_item_that_not_exits_yet)
                     log_file.warning("WARNING: '%s' already exists!", full_path_item_that_not_exits_yet)
+                    update_snapshot_item(snapshot, root, path_without_root)
                     continue
-                else:
-                    message2 = "'{}' is copying to '{}'...".format(item[1][0], full_path_item_that_not_exits_yet)
-                    print(message2)
-                    log_file.info(message2)
-                    if item[2] > 1024**3:  # if size of file more than 1 Gb
-                        message2 = "'{} is heavy. Please be patient.'".format(item[1][0])
-                        print(message2)
-                        log_file.info(message2)
 
-                    # copy file
-                    shutil.copy2(full_path_item_in_this_folder, full_path_item_that_not_exits_yet)
+                if item.size > 1024**3:  # if size of file more than 1 Gb
+                    message2 = "'{} is heavy. Please be patient.'".format(full_path_item_in_this_folder)
+                    progress.echo(message2)
+                    log_file.info(message2)
+                files_to_copy.append((full_path_item_in_this_folder, full_path_item_that_not_exits_yet))
+                size_of_files[full_path_item_that_not_exits_yet] = item.size
+                source_folder = item.root.path
+
+        # Copy files in thread pool, results come back in the same order
+        for (source, destination), error in copy_files.copy_files(files_to_copy, source_folder, path_to_root):
+            if error is not None:
+                log_file.error(''.join(traceback.format_exception_only(type(error), error)))
+                message2 = "'{}' was not copied: {}".format(source, error)
+                progress.echo(message2)
+                log_file.warning(message2)
+                continue
 
-                    were_copied += 1
-                    total_size_copied_updated += item[2]
-                    print('Done.')
-                    log_file.info('Done.')
+            update_snapshot_item(snapshot, root, os.path.relpath(destination, path_to_root))
+            were_copied += 1
+            total_size_copied_updated += size_of_files[destination]
+            progress.detail("'{}' was copied to '{}'.".format(source, destination))
+            bar.update(size=size_of_files[destination])
 
-    def update_files(to_be_updated):  # recursively update files by deleting old one and copying new one instead of it
+    # recursively update files by deleting old one and copying new one instead of it
+    def update_files(to_be_updated, snapshot, root, not_updated):
+        # not_updated gets paths without root folder of files that were not updated
 
         nonlocal total_size_copied_updated
         nonlocal were_updated
 
+        files_to_copy = []  # (full path of newer file, full path of file to replace)
+        files_to_patch = []  # the same for large files that are updated by rewriting blocks that differ
+        files_to_replace = []  # the same for files that are replaced without moving old version to trash
+        size_of_files = {}  # size of every newer file, keys are full paths of files to replace
+        source_folder = None
+
         # array contains list three items: full path of item to be copied, full path where copy to, size of file to copy
+        # Old versions are removed one by one, because user may be asked to close a program that uses a file,
+        # and new versions are copied in thread pool afterwards
         for array in to_be_updated:
             if os.path.exists(array[0]) and os.path.exists(array[1]):
-                if delete(array[1]):  # if item was successfully removed
-                    shutil.copy2(array[0], array[1])  # copy newer version instead of one that was removed
-                    message2 = "'{}' was updated.".format(array[1])
-                    print(message2)
-                    log_file.info(message2)
-                    total_size_copied_updated += array[2]
-                    were_updated += 1
+                if source_folder is None:
+                    source_folder = os.path.dirname(array[0])
+                if 0 < copy_files.delta_threshold <= array[2]:
+                    # old version is replaced by a new one atomically and goes to trash or stash afterwards
+                    files_to_patch.append((array[0], array[1]))
+                    size_of_files[array[1]] = array[2]
+                elif copy_files.update_mode != 'trash':
+                    files_to_replace.append((array[0], array[1]))
+                    size_of_files[array[1]] = array[2]
+                elif delete(array[1]):  # if item was successfully removed
+                    files_to_copy.append((array[0], array[1]))
+                    size_of_files[array[1]] = array[2]
                 else:
                     message2 = "'{}' was not updated.".format(array[1])
-                    print(message2)
+                    progress.echo(message2)
                     log_file.warning(message2)
+                    not_updated.append(os.path.relpath(array[1], root.path))
                     # Script will try to updated it next time, there is nothing to be worried about
                     continue
 
             elif not os.path.exists(array[0]):
                 message2 = "'{}' hasn't been found! Can't handle it.".format(array[0])
-                print(message2)
+                progress.echo(message2)
                 log_file.warning(message2)
             elif not os.path.exists(array[1]):
                 message2 = "'{}' hasn't been found! Can't handle it.".format(array[1])
-                print(message1)
+                progress.echo(message2)
                 log_file.warning(message2)
 
-    if len(remove_from_a) > 0:
-        remove_items(remove_from_a, 'first')
+        # copy newer versions instead of ones that were removed, then replace and patch the others
+        results = itertools.chain(copy_files.copy_files(files_to_copy, source_folder, root.path),
+                                  copy_files.copy_files(files_to_replace, source_folder, root.path,
+                                                        copy=functools.partial(copy_files.replace_file,
+                                                                               root_folder=root.path)),
+                                  copy_files.copy_files(files_to_patch, source_folder, root.path,
+                                                        copy=functools.partial(copy_files.delta_update,
+                                                                               root_folder=root.path)))
+        for (source, destination), error in results:
+            if error is not None:
+                log_file.error(''.join(traceback.format_exception_only(type(error), error)))
+                message2 = "'{}' was not updated: {}".format(destination, error)
+                progress.echo(message2)
+                log_file.warning(message2)
+                not_updated.append(os.path.relpath(destination, root.path))
+                continue
 
-    if len(remove_from_b) > 0:
-        remove_items(remove_from_b, 'second')
+            update_snapshot_item(snapshot, root, os.path.relpath(destination, root.path))
+            progress.detail("'{}' was updated.".format(destination))
+            bar.update(size=size_of_files[destination])
+            total_size_copied_updated += size_of_files[destination]
+            were_updated += 1
 
-    if len(to_be_updated_from_a_to_b) > 0:
-        update_files(to_be_updated_from_a_to_b)
+    with metrics.phase('delete'):
+        if len(remove_from_a) > 0:
+            remove_items(remove_from_a, 'first', removed_from_a)
 
-    if len(to_be_updated_from_b_to_a) > 0:
-        update_files(to_be_updated_from_b_to_a)
+        if len(remove_from_b) > 0:
+            remove_items(remove_from_b, 'second', removed_from_b)
 
-    if len(not_exist_in_a) > 0:
-        copy_items(not_exist_in_a, first_folder)
+    with metrics.phase('update'):
+        if len(to_be_updated_from_a_to_b) > 0:
+            update_files(to_be_updated_from_a_to_b, snap_b, root_b, plan.not_updated_in_b)
 
-    if len(not_exist_in_b) > 0:
-        copy_items(not_exist_in_b, second_folder)
+        if len(to_be_updated_from_b_to_a) > 0:
+            update_files(to_be_updated_from_b_to_a, snap_a, root_a, plan.not_updated_in_a)
 
+        if copy_files.update_mode == 'stash':
+            copy_files.evict_stash(first_folder)
+            copy_files.evict_stash(second_folder)
+
+    with metrics.phase('copy'):
+        if len(not_exist_in_a) > 0:
+            copy_items(not_exist_in_a, first_folder, snap_a, root_a)
+
+        if len(not_exist_in_b) > 0:
+            copy_items(not_exist_in_b, second_folder, snap_b, root_b)
+
+    bar.close()
     if were_created > 0:
         message1 = "\n{} folders were created.".format(were_created)
         print(message1)
@@ -953,6 +1535,7 @@ def sync_files(difference_between_folders, first_folder, second_folder, root_fir
             .format(total_size_copied_updated / 1024**2)
         print(message)
         log_file.info(message)
+        copy_files.log_stats()
 
     if total_size_removed > 0:
         message1 = 'Total size of files were removed in {0:.2f} MB'.format(total_size_removed / 1024**2)
@@ -963,8 +1546,29 @@ def sync_files(difference_between_folders, first_folder, second_folder, root_fir
     print(message1)
     log_file.info(message1)
 
-    store_snapshot_before_exit(first_folder, root_first_folder, first_folder_synced)
-    store_snapshot_before_exit(second_folder, root_second_folder, second_folder_synced)
+    # remove_from_*_next_time lists start with name of root folder they belong to
+    remove_from_snapshot(snap_a, removed_from_a)
+    remove_from_snapshot(snap_b, removed_from_b)
+    if changed_paths is None:
+        # folders where items were created, replaced or removed have new times of modification
+        with metrics.phase('refresh_folders'):
+            refresh_folder_times(snap_a, root_a, get_touched_folders(not_exist_in_a, remove_from_a,
+                                                                     to_be_updated_from_b_to_a, first_folder))
+            refresh_folder_times(snap_b, root_b, get_touched_folders(not_exist_in_b, remove_from_b,
+                                                                     to_be_updated_from_a_to_b, second_folder))
+        store_snapshot_before_exit(first_folder, root_first_folder, snap_a, remove_from_a_next_time[1:])
+        store_snapshot_before_exit(second_folder, root_second_folder, snap_b, remove_from_b_next_time[1:])
+    else:
+        # times of folders are not refreshed here, that would take a pass over the whole snapshot,
+        # so stored times just stay older than actual ones and such folders are listed by the next run
+        store_snapshot_changes(first_folder, root_first_folder, snap_a, changed_paths[0] | get_synced_paths(
+            not_exist_in_a, remove_from_a, to_be_updated_from_b_to_a, first_folder), remove_from_a_next_time[1:])
+        store_snapshot_changes(second_folder, root_second_folder, snap_b, changed_paths[1] | get_synced_paths(
+            not_exist_in_b, remove_from_b, to_be_updated_from_a_to_b, second_folder), remove_from_b_next_time[1:])
+    if changed_paths is None:
+        # items that were not removed have been stored, watch mode takes them to try again with next changes
+        del remove_from_a_next_time[1:]
+        del remove_from_b_next_time[1:]
 
 
 # Menu to ask user if he wants to start transferring files
@@ -977,33 +1581,186 @@ def menu_before_sync(difference_between_folders, first_folder, second_folder, ro
             log_file.info('User agreed to sync files.')
             sync_files(difference_between_folders, first_folder, second_folder, root_first_folder, first_folder_synced,
                        root_second_folder, second_folder_synced)
-            break
+            return True
         elif start_syncing == 'n':  # continue without copy/remove files
             log_file.info('User denied to sync files.')
-            break
+            return False
         else:
             print('Error of input. Try again.')
             log_file.info('Error of input. Try again.')
             continue
 
 
+def save_plan(path_to_plan, difference_between_folders, first_folder, second_folder, root_first_folder,
+              first_folder_synced, root_second_folder, second_folder_synced):
+    # Write plan made by compare_snapshot() to file for --apply, with snapshots of both folders,
+    # so they can be stored after syncing without scanning folders again
+
+    # plan can be applied from another working folder, so paths in it are absolute
+    header = {'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'first_folder': os.path.abspath(first_folder), 'second_folder': os.path.abspath(second_folder),
+              'root_first_folder': root_first_folder, 'root_second_folder': root_second_folder,
+              'first_folder_synced': first_folder_synced, 'second_folder_synced': second_folder_synced,
+              'scan_info': {os.path.abspath(folder): scan_info.get(folder) for folder in (first_folder, second_folder)}}
+    plan = difference_between_folders[7]
+    try:
+        number_of_operations = plan_file.write_plan(path_to_plan, header, plan.snap_a, plan.snap_b,
+                                                    difference_between_folders)
+    except OSError as error:
+        message = "Can't write plan to '{}': {}".format(path_to_plan, error)
+        print(message)
+        log_file.error(message)
+        return False
+
+    message = "Plan with {} operation(s) was written to '{}'. Sync folders with --apply {}".format(
+        number_of_operations, path_to_plan, path_to_plan)
+    print(message)
+    log_file.info(message)
+    return True
+
+
+def apply_plan(path_to_plan):
+    # Sync folders as plan from --plan says. Folders are not scanned: every operation is checked against sizes
+    # and times of modification of its files in plan, and skipped if they have changed since plan was made.
+
+    try:
+        plan_from_file = plan_file.read_plan(path_to_plan)
+    except (OSError, ValueError, KeyError) as error:
+        message = "Can't read plan from '{}': {}".format(path_to_plan, error)
+        print(message)
+        log_file.error(message)
+        return False
+
+    header = plan_from_file.header
+    first_folder, second_folder = header['first_folder'], header['second_folder']
+    message = "Plan was made at {} for '{}' and '{}'.".format(header['created'], first_folder, second_folder)
+    print(message)
+    log_file.info(message)
+    for folder in (first_folder, second_folder):
+        if not os.path.isdir(folder):
+            message = "'{}' doesn't exist anymore, plan can't be applied.".format(folder)
+            print(message)
+            log_file.error(message)
+            return False
+
+    operations, skipped = plan_file.check_operations(plan_from_file)
+    for operation, reason in skipped:
+        message = "Skipped: {} '{}' from {} folder, because {}.".format(operation['op'], operation['path'],
+                                                                       operation['from'], reason)
+        print(message)
+        log_file.warning(message)
+
+    # lists in the same form as compare_snapshot() returns
+    plan = SyncPlan()
+    plan.snap_a, plan.snap_b = plan_from_file.snapshots
+    for operation in operations:
+        index = plan_file.SIDES.index(operation['from'])
+        item = plan_from_file.snapshots[index][operation['path']]
+        if operation['op'] == 'remove':
+            (plan.remove_from_a, plan.remove_from_b)[index].append(item)
+        elif operation['op'] == 'update':
+            destination = os.path.join(plan_from_file.roots[1 - index].path, operation['path'])
+            (plan.update_from_a_to_b, plan.update_from_b_to_a)[index].append([item.full_path, destination,
+                                                                              item.size])
+        else:
+            (plan.copy_from_a_to_b, plan.copy_from_b_to_a)[index].append(item)
+
+    # scan_info is stored with snapshots, so next scan knows which folders have not changed since this one
+    for folder, info in header['scan_info'].items():
+        if info is not None:
+            scan_info[folder] = info
+    remove_from_a_next_time.append(header['root_first_folder'])
+    remove_from_b_next_time.append(header['root_second_folder'])
+
+    difference_between_folders = [plan.copy_from_b_to_a, plan.copy_from_a_to_b, plan.update_from_b_to_a,
+                                  plan.update_from_a_to_b, plan.remove_from_a, plan.remove_from_b, len(operations),
+                                  plan]
+    if not operations:
+        print('There is nothing to copy or remove.')
+        log_file.info('There is nothing to copy or remove.')
+    # snapshots are stored even if there is nothing to do, folders are synced as far as plan knows
+    sync_files(difference_between_folders, first_folder, second_folder, header['root_first_folder'],
+               header['first_folder_synced'], header['root_second_folder'], header['second_folder_synced'])
+    return True
+
+
+def is_stale(path_to_folder):
+    # Check whether scan of folder listed any folder that could have been taken from stored snapshot
+    changes = change_sets.get(path_to_folder)
+    return changes is not None and changes.listed_folders > 0
+
+
+def apply_settings(arguments):
+    # Make arguments from parse_arguments() settings of this run and pass them to other modules
+    global settings
+    settings = arguments
+    compare_files.buffer_size = settings.compare_buffer_mb * 1024 ** 2
+    compare_files.use_mmap = settings.compare_mmap
+    compare_files.workers = settings.compare_workers
+    compare_files.large_file_workers = settings.compare_large_workers
+    compare_files.probes = settings.compare_probes
+    copy_files.workers = settings.copy_workers
+    copy_files.max_per_source = settings.copy_per_source
+    copy_files.max_per_destination = settings.copy_per_destination
+    copy_files.delta_threshold = settings.delta_threshold_mb * 1024 ** 2
+    copy_files.update_mode = settings.update_mode
+    copy_files.stash_limit = settings.stash_max_mb * 1024 ** 2
+    remove_files.permanent = settings.permanent_delete
+    stream_sync.on_removed = settings.on_removed
+    progress.verbose = settings.verbose
+    metrics.trace = settings.trace
+    # lines about every file are logged at DEBUG level
+    log_file.setLevel(logging.DEBUG if settings.verbose else logging.INFO)
+    stream_sync.window = settings.copy_workers * 2
+    compare_files.max_per_device = settings.compare_per_device
+    compare_files.max_bytes_in_flight = settings.compare_max_mb_in_flight * 1024 ** 2
+
+
+def write_metrics():
+    # Write time of every phase and counters of this run to log folder, with statistics of comparison and copying
+    metrics.write_report(handle_logs.current_log_path, {
+        'compare': {name: value for name, value in vars(compare_files.stats).items() if name != 'lock'},
+        'copy': {'files': copy_files.stats.files, 'bytes': copy_files.stats.bytes,
+                 'seconds': copy_files.stats.seconds},
+        'delta': {'files': copy_files.delta_stats.files, 'size': copy_files.delta_stats.size,
+                  'bytes_written': copy_files.delta_stats.bytes_written},
+    })
+
+
 def main():
+    apply_settings(parse_arguments())
+    # metrics are written however program ends, e.g. when watching is stopped with Ctrl+C
+    atexit.register(write_metrics)
+
     hello_message = ('Hello. This is folder_sync.py written by Aleksandr Mikheev.\nIt is a program that can '
                      'sync all files and folders between two chosen directories.\n')
     print(hello_message)
     log_file.info(hello_message)
 
-    # first argument is max size of folder with logs in megabytes
-    # if there are more than that - remove oldest logs
-    handle_logs.clean_log_folder(20, log_file, log_console)
+    # remove logs that are older than --log-max-days and the oldest logs while there are more than --log-max-mb
+    handle_logs.clean_log_folder(settings.log_max_mb, log_file, log_console, settings.log_max_days)
+
+    if settings.apply:
+        apply_plan(settings.apply)
+        print('Goodbye.')
+        log_file.info('Goodbye.')
+        return
 
     # let user choose folders to sync - here program starts
-    first_folder, second_folder = menu_choose_folders()
+    if settings.folders:
+        first_folder, second_folder = (os.path.normpath(folder) for folder in settings.folders)
+    else:
+        first_folder, second_folder = menu_choose_folders()
+
+    # start watching before folders are scanned, so nothing that changes during first sync is missed
+    watcher = None
+    if settings.watch:
+        watcher = watch_folders.make_watcher([first_folder, second_folder], settings.watch_poll)
 
     # check if there is snapshot of previous sync inside root directory
-    first_folder_synced = os.path.exists(os.path.join(first_folder, '.folderSyncSnapshot'))
+    first_folder_synced = snapshot_store.has_stored_snapshot(first_folder)
     log_file.info("Has '{%s}' been synced before? %s", first_folder, first_folder_synced)
-    second_folder_synced = os.path.exists(os.path.join(second_folder, '.folderSyncSnapshot'))
+    second_folder_synced = snapshot_store.has_stored_snapshot(second_folder)
     log_file.info("Has '{%s}' been synced before? %s \n", second_folder, second_folder_synced)
 
     # check if both folders were synced before
@@ -1022,23 +1779,52 @@ def main():
     remove_from_a_next_time.append(root_first_folder)
     remove_from_b_next_time.append(root_second_folder)
 
+    if settings.stream:
+        stream_sync.sync_folders(first_folder, second_folder, root_first_folder, root_second_folder, both_synced)
+        print('Goodbye.')
+        log_file.info('Goodbye.')
+        return
+
+    if settings.plan:
+        # nothing is synced and no snapshot is stored until plan is applied
+        difference_between_folders = compare_snapshot(first_folder, second_folder, root_first_folder,
+                                                      root_second_folder, both_synced, first_folder_synced,
+                                                      second_folder_synced, ask_user=False)
+        save_plan(settings.plan, difference_between_folders, first_folder, second_folder, root_first_folder,
+                  first_folder_synced, root_second_folder, second_folder_synced)
+        print('Goodbye.')
+        log_file.info('Goodbye.')
+        return
+
     # start to compare folders that user has chosen
     difference_between_folders = compare_snapshot(first_folder, second_folder, root_first_folder, root_second_folder,
                                                   both_synced, first_folder_synced, second_folder_synced)
 
+    folders_synced = True
     if difference_between_folders[6] > 0:  # call sync function if there is something to sync
-        menu_before_sync(difference_between_folders, first_folder, second_folder, root_first_folder,
-                         first_folder_synced, root_second_folder, second_folder_synced)
+        folders_synced = menu_before_sync(difference_between_folders, first_folder, second_folder, root_first_folder,
+                                          first_folder_synced, root_second_folder, second_folder_synced)
     else:
-        # store snapshots of folders if they have been synced but no differences have been found
-        if not first_folder_synced:
-            store_snapshot_before_exit(first_folder, root_first_folder, first_folder_synced)
-        if not second_folder_synced:
-            store_snapshot_before_exit(second_folder, root_second_folder, second_folder_synced)
+        # store snapshots of folders if they have been synced but no differences have been found,
+        # and store them again if scan had to list folders whose times differ from stored ones,
+        # otherwise such folders would be listed on every run until something changes
+        if not first_folder_synced or is_stale(first_folder):
+            store_snapshot_before_exit(first_folder, root_first_folder, difference_between_folders[7].snap_a, [])
+        if not second_folder_synced or is_stale(second_folder):
+            store_snapshot_before_exit(second_folder, root_second_folder, difference_between_folders[7].snap_b, [])
 
         print('There is nothing to copy or remove.')
         log_file.info('There is nothing to copy or remove.')
 
+    if watcher is not None:
+        if folders_synced:
+            watch_and_sync(first_folder, second_folder, root_first_folder, root_second_folder,
+                           difference_between_folders[7].snap_a, difference_between_folders[7].snap_b, watcher)
+        else:
+            watcher.close()
+            print('Folders are not watched, because they have not been synced.')
+            log_file.info('Folders are not watched, because they have not been synced.')
+
     print('Goodbye.')
     log_file.info('Goodbye.')
 
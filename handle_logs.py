@@ -16,19 +16,43 @@
 # or
 # logFile.info('User went crazy!')
 
+# Log file is written by a background thread: loggers only put records in a queue, so logging
+# doesn't make the program wait for disk. Records that are still in the queue are written when program exits.
+
 # This module can also clean up log folder when it is too large
-# Put in your script 'handle_logs.clean_log_folder(size, logFile, logConsole)'
+# Put in your script 'handle_logs.clean_log_folder(size, logFile, logConsole, max_age_days)'
 # where size is integer that represents maximum size in megabytes that
-# triggers removing the oldest log files
+# triggers removing the oldest log files, max_age_days is how many days logs are kept (0 - no limit)
 # and where logFile and logConsole are names of loggers
 
+# Logs that are not written anymore are compressed with gzip. Log of one run is rotated too
+# when it grows larger than max_log_file_size, the older part is compressed right away.
+
+import atexit
+import gzip
+import heapq
 import logging
+import logging.handlers
 import os
+import queue
+import shutil
 import time
-import send2trash
 from datetime import datetime
 import re
 
+LOG_FOLDER = 'log'
+LOG_NAME_DATE = re.compile(r'log_(\d{4}-\d{2}-\d{2}__\d{2}h\d{2}m)')  # date is taken from name of log file
+
+max_log_file_size = 10 * 1024 ** 2  # log of one run is rotated when it is larger than that
+current_log_path = None  # log that is being written now, it is never compressed or removed
+
+
+def compress_file(source, destination):
+    # Compress source into destination with gzip and remove source
+    with open(source, 'rb') as file_in, gzip.open(destination, 'wb') as file_out:
+        shutil.copyfileobj(file_in, file_out)
+    os.remove(source)
+
 
 def set_loggers():
     log_file = logging.getLogger('fs1')  # create logger for this specific module for logging to file
@@ -41,80 +65,98 @@ def set_loggers():
     # define format of logging messages
     formatter = logging.Formatter('%(levelname)s %(asctime)s line %(lineno)s: %(message)s')
 
+    global current_log_path
     timestr = time.strftime('%Y-%m-%d__%Hh%Mm')
-    new_log_name = os.path.join('log', 'log_' + timestr + '.txt')
-
-    if os.path.exists('.\log'):  # create new log every time when script starts instead of writing in the same file
-        if os.path.exists(new_log_name): # if log file with this date already exists, make new one with (i) in the name
-            i = 2
-            while os.path.exists(os.path.join('log', 'log_' + timestr + '(' + str(i) + ').txt')):
-                i += 1
-                continue
-            file_handler = logging.FileHandler(os.path.join('log', 'log_' + timestr + '(' +
-                                                            str(i) + ').txt'), encoding='utf8')
-        else:
-            file_handler = logging.FileHandler(new_log_name, encoding='utf8')
-    else:
-        os.mkdir('.\log')
-        file_handler = logging.FileHandler(new_log_name, encoding='utf8')
+    new_log_name = os.path.join(LOG_FOLDER, 'log_' + timestr + '.txt')
+
+    # create new log every time when script starts instead of writing in the same file
+    os.makedirs(LOG_FOLDER, exist_ok=True)
+    if os.path.exists(new_log_name) or os.path.exists(new_log_name + '.gz'):
+        # if log file with this date already exists, make new one with (i) in the name
+        i = 2
+        while (os.path.exists(os.path.join(LOG_FOLDER, 'log_' + timestr + '(' + str(i) + ').txt')) or
+               os.path.exists(os.path.join(LOG_FOLDER, 'log_' + timestr + '(' + str(i) + ').txt.gz'))):
+            i += 1
+        new_log_name = os.path.join(LOG_FOLDER, 'log_' + timestr + '(' + str(i) + ').txt')
+    current_log_path = new_log_name
+
+    # when log grows too large, it is renamed to log_<date>.txt.1.gz (.2.gz and so on) and compressed
+    file_handler = logging.handlers.RotatingFileHandler(new_log_name, maxBytes=max_log_file_size,
+                                                        backupCount=1000, encoding='utf8',
+                                                        errors='backslashreplace')  # names that are not UTF-8
+    file_handler.namer = lambda name: name + '.gz'
+    file_handler.rotator = compress_file
 
     # set format to both handlers
     stream_handler = logging.StreamHandler()
     stream_handler.setFormatter(formatter)
     file_handler.setFormatter(formatter)
 
-    # apply handler to this module (folderSync.py)
-    log_file.addHandler(file_handler)
+    # apply handler to this module (folderSync.py): records go to queue, listener writes them to file in its thread
+    log_queue = queue.SimpleQueue()
+    log_file.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)  # write the rest of queue before exit
     log_console.addHandler(stream_handler)
 
     return log_file, log_console
 
 
-def clean_log_folder(max_size, log_file, log_console):
-    # Remove oldest log files from log folder when size of folder is more than max_size.
+def clean_log_folder(max_size, log_file, log_console, max_age_days=0):
+    # Compress logs of previous runs, then remove logs that are older than max_age_days (0 - keep logs of any age)
+    # and the oldest logs while size of log folder is more than max_size megabytes.
+    # Logs are removed permanently, there is no point in keeping them in trash.
 
     # Script take creation time of file not from its properties (get.cwd()),
     # but from it's name, because you cannot rely on properties in case if log file was copied by
     # for example Yandex.Disk, because then creation time is time of copying this file from another machine
 
-    logfile_list = []
-
-    def check_logs_size():  # count size of all already existing logs and create a list of them
-        nonlocal logfile_list
-        total_size = 0
-
-        for root, subfolders, logfiles in os.walk('log'):  # Get name and creation time of every logfile
-            for logfile in logfiles:
-                # Get date and time as a string from file name
-                date_from_filename = re.search(r'(\d{4}-\d{2}-\d{2}__\d{2}h\d{2}m)', logfile).group()
-                # Covert string with date and time to timestamp
-                creation_time = time.mktime(datetime.strptime(date_from_filename, '%Y-%m-%d__%Hh%Mm').timetuple())
-                # creation_time = time.mktime(creation_time.timetuple())
-                path_to_logfile = os.path.join(root, logfile)
-                size_of_log = os.path.getsize(path_to_logfile)
-                logfile_list.append([path_to_logfile, creation_time, size_of_log])
-                total_size += size_of_log
-
-        log_file.info('There is {0:.02f} MB of logs.\n'.format(total_size / 1024**2))
-        return total_size
-
-    total_log_size = check_logs_size()
-
-    while total_log_size > max_size * 1024**2:
-        # if log files weighs more than max_size in megabytes - recursively remove oldest one one by one
-        logfile_to_delete = ''
-        oldest = time.time()
-
-        # recursively check all log files to find out the oldest one
-        for index, val in enumerate(logfile_list):  # enumerate to extract not only values, but their indexes also
-            if val[1] < oldest:  # if file older than previous one
-                oldest = val[1]
-                logfile_to_delete = val[0]
-                index_to_remove = index
-        log_file.info('Removing old log file: ' + logfile_to_delete + ', ' +
-                      str(datetime.fromtimestamp(oldest)))
-
-        send2trash.send2trash(logfile_to_delete)
-        # remove item from from list and subtract it's size from total size
-        total_log_size -= logfile_list[index_to_remove][2]
-        logfile_list.pop(index_to_remove)
+    logs = []  # heap of (creation time, path to log file, size of log file), the oldest log is on top
+    total_size = 0
+
+    with os.scandir(LOG_FOLDER) as entries:  # folder is listed only once
+        for entry in entries:
+            match = LOG_NAME_DATE.match(entry.name)
+            if not entry.is_file() or match is None:  # not a log of this program
+                continue
+            try:
+                creation_time = time.mktime(datetime.strptime(match.group(1), '%Y-%m-%d__%Hh%Mm').timetuple())
+            except ValueError:  # e.g. 13th month, not a log of this program either
+                continue
+            path_to_logfile = entry.path
+            if current_log_path is not None and os.path.samefile(path_to_logfile, current_log_path):
+                continue
+
+            if entry.name.endswith('.txt'):  # log of previous run that has not been compressed yet
+                try:
+                    compress_file(path_to_logfile, path_to_logfile + '.gz')
+                    path_to_logfile += '.gz'
+                except OSError as error:
+                    log_file.warning("Can't compress log file '%s': %s", path_to_logfile, error)
+
+            size_of_log = os.path.getsize(path_to_logfile)
+            logs.append((creation_time, path_to_logfile, size_of_log))
+            total_size += size_of_log
+
+    log_file.info('There is {0:.02f} MB of logs.\n'.format(total_size / 1024**2))
+
+    # heap gives the oldest log in O(log n), so removing k logs of n takes O(n + k log n)
+    heapq.heapify(logs)
+    oldest_allowed = time.time() - max_age_days * 24 * 3600 if max_age_days > 0 else 0
+    removed = 0
+    removed_size = 0
+    while logs and (logs[0][0] < oldest_allowed or total_size > max_size * 1024**2):
+        creation_time, logfile_to_delete, size_of_log = heapq.heappop(logs)
+        try:
+            os.remove(logfile_to_delete)
+        except OSError as error:
+            log_file.warning("Can't remove old log file '%s': %s", logfile_to_delete, error)
+        else:
+            log_file.debug('Removing old log file: %s, %s', logfile_to_delete, datetime.fromtimestamp(creation_time))
+            removed += 1
+            removed_size += size_of_log
+        total_size -= size_of_log
+
+    if removed:
+        log_file.info('%d old log file(s) (%.2f MB) were removed.', removed, removed_size / 1024**2)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+# This module measures where folder_sync spends its time.
+
+# Phases of sync (scanning, finding changes, comparing, copying, removing, storing snapshots) are timed
+# with phase(), and counters of system calls and bytes are added with add(). Counters are added once per
+# folder or per chunk of a file, not per byte, so measuring costs next to nothing.
+# At the end of run write_report() writes totals to a JSON file next to the log of the run, so runs can be
+# graphed over time. If trace is on, every phase is also written to a file of Chrome trace events
+# (open it in chrome://tracing or https://ui.perfetto.dev) to see phases and threads on a timeline.
+
+# In order to use it:
+# with metrics.phase('copy', folder=path):
+#     ...
+#     metrics.add('copy_file_range', number_of_calls)
+# metrics.write_report(path_to_log_file, {'compare': {...}})  # any extra statistics of the run
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+log_file = logging.getLogger('fs1')
+
+# options, folder_sync sets them from command line
+trace = False  # write trace events as well
+MAX_EVENTS = 100000  # trace events kept in memory, watch mode can run for days
+
+lock = threading.Lock()
+phases = {}  # keys are names of phases, values are [number of times phase ran, nanoseconds spent in it]
+counters = {}  # keys are names of counters, e.g. 'scandir' or 'bytes_written'
+events = []  # trace events, see phase()
+start_time_ns = time.perf_counter_ns()
+start_date = time.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def add(name, value=1):
+    # Add value to counter, safe to call from several threads
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+@contextlib.contextmanager
+def phase(name, **details):
+    # Time the code inside with statement. details are shown with the phase in trace.
+    phase_start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        phase_end = time.perf_counter_ns()
+        with lock:
+            total = phases.setdefault(name, [0, 0])
+            total[0] += 1
+            total[1] += phase_end - phase_start
+            if trace and len(events) < MAX_EVENTS:
+                # complete event, times are in microseconds from start of the program
+                events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                               'ts': (phase_start - start_time_ns) / 1000, 'dur': (phase_end - phase_start) / 1000,
+                               'args': details})
+
+
+def get_report(statistics=None):
+    with lock:
+        report = {
+            'date': start_date,
+            'seconds': (time.perf_counter_ns() - start_time_ns) / 10 ** 9,
+            'phases': {name: {'count': count, 'seconds': nanoseconds / 10 ** 9}
+                       for name, (count, nanoseconds) in sorted(phases.items())},
+            'counters': dict(sorted(counters.items())),
+        }
+    if statistics:
+        report.update(statistics)
+    return report
+
+
+def write_report(path_to_log_file, statistics=None):
+    # Write metrics of the run to '<log file>.metrics.json' and, if trace is on, trace to '<log file>.trace.json'.
+    # statistics is a dictionary of other figures of the run that are written to metrics as they are.
+    base_path = os.path.splitext(path_to_log_file)[0]
+    try:
+        with open(base_path + '.metrics.json', 'w', encoding='utf8') as file:
+            json.dump(get_report(statistics), file, indent=1)
+        if trace:
+            with lock:
+                trace_events = list(events)
+                counter_values = dict(counters)
+            # counters are shown as one more track of trace at the end of run
+            trace_events.append({'name': 'counters', 'ph': 'C', 'pid': os.getpid(), 'tid': 0,
+                                 'ts': (time.perf_counter_ns() - start_time_ns) / 1000, 'args': counter_values})
+            with open(base_path + '.trace.json', 'w', encoding='utf8') as file:
+                json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, file)
+    except OSError as error:
+        log_file.warning("Can't write metrics of the run: %s", error)
+        return
+    log_file.info('Metrics of the run were written to %s.metrics.json', base_path)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+# This module saves a sync plan to a file and loads it back for --plan and --apply modes of folder_sync.
+# Folders can be compared when nobody uses them, e.g. at night, and synced later without scanning them again:
+# apply only checks that files of every operation are still the same as they were when plan was made.
+
+# Plan file is JSON lines (compressed with gzip if its name ends with .gz), one object per line:
+# - header: paths and names of both folders, whether they were synced before and when they were scanned;
+# - "item" lines: snapshots of both folders when they were compared. After sync they are stored as snapshots
+#   of folders with results of operations, the same way sync_files() stores snapshots it has updated;
+# - "op" lines: operations in the order they are performed - "remove", "update" (replace older file with newer one)
+#   and "copy" (folder or file that doesn't exist in the other folder), "from" is folder of the source item,
+#   or folder the item is removed from. Operations carry size and time of modification of their source and of
+#   the file they replace, which are preconditions: an operation whose files have changed since plan was made
+#   is skipped, and the next sync sees the change as usual.
+
+import gzip
+import json
+import logging
+import os
+
+import scan_folder
+
+log_file = logging.getLogger('fs1')
+
+FORMAT = 'folder_sync plan'
+VERSION = 1
+SIDES = ('first', 'second')
+
+
+class Plan:
+    # Plan loaded from file: header, snapshots of both folders and operations
+
+    def __init__(self, header):
+        self.header = header
+        self.roots = (scan_folder.FolderRoot(header['first_folder'], header['root_first_folder']),
+                      scan_folder.FolderRoot(header['second_folder'], header['root_second_folder']))
+        self.snapshots = ({}, {})  # {path without root folder: SnapshotItem} of 1st and 2nd folders
+        self.operations = []  # dictionaries as they are in file
+
+
+def open_plan_file(path_to_plan, mode):
+    if path_to_plan.endswith('.gz'):
+        return gzip.open(path_to_plan, mode + 't', encoding='utf8')
+    return open(path_to_plan, mode, encoding='utf8')
+
+
+def dump(record):
+    # non-ASCII characters are escaped, because names that are not valid UTF-8 come with surrogates,
+    # which can't be written to UTF-8 file, and json.loads() restores them from escapes
+    return json.dumps(record, separators=(',', ':')) + '\n'
+
+
+def write_plan(path_to_plan, header, snap_a, snap_b, difference_between_folders):
+    # Write plan made by compare_snapshot() to file. header is dictionary with first_folder, second_folder,
+    # root_first_folder, root_second_folder and other information about folders that apply needs.
+    # Returns number of operations.
+    not_exist_in_a, not_exist_in_b, to_be_updated_from_b_to_a, to_be_updated_from_a_to_b, \
+        remove_from_a, remove_from_b = difference_between_folders[:6]
+    snapshots = (snap_a, snap_b)
+    roots = (header['first_folder'], header['second_folder'])
+    operations = 0
+
+    with open_plan_file(path_to_plan, 'w') as file:
+        file.write(dump(dict(header, format=FORMAT, version=VERSION)))
+        for side, snapshot in zip(SIDES, snapshots):
+            for item in snapshot.values():
+                file.write(dump({'item': side, 'path': item.path_wout_root, 'type': item.type, 'size': item.size,
+                                 'mtime_ns': item.mtime_ns, 'inode': item.inode}))
+
+        # the same order as sync_files() performs them
+        for side, items in zip(SIDES, (remove_from_a, remove_from_b)):
+            for item in items:
+                file.write(dump({'op': 'remove', 'from': side, 'path': item.path_wout_root, 'type': item.type,
+                                 'size': item.size, 'mtime_ns': item.mtime_ns}))
+                operations += 1
+        for index, updates in ((0, to_be_updated_from_a_to_b), (1, to_be_updated_from_b_to_a)):
+            for source_path, destination_path, size in updates:
+                path_wout_root = os.path.relpath(destination_path, roots[1 - index])
+                source = snapshots[index][path_wout_root]
+                destination = snapshots[1 - index][path_wout_root]
+                file.write(dump({'op': 'update', 'from': SIDES[index], 'path': path_wout_root,
+                                 'size': source.size, 'mtime_ns': source.mtime_ns,
+                                 'old_size': destination.size, 'old_mtime_ns': destination.mtime_ns}))
+                operations += 1
+        for side, items in (('second', not_exist_in_a), ('first', not_exist_in_b)):
+            for item in items:
+                file.write(dump({'op': 'copy', 'from': side, 'path': item.path_wout_root, 'type': item.type,
+                                 'size': item.size, 'mtime_ns': item.mtime_ns}))
+                operations += 1
+    return operations
+
+
+def read_plan(path_to_plan):
+    # Load plan from file. Raises ValueError if it is not a plan or it was made by another version of format.
+    with open_plan_file(path_to_plan, 'r') as file:
+        try:
+            header = json.loads(file.readline())
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get('format') != FORMAT:
+            raise ValueError("'{}' is not a plan of folder_sync".format(path_to_plan))
+        if header.get('version') != VERSION:
+            raise ValueError("Plan '{}' has version {} of format, but only version {} is supported".format(
+                path_to_plan, header.get('version'), VERSION))
+
+        plan = Plan(header)
+        for line in file:
+            record = json.loads(line)
+            if 'item' in record:
+                index = SIDES.index(record['item'])
+                plan.snapshots[index][record['path']] = scan_folder.SnapshotItem(
+                    record['type'], record['path'], record['size'], record['mtime_ns'], record['inode'],
+                    plan.roots[index])
+            else:
+                plan.operations.append(record)
+    return plan
+
+
+def is_unchanged(full_path, item_type, size, mtime_ns):
+    # Check precondition: item is still the same as it was when plan was made.
+    # Folders are compared by time of modification too, it changes when something is added to folder or removed.
+    try:
+        item_stat = os.stat(full_path)
+    except OSError:
+        return False
+    if item_type == 'folder':
+        return os.path.isdir(full_path) and item_stat.st_mtime_ns == mtime_ns
+    return (not os.path.isdir(full_path) and item_stat.st_size == size and item_stat.st_mtime_ns == mtime_ns)
+
+
+def check_operation(plan, operation):
+    # Returns None if preconditions of operation hold, or why it can't be performed
+    index = SIDES.index(operation['from'])
+    path_wout_root = operation['path']
+    source = os.path.join(plan.roots[index].path, path_wout_root)
+    destination = os.path.join(plan.roots[1 - index].path, path_wout_root)
+
+    if operation['op'] == 'remove':
+        # item that has been removed by user already is fine, sync_files() counts it as removed
+        if os.path.lexists(source) and not is_unchanged(source, operation['type'], operation['size'],
+                                                         operation['mtime_ns']):
+            return 'it has changed'
+    elif operation['op'] == 'update':
+        if not is_unchanged(source, 'file', operation['size'], operation['mtime_ns']):
+            return 'newer version has changed'
+        if not is_unchanged(destination, 'file', operation['old_size'], operation['old_mtime_ns']):
+            return 'version to be replaced has changed'
+    elif operation['op'] == 'copy':
+        # time of modification of folder changes when its content is copied, only its presence matters
+        if operation['type'] == 'folder':
+            if not os.path.isdir(source):
+                return 'it has been removed'
+        elif not is_unchanged(source, 'file', operation['size'], operation['mtime_ns']):
+            return 'it has changed'
+        if os.path.lexists(destination):
+            return 'it already exists in the other folder'
+    else:
+        return 'unknown operation {!r}'.format(operation['op'])
+    return None
+
+
+def check_operations(plan):
+    # Split operations into ones whose preconditions hold and skipped ones with reasons:
+    # returns (list of operations, list of (operation, reason)).
+    # A folder is not removed if anything inside it is skipped, and content of a folder that is not copied
+    # is not copied either.
+    skipped = []
+    blocked_folders = (set(), set())  # folders that must stay as they are in 1st and 2nd folders
+    not_copied = (set(), set())  # folders of 1st and 2nd folders that are not copied
+
+    checked = []
+    for operation in plan.operations:
+        reason = check_operation(plan, operation)
+        if reason is not None:
+            skipped.append((operation, reason))
+            index = SIDES.index(operation['from'])
+            # every folder on the way to skipped item stays, because removing it would remove the item too
+            parent = os.path.dirname(operation['path'])
+            while parent:
+                blocked_folders[index].add(parent)
+                parent = os.path.dirname(parent)
+            # content of folder is not copied, unless the folder has been created in the other folder already
+            if operation['op'] == 'copy' and operation['type'] == 'folder' and not os.path.isdir(
+                    os.path.join(plan.roots[1 - index].path, operation['path'])):
+                not_copied[index].add(operation['path'])
+        else:
+            checked.append(operation)
+
+    operations = []
+    for operation in checked:
+        index = SIDES.index(operation['from'])
+        if operation['op'] == 'remove' and operation['path'] in blocked_folders[index]:
+            skipped.append((operation, 'something inside it has changed'))
+            continue
+        if operation['op'] == 'copy':
+            parent = os.path.dirname(operation['path'])
+            while parent and parent not in not_copied[index]:
+                parent = os.path.dirname(parent)
+            if parent:
+                not_copied[index].add(operation['path'])
+                skipped.append((operation, 'its folder is not copied'))
+                continue
+        operations.append(operation)
+    return operations, skipped
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+# This module shows progress of long operations of folder_sync.
+
+# A line printed and logged for every file makes terminal and log the bottleneck on folders with millions
+# of files. So by default there is one line of progress that is redrawn at most a few times per second:
+# how many items are done, how fast and how much time is left. Lines about every file are printed only
+# in verbose mode and are logged at DEBUG level, which is written to log only in verbose mode too.
+
+# In order to use it:
+# with progress.Progress('Comparing files', total=len(pairs)) as bar:
+#     for pair in pairs:
+#         ...
+#         progress.detail('Content of {} is equal.'.format(path))
+#         bar.update(size=size_of_pair)
+# Messages that should be seen in any mode (e.g. warnings) are printed with progress.echo().
+
+import logging
+import sys
+import time
+
+log_file = logging.getLogger('fs1')
+
+# options, folder_sync sets them from command line
+verbose = False  # print a line for every file instead of progress line
+interval = 0.5  # seconds between redraws of progress line in terminal
+interval_not_tty = 10  # the same when output is redirected to file, every redraw is a new line there
+
+current = None  # Progress that is shown right now, its line is cleared before other messages are printed
+
+
+def detail(message):
+    # Message about one file: printed only in verbose mode and logged only if DEBUG messages are logged
+    if verbose:
+        print(message)
+    log_file.debug(message)
+
+
+def echo(message):
+    # Print message so that it doesn't mix with progress line, which is redrawn below it later
+    if current is not None:
+        current.clear()
+    print(message)
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02}:{:02}'.format(hours, minutes, seconds)
+
+
+class Progress:
+    # One line of progress: number of items done out of total, items and megabytes per second and ETA.
+    # total and size are optional, ETA is shown only when total is known.
+
+    def __init__(self, title, total=None):
+        global current
+        current = self
+        self.title = title
+        self.total = total
+        self.done = 0
+        self.size = 0  # bytes processed
+        self.start_time = time.monotonic()
+        self.last_draw = self.start_time
+        self.line_length = 0  # length of progress line in terminal, 0 if there is no line to clear
+        self.is_tty = sys.stdout.isatty()
+        self.interval = interval if self.is_tty else interval_not_tty
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def update(self, count=1, size=0):
+        # Count items that are done. Cheap enough to call for every file: time is checked, but nothing is printed
+        # until interval has passed since last redraw.
+        self.done += count
+        self.size += size
+        now = time.monotonic()
+        if now - self.last_draw >= self.interval and not verbose:
+            self.last_draw = now
+            self.draw(now)
+
+    def get_line(self, now):
+        elapsed = max(now - self.start_time, 1e-6)
+        speed = self.done / elapsed
+        if self.total:
+            line = '{}: {}/{} ({:.0%})'.format(self.title, self.done, self.total, self.done / self.total)
+        else:
+            line = '{}: {}'.format(self.title, self.done)
+        line += ', {:.0f} items/s'.format(speed)
+        if self.size:
+            line += ', {:.2f} MB/s'.format(self.size / 1024 ** 2 / elapsed)
+        if self.total and self.done and self.done < self.total:
+            line += ', {} left'.format(format_seconds((self.total - self.done) / speed))
+        return line
+
+    def draw(self, now):
+        line = self.get_line(now)
+        if self.is_tty:
+            # carriage return puts new line over the old one, spaces wipe the rest of a longer old line
+            sys.stdout.write('\r' + line.ljust(self.line_length))
+            sys.stdout.flush()
+            self.line_length = len(line)
+        else:
+            print(line)
+
+    def clear(self):
+        if self.line_length:
+            sys.stdout.write('\r' + ' ' * self.line_length + '\r')
+            self.line_length = 0
+
+    def close(self):
+        # Remove progress line and log how long it took
+        global current
+        self.clear()
+        if current is self:
+            current = None
+        if self.done:
+            elapsed = time.monotonic() - self.start_time
+            log_file.info('%s: %d item(s) in %.3f seconds.', self.title, self.done, elapsed)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# This module removes files and folders for folder_sync.
+
+# Snapshot lists every item inside a removed folder as well as the folder itself, but only the folder
+# has to be removed: everything inside goes with it. collapse() leaves only top-most removed items, and
+# they are removed in batches: one call of send2trash for many paths (on Windows it is one shell operation),
+# or os.remove()/shutil.rmtree() in permanent mode for backup folders where trash is not wanted.
+
+import logging
+import os
+import shutil
+
+import send2trash
+
+import metrics
+
+log_file = logging.getLogger('fs1')
+
+# options, folder_sync sets them from command line
+permanent = False  # remove items permanently instead of sending them to trash
+batch_size = 256  # number of paths sent to trash by one call
+
+
+class RemovalGroup:
+    # Top-most removed item and all snapshot items inside it (including the top item itself)
+    __slots__ = ('top', 'items')
+
+    def __init__(self, top):
+        self.top = top
+        self.items = [top]
+
+    @property
+    def size(self):
+        # size of files that go with this group
+        return sum(item.size for item in self.items if item.type == 'file')
+
+
+def collapse(items):
+    # Group snapshot items by top-most removed folder they are inside of.
+    # Returns list of RemovalGroup in order of paths, so parent folders come before their content.
+    groups = {}  # keys are paths without root folder of top items
+    for item in sorted(items, key=lambda item: item.path_wout_root):
+        parent = os.path.dirname(item.path_wout_root)
+        while parent and parent not in groups:
+            parent = os.path.dirname(parent)
+        if parent:
+            groups[parent].items.append(item)
+        else:
+            groups[item.path_wout_root] = RemovalGroup(item)
+    return list(groups.values())
+
+
+def remove_path(path):
+    # Remove one file or folder with everything inside
+    if not permanent:
+        metrics.add('send2trash')
+        send2trash.send2trash(path)
+    elif os.path.isdir(path) and not os.path.islink(path):
+        metrics.add('rmtree')
+        shutil.rmtree(path)
+    else:
+        metrics.add('remove')
+        os.remove(path)
+
+
+def remove_paths(paths):
+    # Remove several files and folders. Raises OSError if any of them could not be removed,
+    # some of paths may have been removed by then.
+    if not permanent:
+        metrics.add('send2trash')
+        send2trash.send2trash(paths)
+    else:
+        for path in paths:
+            remove_path(path)
+
+
+def remove_groups(groups):
+    # Remove top items of groups in batches. Yields (group, None) for every removed group and
+    # (group, exception) for groups that could not be removed, so caller can deal with them one by one.
+    for start in range(0, len(groups), batch_size):
+        batch = groups[start:start + batch_size]
+        try:
+            remove_paths([group.top.full_path for group in batch])
+        except OSError as error:
+            log_file.debug('Batch of %d item(s) was not removed at once: %s', len(batch), error)
+            # some of batch may have been removed already, the rest is removed one by one
+            for group in batch:
+                if not os.path.lexists(group.top.full_path):
+                    yield group, None
+                    continue
+                try:
+                    remove_path(group.top.full_path)
+                except OSError as error:
+                    yield group, error
+                else:
+                    yield group, None
+        else:
+            for group in batch:
+                yield group, None
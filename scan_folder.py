@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+
+# This module walks through a folder with os.scandir and collects information
+# about every file and subfolder inside it in a single pass.
+
+# os.walk() already calls os.scandir() under the hood, but after that
+# folder_sync used to call os.path.getsize() and os.path.getmtime() for every file,
+# which means two more system calls per file. DirEntry knows type of the entry
+# from the directory listing and caches result of its stat() call, so here
+# size, time of modification and inode of every item are taken from one stat().
+
+# Time of modification of a folder changes only when something is created, removed or renamed right inside it.
+# If previous snapshot is given and a folder has the same time of modification as it had then, the folder is not
+# listed: its items are taken from previous snapshot and only files are stat'ed to find out whether
+# they were modified (or not even that if time of modification of folders is trusted completely).
+
+import hashlib
+import logging
+import os
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+log_file = logging.getLogger('fs1')
+
+SNAPSHOT_FOLDER = '.folderSyncSnapshot'  # folder where folder_sync keeps its own data, never scanned
+# Folders modified this close to the time when previous snapshot was taken are listed anyway,
+# because something could have been added in the same tick of file system clock right after they were scanned.
+# Two seconds is resolution of FAT.
+RACY_INTERVAL_NS = 2 * 10 ** 9
+
+
+class FolderRoot:
+    # Folder that user chose to sync. One object is shared by all items of a snapshot,
+    # so items keep only their own path without root folder and build full paths on demand.
+    __slots__ = ('path', 'name')
+
+    def __init__(self, path, name):
+        self.path = path  # full path to the folder
+        self.name = name  # name of the folder itself, e.g. 'photos' for 'D:\backup\photos'
+
+
+class SnapshotItem:
+    # File or folder in a snapshot. __slots__ saves memory on millions of items:
+    # there is no __dict__ per object and only one path string is stored.
+    __slots__ = ('type', 'path_wout_root', 'size', 'mtime_ns', 'inode', 'root')
+
+    def __init__(self, item_type, path_wout_root, size, mtime_ns, inode, root):
+        self.type = item_type  # 'file' or 'folder'
+        self.path_wout_root = path_wout_root  # path inside root folder, the same for both synced folders
+        self.size = size  # size in bytes, 0 for folders
+        self.mtime_ns = mtime_ns  # time of modification in nanoseconds
+        self.inode = inode
+        self.root = root  # FolderRoot this item belongs to
+
+    @property
+    def full_path(self):
+        return os.path.join(self.root.path, self.path_wout_root)
+
+    @property
+    def path_with_root(self):
+        return os.path.join(self.root.name, self.path_wout_root)
+
+    @property
+    def mtime(self):
+        # time of modification in seconds rounded up, because nanoseconds are too precise for our purpose
+        return -(-self.mtime_ns // 10 ** 9)
+
+    def __repr__(self):
+        return 'SnapshotItem({!r}, {!r}, {}, {})'.format(self.type, self.path_wout_root, self.size, self.mtime_ns)
+
+
+class FolderTree:
+    # Items of snapshot {path without root folder: SnapshotItem} grouped by folder they are in,
+    # with Merkle-style digest of every folder: hash of names, sizes and times of modification of its files
+    # and of digests of its subfolders. Equal digests of the same folder in two snapshots mean that everything
+    # inside it is equal, so there is no need to look inside. Time of modification of folders themselves
+    # is not part of digest, because it differs in every copy of a folder. Root folder has path ''.
+
+    def __init__(self, snapshot):
+        self.children = {'': []}  # items right inside every folder, sorted by path
+        for path, item in snapshot.items():
+            if item.type == 'folder':
+                self.children.setdefault(path, [])
+            self.children.setdefault(os.path.dirname(path), []).append(item)
+
+        self.digests = {}
+        self.totals = {}  # [number of files, number of folders, size of files] with everything inside every folder
+        # the deepest folders go first, so subfolders are done when their parent is hashed
+        for folder in sorted(self.children, key=lambda path: path.count(os.sep) + bool(path), reverse=True):
+            items = self.children[folder]
+            items.sort(key=lambda item: item.path_wout_root)
+            digest = hashlib.blake2b(digest_size=16)
+            totals = [0, 0, 0]
+            for item in items:
+                name = os.path.basename(item.path_wout_root).encode('utf-8', 'surrogateescape')
+                if item.type == 'folder':
+                    digest.update(b'd%d:%s' % (len(name), name) + self.digests[item.path_wout_root])
+                    files, folders, size = self.totals[item.path_wout_root]
+                    totals[0] += files
+                    totals[1] += folders + 1
+                    totals[2] += size
+                else:
+                    digest.update(b'f%d:%s%d:%d;' % (len(name), name, item.size, item.mtime_ns))
+                    totals[0] += 1
+                    totals[2] += item.size
+            self.digests[folder] = digest.digest()
+            self.totals[folder] = totals
+
+    def identical_folders(self, other):
+        # Topmost folders whose digests are equal in both trees. Tree is walked from root folder down,
+        # and folders inside identical ones are not visited, so equal root means a single comparison.
+        identical = set()
+        folders = ['']
+        while folders:
+            folder = folders.pop()
+            if other.digests.get(folder) == self.digests[folder]:
+                identical.add(folder)
+                continue
+            folders.extend(item.path_wout_root for item in self.children[folder] if item.type == 'folder')
+        return identical
+
+    def walk(self, skip=()):
+        # Yield items folder by folder, every folder goes right before its content.
+        # Content of folders from skip is not yielded, the folders themselves are.
+        stack = [iter(self.children[''])] if '' not in skip else []
+        while stack:
+            item = next(stack[-1], None)
+            if item is None:
+                stack.pop()
+                continue
+            yield item
+            if item.type == 'folder' and item.path_wout_root not in skip:
+                stack.append(iter(self.children[item.path_wout_root]))
+
+
+def item_from_list(record, root):
+    # Convert item of snapshot stored by old versions of folder_sync, which looked like
+    # ['file', [full_path, root_folder, path_with_root, path_wout_root], size, mtime] or
+    # ['folder', [full_path, root_folder, path_with_root, path_wout_root]]
+    if record[0] == 'file':
+        return SnapshotItem('file', record[1][3], record[2], record[3] * 10 ** 9, 0, root)
+    return SnapshotItem('folder', record[1][3], 0, 0, 0, root)
+
+
+class PreviousScan:
+    # Previous snapshot of folder, so folders that have not changed since then don't have to be listed again.
+    # Only times of modification of folders are kept in memory, items of unchanged folders are read
+    # from snapshot_store.SnapshotStore folder by folder when they are needed.
+
+    def __init__(self, store, root_mtime_ns, scan_time_ns, trust_mtime=False):
+        # store is snapshot_store.SnapshotStore with previous snapshot, root_mtime_ns is time of modification
+        # of root folder and scan_time_ns is time when previous snapshot was taken
+        self.store = store
+        self.folder_mtimes = store.folder_mtimes()  # keys are paths without root folder of folders
+        self.folder_mtimes[''] = root_mtime_ns
+        self.not_after_ns = scan_time_ns - RACY_INTERVAL_NS
+        self.trust_mtime = trust_mtime  # take files of unchanged folders from previous snapshot without stat()
+        self.pruned = 0  # folders whose items were taken from previous snapshot
+        self.listed = 0  # folders that were listed
+        self.lock = threading.Lock()
+
+    def get_children(self, path_wout_root):
+        # Items right inside folder in previous snapshot as tuples like scan_one_folder() gives
+        with self.lock:  # the same database connection is used by all threads of scan
+            return [(item.type, item.path_wout_root, item.size, item.mtime_ns, item.inode)
+                    for item in self.store.iter_children(path_wout_root)]
+
+    def is_unchanged(self, path_wout_root, mtime_ns):
+        return mtime_ns == self.folder_mtimes.get(path_wout_root) and mtime_ns < self.not_after_ns
+
+    def count(self, pruned):
+        with self.lock:
+            if pruned:
+                self.pruned += 1
+            else:
+                self.listed += 1
+
+
+def reuse_one_folder(current_folder, current_path_wout_root, previous):
+    # The same as scan_one_folder(), but items of folder are taken from previous snapshot
+    folders = []
+    files = []
+    subfolders_to_scan = []
+
+    for item in previous.get_children(current_path_wout_root):
+        item_type, path_wout_root = item[0], item[1]
+        full_path = os.path.join(current_folder, os.path.basename(path_wout_root))
+        try:
+            if item_type == 'folder':
+                # time of modification of every subfolder is needed anyway to find out whether to list it
+                folder_stat = os.lstat(full_path)
+                if stat.S_ISLNK(folder_stat.st_mode):
+                    folders.append(('folder', path_wout_root, 0, os.stat(full_path).st_mtime_ns, folder_stat.st_ino))
+                else:
+                    folders.append(('folder', path_wout_root, 0, folder_stat.st_mtime_ns, folder_stat.st_ino))
+                    subfolders_to_scan.append((full_path, path_wout_root, folder_stat.st_mtime_ns))
+            elif previous.trust_mtime:
+                files.append(item)
+            else:
+                file_stat = os.stat(full_path)
+                files.append(('file', path_wout_root, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino))
+        except OSError:
+            # removed right now, after time of modification of its folder was checked
+            log_file.warning("Can't get information about '%s', skip it.", full_path)
+
+    metrics.add('stat', len(folders) + (0 if previous.trust_mtime else len(files)))
+    folders.extend(files)
+    return folders, subfolders_to_scan
+
+
+def scan_one_folder(current_folder, current_path_wout_root, mtime_ns=None, previous=None):
+    # List one folder and return two lists: items in it as tuples
+    # (type of item, path without root folder, size, time of modification in nanoseconds, inode)
+    # where type of item is 'file' or 'folder' (size of folders is 0),
+    # and subfolders to descend into as tuples (full path, path without root folder, time of modification).
+    # Subfolders go before files in the first list, the same way os.walk() gives them.
+    # If previous is PreviousScan and folder has not changed since then (mtime_ns is its current time
+    # of modification), items are taken from previous snapshot instead of listing the folder.
+
+    if previous is not None:
+        pruned = mtime_ns is not None and previous.is_unchanged(current_path_wout_root, mtime_ns)
+        previous.count(pruned)
+        if pruned:
+            return reuse_one_folder(current_folder, current_path_wout_root, previous)
+
+    folders = []
+    files = []
+    subfolders_to_scan = []
+
+    try:
+        with os.scandir(current_folder) as entries:
+            for entry in entries:
+                if current_path_wout_root:
+                    path_wout_root = os.path.join(current_path_wout_root, entry.name)
+                else:
+                    path_wout_root = entry.name
+
+                try:
+                    if entry.is_dir():
+                        if entry.name == SNAPSHOT_FOLDER:
+                            continue
+                        folder_mtime_ns = entry.stat().st_mtime_ns
+                        folders.append(('folder', path_wout_root, 0, folder_mtime_ns, entry.inode()))
+                        # do not descend into symlinks to folders, os.walk() doesn't do it either
+                        if not entry.is_symlink():
+                            subfolders_to_scan.append((entry.path, path_wout_root, folder_mtime_ns))
+                    elif not entry.name.startswith('~$'):  # skip temporary files of MS Office
+                        entry_stat = entry.stat()  # cached by DirEntry, the only stat() for this file
+                        files.append(('file', path_wout_root, entry_stat.st_size, entry_stat.st_mtime_ns,
+                                      entry_stat.st_ino))
+                except OSError:
+                    # e.g. broken symlink or file that was removed right after listing
+                    log_file.warning("Can't get information about '%s', skip it.", entry.path)
+    except OSError:
+        # os.walk() silently skips folders it can't list, do the same but leave a trace in log
+        log_file.warning("Can't scan '%s', skip it.", current_folder)
+
+    metrics.add('scandir')
+    metrics.add('stat', len(folders) + len(files))
+    folders.extend(files)
+    return folders, subfolders_to_scan
+
+
+def scan_folder(path_to_root_folder, workers=1, path_wout_root='', previous=None):
+    # Recursively scan given folder and yield one tuple per item, see scan_one_folder().
+    # If only a subfolder of root folder is scanned, path_wout_root is its path without root folder,
+    # so paths of items are relative to root folder as usual.
+    # previous is PreviousScan if folders that have not changed since previous snapshot should not be listed.
+    # Items are yielded in the same order as os.walk() gives them: subfolders and files of
+    # a folder first, then content of every subfolder - so a folder always goes before its content.
+    # With more than one worker folders are listed in a thread pool, which helps a lot
+    # on network drives where every listing waits for the server, but the order stays the same.
+
+    mtime_ns = os.stat(path_to_root_folder).st_mtime_ns if previous is not None else None
+
+    if workers > 1:
+        yield from _scan_folder_in_parallel(path_to_root_folder, workers, path_wout_root, mtime_ns, previous)
+        return
+
+    # stack of folders to scan: (full path, path without root folder, time of modification)
+    folders_to_scan = [(path_to_root_folder, path_wout_root, mtime_ns)]
+
+    while folders_to_scan:
+        items, subfolders_to_scan = scan_one_folder(*folders_to_scan.pop(), previous=previous)
+        yield from items
+        folders_to_scan.extend(reversed(subfolders_to_scan))
+
+
+def scan_folder_sorted(path_to_root_folder, skip_folder=None):
+    # Scan folder and yield the same tuples as scan_folder(), but in order of their paths, the same order
+    # sorted() gives for strings and SQLite gives for stored snapshots, so two folders and their stored snapshots
+    # can be joined item by item without keeping snapshots in memory.
+    # skip_folder(path without root folder) is asked right before a subfolder is listed, e.g. it may have
+    # been removed after it was yielded.
+    # Content of folder 'a' goes after its sibling 'a b', because os.sep is greater than space,
+    # so content of every subfolder is scanned when its place comes, as if its name ended with os.sep.
+    # Only listings of folders on the way to the current item are kept in memory.
+
+    # stack of (sort key, item to yield or None, subfolder to scan or None), the smallest key is on top
+    stack = []
+
+    def list_folder(current_folder, current_path_wout_root):
+        items, subfolders_to_scan = scan_one_folder(current_folder, current_path_wout_root)
+        entries = [(item[1], item, None) for item in items]
+        entries.extend((path_wout_root + os.sep, None, (full_path, path_wout_root))
+                       for full_path, path_wout_root, mtime_ns in subfolders_to_scan)
+        entries.sort(key=lambda entry: entry[0], reverse=True)
+        stack.extend(entries)
+
+    list_folder(path_to_root_folder, '')
+    while stack:
+        key, item, subfolder = stack.pop()
+        if item is not None:
+            yield item
+        elif skip_folder is None or not skip_folder(subfolder[1]):
+            list_folder(*subfolder)
+
+
+def _scan_folder_in_parallel(path_to_root_folder, workers, path_wout_root, mtime_ns, previous):
+    # Every worker lists one folder and right away schedules its subfolders, so idle workers
+    # pick up any folder that is waiting in the shared queue of the pool no matter
+    # which part of the tree it belongs to. Results are read back in the order of the serial scan.
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scan')
+
+    def scan_and_schedule(current_folder, current_path_wout_root, current_mtime_ns):
+        items, subfolders_to_scan = scan_one_folder(current_folder, current_path_wout_root, current_mtime_ns,
+                                                    previous)
+        return items, [executor.submit(scan_and_schedule, *subfolder) for subfolder in subfolders_to_scan]
+
+    try:
+        folders_to_read = [executor.submit(scan_and_schedule, path_to_root_folder, path_wout_root, mtime_ns)]
+        while folders_to_read:
+            items, subfolders_to_read = folders_to_read.pop().result()
+            yield from items
+            folders_to_read.extend(reversed(subfolders_to_read))
+    finally:
+        # if scan was interrupted don't list folders nobody is going to read
+        executor.shutdown(wait=True, cancel_futures=True)
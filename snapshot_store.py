@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+# This module stores snapshot of a folder in SQLite database inside .folderSyncSnapshot folder.
+# Every file and subfolder is a separate row indexed by its path without root folder, so
+# folder_sync can read previous snapshot row by row in order of paths or look up single items,
+# and never has to load the whole snapshot into memory like it used to do with shelve.
+
+# In order to use it:
+# with snapshot_store.open_store(path_to_folder, root_folder) as store:
+#     for item in store.iter_items(): ...
+# open_store() also imports snapshot stored by old versions of folder_sync with shelve.
+
+import dbm
+import logging
+import os
+import shelve
+import sqlite3
+
+import scan_folder
+
+log_file = logging.getLogger('fs1')
+
+DATABASE_NAME = 'snapshot.sqlite3'
+SHELVE_NAME = 'snapshot'  # name of shelve file used by old versions of folder_sync
+SCHEMA_VERSION = 2  # stored in user_version of database, 0 - paths were stored as TEXT, 1 - digests were stored
+
+# Paths are stored as UTF-8 BLOBs (see encode_path()), because names that are not valid UTF-8 can't be TEXT
+ITEMS_TABLE = '''
+CREATE TABLE IF NOT EXISTS {} (
+    path BLOB PRIMARY KEY,  -- path without root folder
+    type TEXT NOT NULL,  -- 'file' or 'folder'
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL
+) WITHOUT ROWID;
+'''
+SCHEMA = ITEMS_TABLE.format('items') + '''
+CREATE TABLE IF NOT EXISTS info (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS not_removed (  -- items that program could not remove last time
+    path BLOB PRIMARY KEY
+);
+'''
+
+
+def encode_path(path):
+    # os.scandir() gives names that are not valid UTF-8 with surrogates instead of bad bytes (surrogateescape),
+    # and sqlite3 can't bind such str. 'surrogatepass' keeps surrogates, and UTF-8 bytes sort the same way
+    # as str do, so snapshot is still read in the order scan_folder.scan_folder_sorted() gives.
+    return path.encode('utf-8', 'surrogatepass')
+
+
+def decode_path(path):
+    return path.decode('utf-8', 'surrogatepass')
+
+
+class SnapshotStore:
+    # Snapshot of one folder in SQLite database. Items are returned as scan_folder.SnapshotItem
+    # that belong to the given root, so they look exactly like items from a fresh snapshot.
+
+    def __init__(self, path_to_folder, root_folder):
+        self.root = scan_folder.FolderRoot(path_to_folder, root_folder)
+        self.path_to_database = get_path_to_database(path_to_folder)
+        # scan_folder.PreviousScan reads items from threads of parallel scan, it doesn't do it at the same time
+        self.connection = sqlite3.connect(self.path_to_database, check_same_thread=False)
+        # Default rollback journal with full sync: folder is often on a network drive where WAL doesn't work,
+        # and stored snapshot decides what is removed next time, so the last one must survive power loss.
+        # Stores left in WAL mode by previous versions are switched back.
+        self.connection.execute('PRAGMA journal_mode=DELETE')
+        self.connection.executescript(SCHEMA)
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            with self.connection:
+                # UTF-8 bytes of TEXT are exactly what encode_path() gives for valid names
+                for table in ('items', 'not_removed'):
+                    self.connection.execute("UPDATE {} SET path = CAST(path AS BLOB) WHERE typeof(path) = 'text'"
+                                            .format(table))
+                # digests of folders are computed from both current snapshots, stored ones were never needed
+                self.connection.execute('DROP TABLE IF EXISTS digests')
+                self.connection.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def _make_item(self, row):
+        path, item_type, size, mtime_ns, inode = row
+        return scan_folder.SnapshotItem(item_type, decode_path(path), size, mtime_ns, inode, self.root)
+
+    def get_info(self, key):
+        # Get one of values stored with snapshot, e.g. 'date' or 'path'. Returns None if there is no such key.
+        row = self.connection.execute('SELECT value FROM info WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def get_item(self, path_wout_root):
+        # Look up one item by its path without root folder. Returns None if there is no such item.
+        row = self.connection.execute('SELECT path, type, size, mtime_ns, inode FROM items WHERE path = ?',
+                                      (encode_path(path_wout_root),)).fetchone()
+        return self._make_item(row) if row else None
+
+    def iter_items(self):
+        # Yield all items ordered by path. Rows are read from database one by one.
+        # SQLite compares BLOBs with memcmp(), which gives the same order as sorted() gives for str.
+        cursor = self.connection.execute('SELECT path, type, size, mtime_ns, inode FROM items ORDER BY path')
+        for row in cursor:
+            yield self._make_item(row)
+
+    def iter_children(self, path_wout_root):
+        # Yield items right inside folder ('' for root folder) ordered by path. Rows deeper inside are not read:
+        # when the next row is inside a subfolder, reading starts again after everything inside it.
+        prefix = encode_path(path_wout_root + os.sep) if path_wout_root else b''
+        sep = encode_path(os.sep)
+        next_byte = bytes([sep[0] + 1])  # paths inside a folder sort from 'folder/' up to 'folder0'
+        start = prefix
+        while True:
+            if prefix:
+                cursor = self.connection.execute('SELECT path, type, size, mtime_ns, inode FROM items '
+                                                 'WHERE path >= ? AND path < ? ORDER BY path',
+                                                 (start, prefix[:-1] + next_byte))
+            else:
+                cursor = self.connection.execute('SELECT path, type, size, mtime_ns, inode FROM items '
+                                                 'WHERE path >= ? ORDER BY path', (start,))
+            for row in cursor:
+                depth = row[0].find(sep, len(prefix))
+                if depth >= 0:  # inside subfolder that has been yielded already
+                    start = row[0][:depth] + next_byte
+                    cursor.close()
+                    break
+                yield self._make_item(row)
+            else:
+                return
+
+    def folder_mtimes(self):
+        # Times of modification of all folders {path without root folder: mtime_ns}
+        return {decode_path(path): mtime_ns for path, mtime_ns in
+                self.connection.execute("SELECT path, mtime_ns FROM items WHERE type = 'folder'")}
+
+    def count_items(self):
+        return self.connection.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+
+    def not_removed_paths(self):
+        # Paths of items that program could not remove last time
+        cursor = self.connection.execute('SELECT path FROM not_removed ORDER BY path')
+        return [decode_path(row[0]) for row in cursor]
+
+    def write_snapshot(self, items, store_date, not_removed_paths=(), info=None):
+        # Replace stored snapshot with given items in one transaction.
+        # items is any iterable of SnapshotItem, it is consumed lazily.
+        # info is dictionary of other values to store with snapshot, see get_info().
+        rows = ((encode_path(item.path_wout_root), item.type, item.size, item.mtime_ns, item.inode)
+                for item in items)
+        with self.connection:
+            self.connection.execute('DELETE FROM items')
+            self.connection.execute('DELETE FROM not_removed')
+            self.connection.executemany('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?)', rows)
+            self.connection.executemany('INSERT OR IGNORE INTO not_removed VALUES (?)',
+                                        ((encode_path(path),) for path in not_removed_paths))
+            self.connection.executemany('INSERT OR REPLACE INTO info VALUES (?, ?)',
+                                        [('path', encode_path(self.root.path)), ('date', store_date)])
+            if info:
+                self.connection.executemany('INSERT OR REPLACE INTO info VALUES (?, ?)', info.items())
+
+    def update_items(self, items, removed_paths, store_date, not_removed_paths=()):
+        # Change stored snapshot in one transaction instead of writing it again: items (SnapshotItem) are inserted
+        # or replaced, and items at removed_paths are deleted with everything inside them.
+        # not_removed_paths are added to paths that were not removed, and other paths of changed items
+        # are taken out of there, because they have been handled. items should be a list.
+        not_removed_paths = {encode_path(path) for path in not_removed_paths}
+        changed_paths = [encode_path(item.path_wout_root) for item in items] + \
+            [encode_path(path) for path in removed_paths]
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?)',
+                                        ((encode_path(item.path_wout_root), item.type, item.size, item.mtime_ns,
+                                          item.inode) for item in items))
+            for path in removed_paths:
+                # paths inside a folder sort from 'folder/' up to 'folder0', because '0' is the byte after '/'
+                inside = encode_path(path + os.sep)
+                self.connection.execute('DELETE FROM items WHERE path = ? OR (path >= ? AND path < ?)',
+                                        (encode_path(path), inside, inside[:-1] + bytes([inside[-1] + 1])))
+            self.connection.executemany('DELETE FROM not_removed WHERE path = ?',
+                                        ((path,) for path in changed_paths if path not in not_removed_paths))
+            self.connection.executemany('INSERT OR IGNORE INTO not_removed VALUES (?)',
+                                        ((path,) for path in not_removed_paths))
+            self.connection.execute("INSERT OR REPLACE INTO info VALUES ('date', ?)", (store_date,))
+
+    def start_new_snapshot(self):
+        # Start writing new snapshot item by item with add_item(), while stored snapshot can still be read
+        # with iter_items(). Items go to a separate table, and finish_new_snapshot() puts it instead of stored one.
+        self.connection.execute('DROP TABLE IF EXISTS items_new')  # left by interrupted run
+        self.connection.execute(ITEMS_TABLE.format('items_new'))
+
+    def add_item(self, item):
+        self.connection.execute('INSERT OR REPLACE INTO items_new VALUES (?, ?, ?, ?, ?)',
+                                (encode_path(item.path_wout_root), item.type, item.size, item.mtime_ns, item.inode))
+
+    def finish_new_snapshot(self, store_date, not_removed_paths=(), info=None):
+        # Replace stored snapshot with items added since start_new_snapshot(), see write_snapshot().
+        with self.connection:
+            self.connection.execute('DROP TABLE items')
+            self.connection.execute('ALTER TABLE items_new RENAME TO items')
+            self.connection.execute('DELETE FROM not_removed')
+            self.connection.executemany('INSERT OR IGNORE INTO not_removed VALUES (?)',
+                                        ((encode_path(path),) for path in not_removed_paths))
+            self.connection.executemany('INSERT OR REPLACE INTO info VALUES (?, ?)',
+                                        [('path', encode_path(self.root.path)), ('date', store_date)])
+            if info:
+                self.connection.executemany('INSERT OR REPLACE INTO info VALUES (?, ?)', info.items())
+
+
+def get_path_to_database(path_to_folder):
+    return os.path.join(path_to_folder, scan_folder.SNAPSHOT_FOLDER, DATABASE_NAME)
+
+
+def open_store(path_to_folder, root_folder):
+    # Open store of the folder, create .folderSyncSnapshot folder if necessary.
+    # If there is snapshot stored with shelve by old version of folder_sync, import it first.
+    os.makedirs(os.path.join(path_to_folder, scan_folder.SNAPSHOT_FOLDER), exist_ok=True)
+    needs_import = not os.path.exists(get_path_to_database(path_to_folder)) and has_shelve_snapshot(path_to_folder)
+
+    store = SnapshotStore(path_to_folder, root_folder)
+    if needs_import:
+        try:
+            import_shelve_snapshot(store)
+        except Exception:
+            store.close()
+            os.remove(store.path_to_database)
+            raise
+    return store
+
+
+def has_stored_snapshot(path_to_folder):
+    # Check whether folder has been synced before
+    return os.path.exists(get_path_to_database(path_to_folder)) or has_shelve_snapshot(path_to_folder)
+
+
+def has_shelve_snapshot(path_to_folder):
+    return bool(dbm.whichdb(os.path.join(path_to_folder, scan_folder.SNAPSHOT_FOLDER, SHELVE_NAME)))
+
+
+def import_shelve_snapshot(store):
+    # Copy snapshot stored with shelve by old versions of folder_sync into SQLite store.
+    # Shelve files are left as they are, new versions just don't read them anymore.
+    path_to_shelve = os.path.join(store.root.path, scan_folder.SNAPSHOT_FOLDER, SHELVE_NAME)
+    log_file.info('Importing snapshot of %s stored by previous version...', store.root.path)
+
+    with shelve.open(path_to_shelve, 'r') as shel_file:
+        stored_snapshot = shel_file['snapshot']
+        store_date = shel_file['date']
+
+        # Old versions stored lists of files that were not removed for both folders inside each of them,
+        # and root folder name as the first element of a list showed which folder it belongs to
+        not_removed_paths = []
+        for key in ('to_remove_from_a', 'to_remove_from_b'):
+            were_not_removed = shel_file.get(key, [])
+            if were_not_removed and were_not_removed[0] == store.root.name:
+                for item in were_not_removed[1:]:
+                    if isinstance(item, list):
+                        not_removed_paths.append(item[1][3])
+                    else:
+                        not_removed_paths.append(item.path_wout_root)
+                break
+
+    items = []
+    for record in stored_snapshot.values():
+        if isinstance(record, list):  # snapshot items used to be lists with four paths inside
+            items.append(scan_folder.item_from_list(record, store.root))
+        else:
+            items.append(record)
+
+    store.write_snapshot(items, store_date, not_removed_paths)
+    log_file.info('%d items were imported.', len(items))
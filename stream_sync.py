@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+
+# This module syncs two folders in streaming mode of folder_sync.
+
+# Usual mode of folder_sync scans both folders into snapshots, compares them into lists of what to do,
+# shows the lists to user and only then starts copying. Here both folders are scanned in order of paths
+# and joined item by item with their snapshots stored after last sync, which are read from database
+# in the same order. Every decision is carried out right away: folders are created and items are removed
+# by the main thread, files are compared and copied by a thread pool while the next items are being scanned.
+# Memory doesn't grow with size of folders: only listings of folders on the current path, a window of jobs
+# in the pool and a few sets of paths of removed folders are kept. New snapshot of every folder is written
+# to its database item by item and replaces the old one when the whole folder has been synced.
+# There is nobody to ask in the middle, so what to do with items removed since last sync is decided up front.
+
+import collections
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import send2trash
+
+import compare_files
+import copy_files
+import metrics
+import progress
+import remove_files
+import scan_folder
+import snapshot_store
+
+log_file = logging.getLogger('fs1')
+
+# options, folder_sync sets them from command line
+# what to do with items that were removed from one folder since last sync:
+# 'remove' - remove them from the other folder too, 'restore' - copy them back, 'skip' - leave folders as they are
+on_removed = 'remove'
+window = 64  # jobs that can be in the thread pool at once
+
+
+def join_by_path(*streams):
+    # Join iterators of SnapshotItem sorted by path without root folder.
+    # Yields (path, [item from every stream or None if stream doesn't have this path]).
+    heads = [next(stream, None) for stream in streams]
+    while True:
+        paths = [item.path_wout_root for item in heads if item is not None]
+        if not paths:
+            return
+        path = min(paths)
+        row = []
+        for index, item in enumerate(heads):
+            if item is not None and item.path_wout_root == path:
+                row.append(item)
+                heads[index] = next(streams[index], None)
+            else:
+                row.append(None)
+        yield path, row
+
+
+def is_inside(path, folders):
+    # Check whether path is inside any of folders (set of paths without root folder)
+    parent = os.path.dirname(path)
+    while parent:
+        if parent in folders:
+            return True
+        parent = os.path.dirname(parent)
+    return False
+
+
+def make_item(root, path_wout_root):
+    # SnapshotItem with current state of item on disk
+    item_stat = os.stat(os.path.join(root.path, path_wout_root))
+    if os.path.isdir(os.path.join(root.path, path_wout_root)):
+        return scan_folder.SnapshotItem('folder', path_wout_root, 0, item_stat.st_mtime_ns, item_stat.st_ino, root)
+    return scan_folder.SnapshotItem('file', path_wout_root, item_stat.st_size, item_stat.st_mtime_ns,
+                                    item_stat.st_ino, root)
+
+
+def update_file(source, destination, root_folder, size):
+    # Replace destination with newer version the same way sync_files() of folder_sync does
+    if 0 < copy_files.delta_threshold <= size:
+        copy_files.delta_update(source, destination, root_folder)
+    elif copy_files.update_mode == 'trash':
+        send2trash.send2trash(destination)
+        copy_files.copy_file(source, destination)
+    else:
+        copy_files.replace_file(source, destination, root_folder)
+
+
+class StreamSync:
+    # State of one streaming sync of two folders. Index 0 is 1st folder, index 1 is 2nd folder.
+
+    def __init__(self, first_folder, second_folder, root_first_folder, root_second_folder, both_synced):
+        self.roots = (scan_folder.FolderRoot(first_folder, root_first_folder),
+                      scan_folder.FolderRoot(second_folder, root_second_folder))
+        self.both_synced = both_synced
+        self.stores = []
+        self.pending = collections.deque()  # (future, function to call with result in the main thread)
+        self.removed_folders = (set(), set())  # folders removed from every folder, their content goes with them
+        self.kept_folders = (set(), set())  # folders whose content is left as it is, e.g. they were not removed
+        self.not_removed = ([], [])  # paths to try to remove next time, stored in snapshot of every folder
+        self.were_copied = 0
+        self.were_created = 0
+        self.were_updated = 0
+        self.were_removed = 0
+        self.equal = 0
+        self.skipped = 0
+        self.size_copied_updated = 0
+
+    def say(self, message):
+        print(message)
+        log_file.info(message)
+
+    def warn(self, message):
+        progress.echo(message)
+        log_file.warning(message)
+
+    def keep(self, index, item):
+        # Item stays in folder as it is, put it in new snapshot
+        if item is not None:
+            self.stores[index].add_item(item)
+
+    def submit(self, job, on_done, *args):
+        # Run job in thread pool and call on_done(result, error) in the main thread when it's done.
+        # If there are too many jobs in flight, wait for the oldest one first, so memory stays bounded.
+        self.pending.append((self.executor.submit(job, *args), on_done))
+        while len(self.pending) > window:
+            self.finish_oldest_job()
+
+    def finish_oldest_job(self):
+        future, on_done = self.pending.popleft()
+        try:
+            result = future.result()
+        except OSError as error:
+            log_file.error(''.join(traceback.format_exception_only(type(error), error)))
+            on_done(None, error)
+        else:
+            on_done(result, None)
+
+    def copy_job(self, item, destination_index):
+        # Copy file to the other folder within limits of both volumes, returns SnapshotItem of the copy
+        destination_root = self.roots[destination_index]
+        with copy_files.get_volume_limit(item.root.path, 'read'), \
+                copy_files.get_volume_limit(destination_root.path, 'write'):
+            copy_files.copy_file(item.full_path, os.path.join(destination_root.path, item.path_wout_root))
+        return make_item(destination_root, item.path_wout_root)
+
+    def compare_job(self, item_a, item_b):
+        # Compare content of two files and replace the older one if they differ.
+        # Returns (None, None) for equal files or (index of folder where file was updated, its new SnapshotItem).
+        if compare_files.files_are_equal(item_a, item_b):
+            return None, None
+        newer, older, older_index = (item_a, item_b, 1) if item_a.mtime > item_b.mtime else (item_b, item_a, 0)
+        with copy_files.get_volume_limit(newer.root.path, 'read'), \
+                copy_files.get_volume_limit(older.root.path, 'write'):
+            update_file(newer.full_path, older.full_path, older.root.path, newer.size)
+        return older_index, make_item(older.root, older.path_wout_root)
+
+    def copy(self, item, destination_index):
+        # Copy item to the other folder: folders are created right away, files are copied by thread pool
+        self.keep(1 - destination_index, item)
+        destination = os.path.join(self.roots[destination_index].path, item.path_wout_root)
+
+        if item.type == 'folder':
+            try:
+                os.mkdir(destination)
+            except OSError as error:
+                log_file.error(''.join(traceback.format_exception_only(type(error), error)))
+                self.warn("'{}' was not created: {}".format(destination, error))
+                self.kept_folders[1 - destination_index].add(item.path_wout_root)
+                return
+            self.keep(destination_index, make_item(self.roots[destination_index], item.path_wout_root))
+            self.were_created += 1
+            progress.detail("- '{}' was created".format(destination))
+            return
+
+        def on_done(copied_item, error):
+            if error is not None:
+                self.warn("'{}' was not copied: {}".format(item.full_path, error))
+                return
+            self.keep(destination_index, copied_item)
+            self.were_copied += 1
+            self.size_copied_updated += item.size
+            self.bar.update(0, item.size)
+            progress.detail("'{}' was copied to '{}'.".format(item.full_path, destination))
+
+        self.submit(self.copy_job, on_done, item, destination_index)
+
+    def remove(self, item, index):
+        # Remove item with everything inside it from folder
+        try:
+            remove_files.remove_path(item.full_path)
+        except OSError as error:
+            log_file.error(''.join(traceback.format_exception_only(type(error), error)))
+            self.warn("'{}' was not removed: {}".format(item.full_path, error))
+            self.keep(index, item)
+            if item.type == 'folder':
+                self.kept_folders[index].add(item.path_wout_root)
+            # snapshot of the other folder remembers it as removed, so it is removed next time
+            self.not_removed[1 - index].append(item.path_wout_root)
+            return
+        if item.type == 'folder':
+            self.removed_folders[index].add(item.path_wout_root)
+        self.were_removed += 1
+        progress.detail("'{}' was removed".format(item.full_path))
+
+    def compare(self, item_a, item_b):
+        # Compare content of files with different time of modification in thread pool
+
+        def on_done(result, error):
+            if error is not None:
+                self.warn("'{}' was not compared or updated: {}".format(item_a.path_wout_root, error))
+                self.keep(0, item_a)
+                self.keep(1, item_b)
+                return
+            updated_index, updated_item = result
+            if updated_index is None:
+                self.equal += 1
+                self.keep(0, item_a)
+                self.keep(1, item_b)
+                return
+            self.keep(1 - updated_index, (item_a, item_b)[1 - updated_index])
+            self.keep(updated_index, updated_item)
+            self.were_updated += 1
+            self.size_copied_updated += updated_item.size
+            self.bar.update(0, updated_item.size)
+            progress.detail("'{}' was updated.".format(updated_item.full_path))
+
+        self.submit(self.compare_job, on_done, item_a, item_b)
+
+    def handle(self, path, item_a, item_b, previous_a, previous_b, not_removed_a, not_removed_b):
+        # Decide what to do with one path, the same way diff_snapshots() of folder_sync does
+        items = (item_a, item_b)
+        if item_a is None and item_b is None:  # it's been removed from both folders since last sync
+            return
+
+        # content of removed folders is gone with them, content of folders that are left as they are stays
+        for index in (0, 1):
+            if items[index] is not None and is_inside(path, self.removed_folders[index]):
+                return
+        if any(items[index] is not None and is_inside(path, self.kept_folders[index]) for index in (0, 1)):
+            self.keep(0, item_a)
+            self.keep(1, item_b)
+            return
+
+        if item_a is not None and item_b is not None:
+            if item_a.type != item_b.type:
+                self.warn("'{}' is a file in one folder and a folder in the other one, check it manually."
+                          .format(path))
+                self.skipped += 1
+                for index in (0, 1):
+                    self.keep(index, items[index])
+                    if items[index].type == 'folder':
+                        self.kept_folders[index].add(path)
+                return
+            if item_a.type == 'folder':
+                self.keep(0, item_a)
+                self.keep(1, item_b)
+                return
+
+            modified_a = previous_a is not None and item_a.mtime != previous_a.mtime
+            modified_b = previous_b is not None and item_b.mtime != previous_b.mtime
+            if self.both_synced and not modified_a and not modified_b:
+                self.equal += 1
+            elif self.both_synced and modified_a and modified_b:
+                self.warn('{} has changed in both folders, so you need to choose right version manually. '
+                          'Program will not manage it.'.format(path))
+                self.skipped += 1
+            elif item_a.mtime != item_b.mtime:
+                self.compare(item_a, item_b)
+                return
+            elif item_a.size == item_b.size:
+                self.equal += 1
+            else:
+                self.warn('{} has the same time of modification but different size in both folders, '
+                          'check it manually.'.format(path))
+                self.skipped += 1
+            self.keep(0, item_a)
+            self.keep(1, item_b)
+            return
+
+        # item exists only in one folder
+        index = 0 if item_a is not None else 1
+        item = items[index]
+        previous_in_other = previous_b if index == 0 else previous_a
+        removed_from_other = previous_in_other is not None or path in (not_removed_b if index == 0 else not_removed_a)
+
+        if not removed_from_other or on_removed == 'restore':
+            self.copy(item, 1 - index)
+        elif on_removed == 'remove':
+            self.remove(item, index)
+        else:  # 'skip'
+            self.keep(index, item)
+            if item.type == 'folder':
+                self.kept_folders[index].add(path)
+
+    def run(self):
+        with metrics.phase('stream_sync'):
+            self.sync()
+
+    def sync(self):
+        start_time = time.time()
+        scan_info = []
+        for root in self.roots:
+            store = snapshot_store.open_store(root.path, root.name)
+            self.stores.append(store)
+            scan_info.append({'root_mtime_ns': os.stat(root.path).st_mtime_ns, 'scan_time_ns': time.time_ns()})
+        not_removed_a = set(self.stores[0].not_removed_paths())
+        not_removed_b = set(self.stores[1].not_removed_paths())
+
+        def scan(index):
+            # folders that have been removed are not listed
+            root = self.roots[index]
+
+            def skip_folder(path_wout_root):
+                return path_wout_root in self.removed_folders[index]
+
+            for item_type, path_wout_root, size, mtime_ns, inode in scan_folder.scan_folder_sorted(root.path,
+                                                                                                 skip_folder):
+                yield scan_folder.SnapshotItem(item_type, path_wout_root, size, mtime_ns, inode, root)
+
+        try:
+            for store in self.stores:
+                store.start_new_snapshot()
+            streams = [scan(0), scan(1)]
+            # previous snapshots tell what has been removed or modified since last sync,
+            # they are empty for folders that have not been synced before
+            streams += [store.iter_items() for store in self.stores]
+
+            # total is not known until folders have been scanned, so there is no ETA
+            with ThreadPoolExecutor(max_workers=max(copy_files.workers, 1), thread_name_prefix='stream') \
+                    as self.executor, progress.Progress('Syncing items') as self.bar:
+                for path, (item_a, item_b, previous_a, previous_b) in join_by_path(*streams):
+                    self.handle(path, item_a, item_b, previous_a, previous_b, not_removed_a, not_removed_b)
+                    self.bar.update()
+                while self.pending:
+                    self.finish_oldest_job()
+
+            store_time = time.strftime('%Y-%m-%d %Hh-%Mm')
+            for index, store in enumerate(self.stores):
+                store.finish_new_snapshot(store_time, self.not_removed[index], scan_info[index])
+        finally:
+            for store in self.stores:
+                store.close()
+            compare_files.close_hash_caches()
+
+        if copy_files.update_mode == 'stash':
+            for root in self.roots:
+                copy_files.evict_stash(root.path)
+
+        self.log_summary(start_time)
+
+    def log_summary(self, start_time):
+        print()
+        for number, message in ((self.equal, '{} file(s) are equal.'),
+                                (self.were_created, '{} folders were created.'),
+                                (self.were_copied, '{} file(s) were copied.'),
+                                (self.were_updated, '{} file(s) were updated.'),
+                                (self.were_removed, '{} item(s) were removed.'),
+                                (self.skipped, 'There are {} items that you should check manually.')):
+            if number > 0:
+                self.say(message.format(number))
+        if self.size_copied_updated > 0:
+            self.say('Total size of files were copied or updated is {:.2f} MB.'.format(
+                self.size_copied_updated / 1024 ** 2))
+            copy_files.log_stats()
+        compare_files.log_stats()
+        if not (self.were_created or self.were_copied or self.were_updated or self.were_removed):
+            self.say('There is nothing to copy or remove.')
+        self.say('--- {0:.3f} seconds ---\n'.format(time.time() - start_time))
+
+
+def sync_folders(first_folder, second_folder, root_first_folder, root_second_folder, both_synced):
+    # Scan, compare and sync both folders at once, see comments at the top of the module
+    message = 'Syncing folders in streaming mode, items removed since last sync will be {}.'.format(
+        {'remove': 'removed from the other folder', 'restore': 'copied back',
+         'skip': 'left as they are'}[on_removed])
+    print(message)
+    log_file.info(message)
+    StreamSync(first_folder, second_folder, root_first_folder, root_second_folder, both_synced).run()
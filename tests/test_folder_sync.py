@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+# Tests of the decisions folder_sync makes: which items have changed since last sync (ChangeSet)
+# and what has to be copied, updated or removed in every folder (diff_snapshots()).
+# Usage: python -m unittest discover tests
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scan_folder  # noqa: E402
+import snapshot_store  # noqa: E402
+
+# folder_sync starts writing its log to 'log' folder in current directory as soon as it is imported
+LOG_FOLDER = tempfile.mkdtemp()
+_cwd = os.getcwd()
+os.chdir(LOG_FOLDER)
+try:
+    import folder_sync  # noqa: E402
+finally:
+    os.chdir(_cwd)
+
+OLD = 1500000000  # time of modification of files that have not changed since last sync, in seconds
+NEW = 1600000000  # ... and of files that have been modified since then
+
+
+def tearDownModule():
+    shutil.rmtree(LOG_FOLDER, ignore_errors=True)
+
+
+def make_folder(parent, name, files):
+    # Create folder with files {path without root folder: (content, time of modification in seconds)}
+    # and return its snapshot
+    path = os.path.join(parent, name)
+    os.makedirs(path)
+    for path_wout_root, (content, mtime) in files.items():
+        full_path = os.path.join(path, path_wout_root)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w') as file:
+            file.write(content)
+        os.utime(full_path, (mtime, mtime))
+    root = scan_folder.FolderRoot(path, name)
+    return {item[1]: scan_folder.SnapshotItem(*item, root) for item in scan_folder.scan_folder(path)}
+
+
+def quietly(function, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        return function(*args, **kwargs)
+
+
+class ChangeSetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_changes_since_last_sync(self):
+        previous = make_folder(self.folder, 'previous', {
+            'kept.txt': ('a', OLD), 'modified.txt': ('a', OLD), 'removed.txt': ('a', OLD),
+            os.path.join('d', 'kept.txt'): ('a', OLD), os.path.join('gone', 'x.txt'): ('a', OLD),
+            'not removed.txt': ('a', OLD)})
+        current = make_folder(self.folder, 'current', {
+            'kept.txt': ('a', OLD), 'modified.txt': ('b', NEW), 'new.txt': ('a', OLD),
+            os.path.join('d', 'kept.txt'): ('a', OLD), os.path.join('d', 'new.txt'): ('a', OLD),
+            'd.txt': ('a', OLD), 'not removed.txt': ('a', OLD)})
+
+        # previous snapshot is read from store in order of UTF-8 bytes of paths, like folder_sync does it
+        with snapshot_store.open_store(self.folder, 'previous') as store:
+            store.write_snapshot(previous.values(), 'date')
+            changes = folder_sync.ChangeSet(current, store.iter_items(), ['not removed.txt'], 'date')
+
+        self.assertEqual(changes.removed, {'removed.txt', 'gone', os.path.join('gone', 'x.txt'), 'not removed.txt'})
+        self.assertEqual(changes.new, {'new.txt', os.path.join('d', 'new.txt'), 'd.txt'})
+        self.assertEqual(changes.modified, {'modified.txt'})
+
+
+class DiffSnapshotsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.snap_a = make_folder(self.folder, 'a', {
+            'equal.txt': ('same', OLD),
+            'newer in a.txt': ('new', NEW),
+            'newer in b.txt': ('old', OLD),
+            'same content.txt': ('same', NEW),
+            'changed in both.txt': ('a', NEW),
+            'only in a.txt': ('a', OLD),
+            'removed from b.txt': ('a', OLD),
+            os.path.join('same', 'x.txt'): ('x', OLD),
+            os.path.join('only in a', 'y.txt'): ('y', OLD),
+        })
+        self.snap_b = make_folder(self.folder, 'b', {
+            'equal.txt': ('same', OLD),
+            'newer in a.txt': ('old', OLD),
+            'newer in b.txt': ('new', NEW),
+            'same content.txt': ('same', OLD),
+            'changed in both.txt': ('b', NEW + 1),
+            'only in b.txt': ('b', OLD),
+            os.path.join('same', 'x.txt'): ('x', OLD),
+            os.path.join('removed from a', 'z.txt'): ('z', OLD),
+        })
+        self.were_removed_from_a = {'removed from a', os.path.join('removed from a', 'z.txt')}
+        self.were_removed_from_b = {'removed from b.txt'}
+        self.updated_items_a = {'newer in a.txt', 'same content.txt', 'changed in both.txt'}
+        self.updated_items_b = {'newer in b.txt', 'changed in both.txt'}
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def diff(self, trees=None):
+        return quietly(folder_sync.diff_snapshots, self.snap_a, self.snap_b, 'a', 'b', True,
+                       self.were_removed_from_a, self.were_removed_from_b, self.updated_items_a,
+                       self.updated_items_b, trees)
+
+    def check_plan(self, plan):
+        def paths(items):
+            return sorted(item.path_wout_root for item in items)
+
+        def updated_paths(updates):  # updated files are right inside root folders
+            return sorted(os.path.basename(destination) for source, destination, size in updates)
+
+        self.assertEqual(paths(plan.copy_from_a_to_b),
+                         sorted(['only in a', os.path.join('only in a', 'y.txt'), 'only in a.txt']))
+        self.assertEqual(paths(plan.copy_from_b_to_a), ['only in b.txt'])
+        self.assertEqual(paths(plan.remove_from_a), ['removed from b.txt'])
+        self.assertEqual(paths(plan.remove_from_b),
+                         sorted(['removed from a', os.path.join('removed from a', 'z.txt')]))
+        self.assertEqual(updated_paths(plan.update_from_a_to_b), ['newer in a.txt'])
+        self.assertEqual(updated_paths(plan.update_from_b_to_a), ['newer in b.txt'])
+        self.assertEqual(plan.skipped, ['changed in both.txt'])
+        self.assertEqual(len(plan.common) + plan.num_identical_files, 6)
+        self.assertEqual(len(plan.equal) + plan.num_identical_files, 3)  # 'same content.txt' is equal by content
+        self.assertEqual((plan.num_files_in_a, plan.num_folders_in_a), (9, 2))
+        self.assertEqual((plan.num_files_in_b, plan.num_folders_in_b), (8, 2))
+
+    def test_plan(self):
+        self.check_plan(self.diff())
+
+    def test_plan_with_identical_folders_skipped(self):
+        # the same decisions are made when identical folders are not looked into
+        tree_a = scan_folder.FolderTree(self.snap_a)
+        tree_b = scan_folder.FolderTree(self.snap_b)
+        self.assertEqual(tree_a.identical_folders(tree_b), {'same'})
+        plan = self.diff((tree_a, tree_b))
+        self.check_plan(plan)
+        self.assertEqual(plan.num_identical_files, 1)
+
+    def test_first_sync_copies_instead_of_removing(self):
+        # folders that have never been synced have no changes since last sync
+        plan = quietly(folder_sync.diff_snapshots, self.snap_a, self.snap_b, 'a', 'b', False)
+        self.assertEqual(plan.remove_from_a, [])
+        self.assertEqual(plan.remove_from_b, [])
+        self.assertIn('removed from b.txt', [item.path_wout_root for item in plan.copy_from_a_to_b])
+
+
+if __name__ == '__main__':
+    unittest.main()
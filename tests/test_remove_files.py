@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+# Tests of grouping items to remove by top-most removed folder.
+# Usage: python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import remove_files  # noqa: E402
+import scan_folder  # noqa: E402
+
+ROOT = scan_folder.FolderRoot(os.sep + 'root', 'root')
+
+
+def make_item(item_type, path_wout_root, size=0):
+    return scan_folder.SnapshotItem(item_type, path_wout_root, size, 0, 0, ROOT)
+
+
+class CollapseTest(unittest.TestCase):
+
+    def test_content_of_removed_folder_goes_with_it(self):
+        items = [make_item('file', os.path.join('d', 'e', 'f.txt'), 3), make_item('folder', os.path.join('d', 'e')),
+                 make_item('folder', 'd'), make_item('file', os.path.join('d', 'g.txt'), 4),
+                 make_item('file', 'd.txt', 5), make_item('file', os.path.join('d0', 'h.txt'), 6)]
+        groups = remove_files.collapse(items)
+        self.assertEqual([group.top.path_wout_root for group in groups], ['d', 'd.txt', os.path.join('d0', 'h.txt')])
+        self.assertEqual(len(groups[0].items), 4)
+        self.assertEqual([group.size for group in groups], [7, 5, 6])
+
+    def test_file_is_not_parent_of_items_with_the_same_prefix(self):
+        groups = remove_files.collapse([make_item('file', 'a'), make_item('file', 'ab'),
+                                        make_item('file', os.path.join('a b', 'c'))])
+        self.assertEqual(len(groups), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
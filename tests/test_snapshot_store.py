@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+# Tests of SQLite snapshot store: order of items, incremental updates of stored snapshot
+# and reading children of one folder.
+# Usage: python -m unittest discover tests
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scan_folder  # noqa: E402
+import snapshot_store  # noqa: E402
+
+# names that sort right before and right after a folder and its content, both as str and as UTF-8 bytes
+PATHS = ['p', 'p.txt', os.path.join('p', 'x'), os.path.join('p', 'q'), os.path.join('p', 'q', 'y'), 'p0', 'pp',
+         os.path.join('pp', 'z'), 'café', 'bad\udcff']  # the last one is not valid UTF-8 on disk
+FOLDERS = {'p', os.path.join('p', 'q'), 'pp'}
+
+
+class SnapshotStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = snapshot_store.open_store(self.folder, 'root')
+        self.store.write_snapshot([self.make_item(path) for path in PATHS], 'date')
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.folder)
+
+    def make_item(self, path, size=1):
+        if path in FOLDERS:
+            return scan_folder.SnapshotItem('folder', path, 0, 10, 0, self.store.root)
+        return scan_folder.SnapshotItem('file', path, size, 10, 0, self.store.root)
+
+    def stored_paths(self):
+        return [item.path_wout_root for item in self.store.iter_items()]
+
+    def test_items_are_read_in_order_of_str(self):
+        # ChangeSet joins stored items with sorted() paths of current snapshot
+        self.assertEqual(self.stored_paths(), sorted(PATHS))
+
+    def test_removed_folder_is_deleted_with_content_only(self):
+        self.store.update_items([], ['p'], 'date')
+        self.assertEqual(self.stored_paths(), sorted(['p.txt', 'p0', 'pp', os.path.join('pp', 'z'), 'café',
+                                                      'bad\udcff']))
+
+    def test_removed_file_does_not_take_items_with_the_same_prefix(self):
+        self.store.update_items([], ['p.txt', os.path.join('p', 'q', 'y')], 'date')
+        self.assertEqual(self.stored_paths(), sorted(set(PATHS) - {'p.txt', os.path.join('p', 'q', 'y')}))
+
+    def test_changed_items_are_replaced_and_added(self):
+        self.store.update_items([self.make_item('p.txt', size=5), self.make_item('new')], [], 'date2')
+        self.assertEqual(self.store.get_item('p.txt').size, 5)
+        self.assertIsNotNone(self.store.get_item('new'))
+        self.assertEqual(len(self.stored_paths()), len(PATHS) + 1)
+        self.assertEqual(self.store.get_info('date'), 'date2')
+
+    def test_not_removed_paths_are_dropped_when_handled(self):
+        self.store.update_items([], [], 'date', ['p0', 'pp'])
+        self.assertEqual(self.store.not_removed_paths(), ['p0', 'pp'])
+        # 'p0' has been removed now, 'pp' still could not be removed
+        self.store.update_items([], ['p0', 'pp'], 'date', ['pp'])
+        self.assertEqual(self.store.not_removed_paths(), ['pp'])
+
+    def test_children_of_folder(self):
+        children = [item.path_wout_root for item in self.store.iter_children('p')]
+        self.assertEqual(children, [os.path.join('p', 'q'), os.path.join('p', 'x')])
+        self.assertEqual([item.path_wout_root for item in self.store.iter_children('')],
+                         sorted(['p', 'p.txt', 'p0', 'pp', 'café', 'bad\udcff']))
+        self.assertEqual(list(self.store.iter_children('p.txt')), [])
+
+    def test_folder_mtimes(self):
+        self.assertEqual(self.store.folder_mtimes(), dict.fromkeys(FOLDERS, 10))
+
+
+if __name__ == '__main__':
+    unittest.main()
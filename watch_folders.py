@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+# This module watches folders for changes in watch mode of folder_sync.
+
+# On Linux every folder of both trees is watched with inotify, so folder_sync learns which paths
+# have changed and looks only at them instead of scanning whole folders again. Changes are collected
+# until folders are quiet for a while (debounce), so e.g. a file that is being written or a folder that is being
+# unpacked is synced once. If kernel drops events because its queue overflowed, nobody knows what has changed,
+# so the whole folder is rescanned. Where inotify is not available folders are rescanned every few seconds.
+
+# In order to use it:
+# watcher = watch_folders.make_watcher([first_folder, second_folder], poll_interval)
+# changes = watcher.wait_for_changes(debounce)  # one item per folder: set of paths without root folder or None
+# watcher.close()
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+import scan_folder
+
+log_file = logging.getLogger('fs1')
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, length of name
+MAX_BATCH_WAIT = 10  # changes are synced after this many debounce periods even if folders are still busy
+
+
+def is_ignored(path_wout_root):
+    # Items that folder_sync never syncs: its own folder and temporary files
+    return (path_wout_root.split(os.sep, 1)[0] == scan_folder.SNAPSHOT_FOLDER or
+            os.path.basename(path_wout_root).startswith('~$'))
+
+
+class InotifyWatcher:
+    # Watch every folder of given trees with inotify
+
+    def __init__(self, folders):
+        self.folders = folders
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, 'inotify_init1: ' + os.strerror(error))
+        self.watches = {}  # keys are watch descriptors, values are (index of folder, path without root folder)
+        try:
+            for index, folder in enumerate(folders):
+                self.add_tree(index, folder, '')
+        except OSError:
+            self.close()
+            raise
+        log_file.info('%d folder(s) are watched with inotify.', len(self.watches))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def add_watch(self, index, full_path, path_wout_root):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(full_path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):  # folder has been removed or replaced already
+                return
+            # ENOSPC means that limit of watches (fs.inotify.max_user_watches) is reached
+            raise OSError(error, "inotify_add_watch '{}': {}".format(full_path, os.strerror(error)))
+        self.watches[wd] = (index, path_wout_root)
+
+    def add_tree(self, index, full_path, path_wout_root):
+        # Watch folder and all its subfolders, the same ones scan_folder descends into.
+        # Only folders are listed, files are not stat'ed.
+        folders_to_watch = [(full_path, path_wout_root)]
+        while folders_to_watch:
+            full_path, path_wout_root = folders_to_watch.pop()
+            self.add_watch(index, full_path, path_wout_root)
+            try:
+                with os.scandir(full_path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False) and entry.name != scan_folder.SNAPSHOT_FOLDER:
+                            path = os.path.join(path_wout_root, entry.name) if path_wout_root else entry.name
+                            folders_to_watch.append((entry.path, path))
+            except OSError:  # folder has been removed already or can't be listed, scan_folder skips it too
+                pass
+
+    def read_events(self, changes):
+        # Read all events that are waiting and add changed paths to changes
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))  # name is padded with zeros
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    log_file.warning('inotify queue overflowed, folders will be rescanned.')
+                    changes[:] = [None] * len(self.folders)
+                    continue
+                if wd not in self.watches:
+                    continue
+                index, folder_path = self.watches[wd]
+                if mask & IN_IGNORED:  # folder is not watched anymore, e.g. it has been removed
+                    del self.watches[wd]
+                    continue
+                if not name:  # event of watched folder itself, its parent gets its own event
+                    continue
+
+                path_wout_root = os.path.join(folder_path, name) if folder_path else name
+                if is_ignored(path_wout_root):
+                    continue
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    # watch new folder right away, whatever was created in it before is found by rescan of the folder
+                    self.add_tree(index, os.path.join(self.folders[index], path_wout_root), path_wout_root)
+                if changes[index] is not None:
+                    changes[index].add(path_wout_root)
+
+    def wait_for_changes(self, debounce):
+        # Block until something changes, then collect changes until there are no new events for debounce seconds.
+        # Returns list with set of changed paths without root folder for every folder,
+        # or None instead of set if the whole folder should be rescanned.
+        changes = [set() for folder in self.folders]
+        while not any(change is None or change for change in changes):
+            select.select([self.fd], [], [], 1)  # wake up every second so Ctrl+C works everywhere
+            self.read_events(changes)
+
+        deadline = time.monotonic() + debounce * MAX_BATCH_WAIT
+        while time.monotonic() < deadline:
+            ready, _, _ = select.select([self.fd], [], [], debounce)
+            if not ready:
+                break
+            self.read_events(changes)
+        return changes
+
+
+class PollingWatcher:
+    # Rescan folders every poll_interval seconds where inotify is not available
+
+    def __init__(self, folders, poll_interval):
+        self.folders = folders
+        self.poll_interval = poll_interval
+
+    def close(self):
+        pass
+
+    def wait_for_changes(self, debounce):
+        time.sleep(self.poll_interval)
+        return [None] * len(self.folders)
+
+
+def make_watcher(folders, poll_interval):
+    # InotifyWatcher if it can watch given folders, PollingWatcher otherwise
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(folders)
+        except (OSError, AttributeError) as error:  # AttributeError - there is no inotify in libc
+            message = "Can't watch folders with inotify ({}), they will be rescanned every {} seconds.".format(
+                error, poll_interval)
+            print(message)
+            log_file.warning(message)
+    return PollingWatcher(folders, poll_interval)